@@ -0,0 +1,83 @@
+# Measure segmentation throughput against the encoder batch size of
+# generate_masks.generate_masks_batch(), for the image encoder alone and
+# for whole micrographs including prompt decoding.
+
+from vesicle_picker import generate_masks
+from vesicle_picker.embedding_cache import MemoryEmbeddingCache
+import numpy as np
+import argparse
+import time
+
+
+def synthetic_micrograph(size, n_vesicles, seed=0):
+
+    """
+    Generate a noisy, preprocessed-looking micrograph of vesicles,
+    drawn as dark rings around slightly dark disks.
+    """
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.ogrid[:size, :size]
+    image = np.zeros((size, size), dtype=np.float32)
+    for _ in range(n_vesicles):
+        radius = rng.uniform(0.03, 0.08) * size
+        cy, cx = rng.uniform(0, size, size=2)
+        distance = np.sqrt((yy - cy)**2 + (xx - cx)**2)
+        image -= 0.5 * (distance < radius)
+        image -= 2.0 * (np.abs(distance - radius) < 0.006 * size)
+    return image + rng.normal(0, 0.3, size=image.shape).astype(np.float32)
+
+
+parser = argparse.ArgumentParser(description='Benchmark batched encoding.')
+parser.add_argument('model_weights_path', type=str,
+                    help='Segment-anything weights.')
+parser.add_argument('--model_type', type=str, default='vit_h',
+                    help='Segment-anything model type of the weights.')
+parser.add_argument('--device', type=str, default='cpu',
+                    help='Device to run the model on.')
+parser.add_argument('--micrographs', type=int, default=8,
+                    help='Number of synthetic micrographs to segment.')
+parser.add_argument('--size', type=int, default=1024,
+                    help='Side length of the preprocessed micrographs.')
+parser.add_argument('--batch_sizes', type=int, nargs='+',
+                    default=[1, 2, 4, 8],
+                    help='Encoder batch sizes to compare.')
+parser.add_argument('--points_per_side', type=int, default=16,
+                    help='Points per side of the prompt grid.')
+args = parser.parse_args()
+
+model = generate_masks.initialize_model(
+    args.model_weights_path, args.model_type, device=args.device
+)
+micrographs = [synthetic_micrograph(args.size, 12, seed)
+               for seed in range(args.micrographs)]
+images = [generate_masks.colour_image(micrograph)
+          for micrograph in micrographs]
+
+# Warm up, so the first batch size is not charged for allocation
+generate_masks.encode_images(model, images[:1], MemoryEmbeddingCache())
+
+print(f"{'batch size':>10} {'encode (img/s)':>15} "
+      f"{'segment (mic/s)':>16} {'speedup':>8}")
+
+baseline = None
+for batch_size in args.batch_sizes:
+
+    # The image encoder alone, into an empty cache each time
+    start = time.perf_counter()
+    generate_masks.encode_images(model, images, MemoryEmbeddingCache(),
+                                 batch_size)
+    encode_throughput = len(images) / (time.perf_counter() - start)
+
+    # Whole micrographs, encoding and prompt decoding
+    start = time.perf_counter()
+    generate_masks.generate_masks_batch(
+        micrographs, model, psize=1.0, downsample=1, batch_size=batch_size,
+        output_mode='crop', points_per_side=args.points_per_side
+    )
+    segment_throughput = len(micrographs) / (time.perf_counter() - start)
+
+    if baseline is None:
+        baseline = segment_throughput
+    print(f"{batch_size:>10} {encode_throughput:>15.2f} "
+          f"{segment_throughput:>16.3f} {segment_throughput / baseline:>7.2f}x")
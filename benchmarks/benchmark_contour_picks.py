@@ -0,0 +1,79 @@
+# Compare picks spaced along the contours of masks, from
+# postprocess.generate_picks() in "contour" mode, with picks on a grid
+# over their edges in "edge" mode: the runtime per micrograph and the
+# number of picks. A grid keeps one pick per box over all masks, so
+# vesicles that touch or overlap share picks, while contours are picked
+# one by one.
+
+from vesicle_picker import postprocess
+import numpy as np
+import argparse
+import time
+
+
+def synthetic_masks(n_masks, shape, seed=0):
+
+    """Generate n_masks compact, contoured circular masks."""
+
+    rng = np.random.default_rng(seed)
+    masks = []
+    for _ in range(n_masks):
+        radius = rng.uniform(20, 80)
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        y0, x0 = max(int(cy - radius) - 1, 0), max(int(cx - radius) - 1, 0)
+        y1 = min(int(cy + radius) + 2, shape[0])
+        x1 = min(int(cx + radius) + 2, shape[1])
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        crop = (yy - cy)**2 + (xx - cx)**2 <= radius**2
+        mask = {'segmentation_crop': crop,
+                'mask_box': [x0, y0, x1 - x0, y1 - y0],
+                'image_shape': shape,
+                'area': int(crop.sum())}
+        mask = postprocess.find_contour(mask)
+        if mask is not None:
+            masks.append(mask)
+    return masks
+
+
+def time_call(function, *args, repeats=3, **kwargs):
+
+    """Return the output of function and its best runtime in seconds."""
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return output, min(times)
+
+
+parser = argparse.ArgumentParser(description='Benchmark contour picks.')
+parser.add_argument('--size', type=int, default=1023,
+                    help='Side length of the downsampled micrograph.')
+parser.add_argument('--n_masks', type=int, default=200,
+                    help='Number of masks in the micrograph.')
+parser.add_argument('--psize', type=float, default=1.0,
+                    help='Pixel size in Angstrom.')
+parser.add_argument('--downsample', type=int, default=4,
+                    help='Downsampling factor.')
+parser.add_argument('--box_sizes', type=int, nargs='+',
+                    default=[16, 32, 64, 100, 200],
+                    help='Pick spacings to benchmark, in Angstrom.')
+args = parser.parse_args()
+
+masks = synthetic_masks(args.n_masks, (args.size, args.size))
+
+print(f"{'box (A)':>8} {'grid picks':>11} {'grid (s)':>9} "
+      f"{'contour picks':>14} {'contour (s)':>12} {'speedup':>8}")
+
+for box_size in args.box_sizes:
+    kwargs = dict(psize=args.psize, downsample=args.downsample,
+                  box_size=box_size)
+    grid, grid_time = time_call(postprocess.generate_picks, masks,
+                                mode='edge', **kwargs)
+    contour, contour_time = time_call(postprocess.generate_picks, masks,
+                                      mode='contour', **kwargs)
+
+    print(f"{box_size:>8} {len(grid[0]):>11} {grid_time:>9.4f} "
+          f"{len(contour[0]):>14} {contour_time:>12.4f} "
+          f"{grid_time / contour_time:>7.1f}x")
@@ -0,0 +1,95 @@
+# Compare the CPU inference options of generate_masks.initialize_model()
+# (fp32, int8, bf16, each with and without torch.compile) in latency per
+# micrograph and in how far their masks drift from those of fp32.
+
+from vesicle_picker import generate_masks, helpers
+import numpy as np
+import argparse
+import time
+
+# The options benchmarked, as (precision, compile)
+OPTIONS = [('fp32', False), ('int8', False), ('bf16', False),
+           ('fp32', True), ('int8', True), ('bf16', True)]
+
+
+def synthetic_micrograph(size, n_vesicles, seed=0):
+
+    """
+    Generate a noisy, preprocessed-looking micrograph of vesicles,
+    drawn as dark rings around slightly dark disks.
+    """
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.ogrid[:size, :size]
+    image = np.zeros((size, size), dtype=np.float32)
+    for _ in range(n_vesicles):
+        radius = rng.uniform(0.03, 0.08) * size
+        cy, cx = rng.uniform(0, size, size=2)
+        distance = np.sqrt((yy - cy)**2 + (xx - cx)**2)
+        image -= 0.5 * (distance < radius)
+        image -= 2.0 * (np.abs(distance - radius) < 0.006 * size)
+    return image + rng.normal(0, 0.3, size=image.shape).astype(np.float32)
+
+
+def mean_best_iou(reference, masks):
+
+    """The mean over reference masks of their best IoU with any mask."""
+
+    if len(reference) == 0 or len(masks) == 0:
+        return 0.0
+    a = np.array([helpers.expand_mask(mask).ravel() for mask in reference],
+                 dtype=np.float32)
+    b = np.array([helpers.expand_mask(mask).ravel() for mask in masks],
+                 dtype=np.float32)
+    intersection = a @ b.T
+    union = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - intersection
+    return float((intersection / union).max(axis=1).mean())
+
+
+parser = argparse.ArgumentParser(description='Benchmark CPU inference.')
+parser.add_argument('model_weights_path', type=str,
+                    help='Segment-anything weights.')
+parser.add_argument('--model_type', type=str, default='vit_h',
+                    help='Segment-anything model type of the weights.')
+parser.add_argument('--micrographs', type=int, default=3,
+                    help='Number of synthetic micrographs to segment.')
+parser.add_argument('--size', type=int, default=1024,
+                    help='Side length of the preprocessed micrographs.')
+parser.add_argument('--points_per_side', type=int, default=16,
+                    help='Points per side of the prompt grid.')
+args = parser.parse_args()
+
+micrographs = [synthetic_micrograph(args.size, 12, seed)
+               for seed in range(args.micrographs)]
+
+print(f"{'precision':>9} {'compile':>8} {'first (s)':>10} "
+      f"{'latency (s)':>12} {'masks':>6} {'count diff':>11} {'mask IoU':>9}")
+
+reference = None
+for precision, compile in OPTIONS:
+    model = generate_masks.initialize_model(
+        args.model_weights_path, args.model_type, device='cpu',
+        precision=precision, compile=compile
+    )
+
+    # The first micrograph includes compilation, so is reported separately
+    runtimes, results = [], []
+    for micrograph in micrographs:
+        start = time.perf_counter()
+        results.append(generate_masks.generate_masks(
+            micrograph, model, psize=1.0, downsample=1, output_mode='crop',
+            points_per_side=args.points_per_side
+        ))
+        runtimes.append(time.perf_counter() - start)
+    if reference is None:
+        reference = results
+
+    counts = [len(masks) for masks in results]
+    count_diff = np.mean([abs(len(masks) - len(truth))
+                          for masks, truth in zip(results, reference)])
+    iou = np.mean([mean_best_iou(truth, masks)
+                   for masks, truth in zip(results, reference)])
+    latency = np.mean(runtimes[1:]) if len(runtimes) > 1 else runtimes[0]
+    print(f"{precision:>9} {str(compile):>8} {runtimes[0]:>10.2f} "
+          f"{latency:>12.2f} {np.mean(counts):>6.1f} {count_diff:>11.1f} "
+          f"{iou:>9.3f}")
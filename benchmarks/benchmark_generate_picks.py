@@ -0,0 +1,102 @@
+# Compare the batched grid pick selection in postprocess.generate_picks()
+# against the previous block-by-block loop, checking that both return
+# identical picks across a range of box sizes.
+
+from vesicle_picker import helpers, postprocess
+import numpy as np
+import argparse
+import time
+
+
+def synthetic_masks(n_masks, shape, seed=0):
+
+    """Generate n_masks circular masks with one-pixel edges."""
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    masks = []
+    for _ in range(n_masks):
+        radius = rng.uniform(20, 80)
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        distance = np.sqrt((yy - cy)**2 + (xx - cx)**2)
+        masks.append({'segmentation': distance <= radius,
+                      'edge': np.abs(distance - radius) < 0.5})
+    return masks
+
+
+def generate_picks_loop(masks, psize, downsample, box_size, mode='edge'):
+
+    """The block-by-block loop previously used by generate_picks()."""
+
+    pick_mask = helpers.sum_masks(
+        masks, 'edge' if mode == 'edge' else 'segmentation'
+    )
+    box_size = int(np.round(box_size/(psize*downsample)))
+    h_org = pick_mask.shape[0]
+    w_org = pick_mask.shape[1]
+    h_pad = int(np.ceil(h_org/box_size)*box_size - h_org)
+    w_pad = int(np.ceil(w_org/box_size)*box_size - w_org)
+    pick_mask_pad = np.pad(pick_mask, ((0, h_pad), (0, w_pad)), "constant")
+    split_pick_mask = helpers.blockshaped(pick_mask_pad, box_size, box_size)
+    for i in range(split_pick_mask.shape[0]):
+        this_patch = np.copy(split_pick_mask[i, :, :])
+        if np.sum(this_patch) > 0:
+            indices = np.argwhere(this_patch)
+            distances = np.sum((indices - box_size / 2) ** 2, axis=1)
+            best_indices = indices[np.argmin(distances)]
+            this_patch = np.zeros(this_patch.shape)
+            this_patch[best_indices[0], best_indices[1]] = 1
+            split_pick_mask[i, :, :] = this_patch
+    merged_pick_mask_pad = helpers.unblockshaped(
+        split_pick_mask, pick_mask_pad.shape[0], pick_mask_pad.shape[1]
+    )
+    merged_pick_mask = merged_pick_mask_pad[0:h_org, 0:w_org]
+    pick_indices = np.where(merged_pick_mask == 1)
+    return (downsample*pick_indices[0], downsample*pick_indices[1])
+
+
+def time_call(function, *args, repeats=3, **kwargs):
+
+    """Return the output of function and its best runtime in seconds."""
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return output, min(times)
+
+
+parser = argparse.ArgumentParser(description='Benchmark generate_picks.')
+parser.add_argument('--size', type=int, default=1023,
+                    help='Side length of the downsampled micrograph.')
+parser.add_argument('--n_masks', type=int, default=200,
+                    help='Number of masks in the micrograph.')
+parser.add_argument('--psize', type=float, default=1.0,
+                    help='Pixel size in Angstrom.')
+parser.add_argument('--downsample', type=int, default=4,
+                    help='Downsampling factor.')
+parser.add_argument('--box_sizes', type=int, nargs='+',
+                    default=[8, 16, 32, 64, 100, 200],
+                    help='Box sizes to benchmark, in Angstrom.')
+args = parser.parse_args()
+
+masks = synthetic_masks(args.n_masks, (args.size, args.size))
+
+print(f"{'mode':>8} {'box (A)':>8} {'picks':>7} {'loop (s)':>9} "
+      f"{'batched (s)':>12} {'speedup':>8} {'identical':>10}")
+
+for mode in ('edge', 'surface'):
+    for box_size in args.box_sizes:
+        kwargs = dict(psize=args.psize, downsample=args.downsample,
+                      box_size=box_size, mode=mode)
+        reference, loop_time = time_call(generate_picks_loop, masks, **kwargs)
+        picks, batched_time = time_call(
+            postprocess.generate_picks, masks, **kwargs
+        )
+        identical = all(
+            np.array_equal(a, b) for a, b in zip(reference, picks)
+        )
+        print(f"{mode:>8} {box_size:>8} {len(picks[0]):>7} "
+              f"{loop_time:>9.4f} {batched_time:>12.4f} "
+              f"{loop_time / batched_time:>7.1f}x {str(identical):>10}")
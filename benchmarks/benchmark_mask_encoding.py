@@ -0,0 +1,106 @@
+# Compare the prime-product composite mask encoding with the packed
+# crop encoding used by export_masks_to_disk(), in file size,
+# encode/decode time, and the number of masks recovered exactly.
+
+from vesicle_picker import external_import, external_export
+import numpy as np
+import primefac
+import itertools
+import argparse
+import pickle
+import time
+import os
+import tempfile
+
+
+def synthetic_masks(n_masks, shape, seed=0):
+
+    """Generate n_masks overlapping circular masks in a frame of shape."""
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    masks = []
+    for _ in range(n_masks):
+        radius = rng.uniform(20, 80)
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        segmentation = (yy - cy)**2 + (xx - cx)**2 <= radius**2
+        masks.append({'segmentation': segmentation,
+                      'area': int(segmentation.sum())})
+    return masks
+
+
+def prime_encode(masks, compression='uint64'):
+
+    """The prime-product encoding previously used by export_masks_to_disk."""
+
+    primes = list(itertools.islice(primefac.primegen(), len(masks)))
+    composite_mask = np.ones(masks[0]['segmentation'].shape, dtype=int)
+    for mask, prime in zip(masks, primes):
+        prime_segmentation = np.ones_like(mask['segmentation']).astype(int)
+        prime_segmentation[mask['segmentation']] = prime
+        composite_mask = composite_mask * prime_segmentation
+    return {'masks': [{'prime_key': prime} for prime in primes],
+            'composite_mask': composite_mask.astype(compression)}
+
+
+def prime_decode(masks_file):
+
+    """The prime-product decoding previously used by import_masks_from_disk."""
+
+    return [masks_file['composite_mask'] % mask['prime_key'] == 0
+            for mask in masks_file['masks']]
+
+
+def time_call(function, *args):
+
+    """Return the output of function(*args) and its runtime in seconds."""
+
+    start = time.perf_counter()
+    output = function(*args)
+    return output, time.perf_counter() - start
+
+
+parser = argparse.ArgumentParser(description='Benchmark mask encodings.')
+parser.add_argument('--size', type=int, default=1024,
+                    help='Side length of the synthetic micrograph in pixels.')
+parser.add_argument('--n_masks', type=int, nargs='+',
+                    default=[10, 15, 20, 50, 200],
+                    help='Numbers of masks per micrograph to benchmark.')
+args = parser.parse_args()
+
+print(f"{'masks':>6} {'scheme':>8} {'size (kB)':>10} {'encode (s)':>11} "
+      f"{'decode (s)':>11} {'exact':>7}")
+
+with tempfile.TemporaryDirectory() as directory:
+    for n_masks in args.n_masks:
+        masks = synthetic_masks(n_masks, (args.size, args.size))
+        truth = [mask['segmentation'] for mask in masks]
+
+        # Prime-product encoding
+        prime_file, encode_time = time_call(prime_encode, masks)
+        decoded, decode_time = time_call(prime_decode, prime_file)
+        n_exact = sum(np.array_equal(a, b) for a, b in zip(truth, decoded))
+        size = len(pickle.dumps(prime_file)) / 1e3
+        print(f"{n_masks:>6} {'prime':>8} {size:>10.1f} {encode_time:>11.3f} "
+              f"{decode_time:>11.3f} {n_exact:>3}/{n_masks:<3}")
+
+        # Packed crop encoding, through the actual disk round trip
+        filename = os.path.join(directory, 'masks.pkl')
+        _, encode_time = time_call(
+            external_export.export_masks_to_disk, masks, filename
+        )
+        decoded, decode_time = time_call(
+            external_import.import_masks_from_disk, filename
+        )
+        decoded = [mask['segmentation'] for mask in decoded]
+        n_exact = sum(np.array_equal(a, b) for a, b in zip(truth, decoded))
+        size = os.path.getsize(filename) / 1e3
+        print(f"{n_masks:>6} {'packed':>8} {size:>10.1f} {encode_time:>11.3f} "
+              f"{decode_time:>11.3f} {n_exact:>3}/{n_masks:<3}")
+
+        # Decoding a single mask from the packed file
+        _, single_time = time_call(
+            external_import.import_mask_from_disk, filename, n_masks // 2
+        )
+        print(f"{n_masks:>6} {'single':>8} {'':>10} {'':>11} "
+              f"{single_time:>11.3f}")
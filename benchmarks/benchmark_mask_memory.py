@@ -0,0 +1,93 @@
+# Measure peak memory of the mask pipeline (postprocessing, dilation,
+# picking and export) with full-frame masks and with compact masks.
+
+from vesicle_picker import helpers, postprocess, external_export
+import numpy as np
+import argparse
+import tempfile
+import tracemalloc
+import os
+
+
+def synthetic_rles(n_masks, shape, seed=0):
+
+    """
+    Yield n_masks circular masks as uncompressed RLEs, in the form
+    returned by segment-anything with output_mode='uncompressed_rle'.
+    """
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    for _ in range(n_masks):
+        radius = rng.uniform(20, 80)
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        segmentation = (yy - cy)**2 + (xx - cx)**2 <= radius**2
+        flat = segmentation.T.ravel()
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+        counts = ([0] if flat[0] else []) + counts.tolist()
+        yield {'segmentation': {'size': list(shape), 'counts': counts},
+               'area': int(segmentation.sum())}
+
+
+def decode_rle(mask):
+
+    """Decode a mask to a full-frame segmentation, as binary_mask mode does."""
+
+    mask = dict(mask)
+    mask['segmentation'] = helpers.expand_mask(
+        helpers.compact_rle_mask(mask)
+    )
+    return mask
+
+
+def measure(function, *args):
+
+    """Run function(*args) and return its output and peak memory in MB."""
+
+    tracemalloc.start()
+    output = function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return output, peak / 1e6
+
+
+parser = argparse.ArgumentParser(description='Benchmark mask memory use.')
+parser.add_argument('--size', type=int, default=1024,
+                    help='Side length of the downsampled micrograph.')
+parser.add_argument('--n_masks', type=int, default=200,
+                    help='Number of masks in the micrograph.')
+args = parser.parse_args()
+
+shape = (args.size, args.size)
+micrograph = np.random.default_rng(0).normal(size=shape).astype(np.float32)
+functions = [postprocess.find_mask_intensity,
+             postprocess.find_contour,
+             postprocess.find_roundness,
+             postprocess.fit_ellipse]
+
+with tempfile.TemporaryDirectory() as directory:
+    for mode, convert in (('full', decode_rle),
+                          ('compact', helpers.compact_rle_mask)):
+        results = {}
+        masks, results['segment'] = measure(
+            lambda: [convert(mask)
+                     for mask in synthetic_rles(args.n_masks, shape)]
+        )
+        masks, results['postprocess'] = measure(
+            postprocess.postprocess_masks,
+            masks, functions, micrograph
+        )
+        masks, results['dilate'] = measure(
+            postprocess.dilate_masks, masks, 20, 1.0, 1
+        )
+        _, results['picks'] = measure(
+            postprocess.generate_picks, masks, 1.0, 4, 100
+        )
+        _, results['export'] = measure(
+            external_export.export_masks_to_disk,
+            masks, os.path.join(directory, 'masks.pkl')
+        )
+        print(f"{mode:>8}: " + ", ".join(
+            f"{stage} {peak:.1f} MB" for stage, peak in results.items()
+        ))
@@ -0,0 +1,118 @@
+# Compare dilating and eroding masks with one distance transform per mask
+# crop, in postprocess.offset_masks(), against the previous iterated 3x3
+# dilation or erosion followed by find_contour(): the runtime over a range
+# of distances, and how far the offset masks are from the true offset
+# disks of the synthetic vesicles.
+
+from vesicle_picker import helpers, postprocess
+import numpy as np
+import argparse
+import copy
+import cv2
+import time
+
+
+def synthetic_masks(n_masks, shape, seed=0):
+
+    """Generate n_masks compact circular masks, with their radii."""
+
+    rng = np.random.default_rng(seed)
+    masks, circles = [], []
+    for _ in range(n_masks):
+        radius = rng.uniform(20, 80)
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        y0, x0 = max(int(cy - radius) - 1, 0), max(int(cx - radius) - 1, 0)
+        y1 = min(int(cy + radius) + 2, shape[0])
+        x1 = min(int(cx + radius) + 2, shape[1])
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        crop = (yy - cy)**2 + (xx - cx)**2 <= radius**2
+        masks.append({'segmentation_crop': crop,
+                      'mask_box': [x0, y0, x1 - x0, y1 - y0],
+                      'image_shape': shape,
+                      'area': int(crop.sum())})
+        circles.append((cy, cx, radius))
+    return masks, circles
+
+
+def offset_masks_iterated(masks, offset, psize, downsample):
+
+    """The iterated 3x3 morphology previously used by dilate_masks()."""
+
+    iterations = int(np.round(abs(offset) / (psize * downsample)))
+    morphology = cv2.dilate if offset > 0 else cv2.erode
+    for mask in masks:
+        crop, mask_box = helpers.padded_mask_crop(mask, iterations)
+        helpers.set_mask_crop(mask, 'segmentation', morphology(
+            crop.astype(np.uint8),
+            np.ones((3, 3), np.uint8),
+            iterations=iterations
+        ).astype(bool), mask_box)
+        contoured_mask = postprocess.find_contour(mask)
+        helpers.set_mask_crop(
+            mask, 'edge',
+            np.zeros_like(helpers.mask_crop(mask)[0])
+            if contoured_mask is None
+            else helpers.mask_crop(contoured_mask, 'edge')[0]
+        )
+    return masks
+
+
+def offset_error(masks, circles, offset):
+
+    """
+    The mean fraction of pixels that differ between each offset mask and
+    the disk of its vesicle's radius plus the offset.
+    """
+
+    errors = []
+    for mask, (cy, cx, radius) in zip(masks, circles):
+        crop, x0, y0 = helpers.mask_crop(mask)
+        yy, xx = np.ogrid[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]]
+        disk = (yy - cy)**2 + (xx - cx)**2 <= (radius + offset)**2
+        errors.append(np.sum(crop != disk) / max(disk.sum(), 1))
+    return float(np.mean(errors))
+
+
+def time_call(function, masks, *args, repeats=3):
+
+    """Return the output of function and its best runtime in seconds."""
+
+    times = []
+    for _ in range(repeats):
+        masks_copy = copy.deepcopy(masks)
+        start = time.perf_counter()
+        output = function(masks_copy, *args)
+        times.append(time.perf_counter() - start)
+    return output, min(times)
+
+
+parser = argparse.ArgumentParser(description='Benchmark mask offsets.')
+parser.add_argument('--size', type=int, default=1023,
+                    help='Side length of the downsampled micrograph.')
+parser.add_argument('--n_masks', type=int, default=200,
+                    help='Number of masks in the micrograph.')
+parser.add_argument('--psize', type=float, default=1.0,
+                    help='Pixel size in Angstrom.')
+parser.add_argument('--downsample', type=int, default=4,
+                    help='Downsampling factor.')
+parser.add_argument('--offsets', type=int, nargs='+',
+                    default=[-40, -16, 16, 40, 100],
+                    help='Dilation (positive) or erosion (negative) '
+                         'distances to benchmark, in Angstrom.')
+args = parser.parse_args()
+
+masks, circles = synthetic_masks(args.n_masks, (args.size, args.size))
+
+print(f"{'offset (A)':>10} {'iterated (s)':>13} {'distance (s)':>13} "
+      f"{'speedup':>8} {'iterated error':>15} {'distance error':>15}")
+
+for offset in args.offsets:
+    pixels = offset / (args.psize * args.downsample)
+    iterated, iterated_time = time_call(offset_masks_iterated, masks, offset,
+                                        args.psize, args.downsample)
+    distance, distance_time = time_call(postprocess.offset_masks, masks,
+                                        offset, args.psize, args.downsample)
+    print(f"{offset:>10} {iterated_time:>13.4f} {distance_time:>13.4f} "
+          f"{iterated_time / distance_time:>7.1f}x "
+          f"{offset_error(iterated, circles, pixels):>15.3f} "
+          f"{offset_error(distance, circles, pixels):>15.3f}")
@@ -0,0 +1,100 @@
+# Compare the legacy funcs_mrcio readers and writer with the MRC and
+# MRCWriter classes on a multi-GB synthetic stack, for writing the stack,
+# reading whole frames, and reading small patches at random positions.
+# Unless the page cache is dropped between runs, reads after the first
+# come from memory, so the numbers measure per-call overhead and copies
+# rather than disk bandwidth. MRCWriter also computes the data statistics
+# of the header, which the legacy writer leaves at zero.
+
+from vesicle_picker import funcs_mrcio
+import numpy as np
+import argparse
+import time
+import os
+import tempfile
+
+
+def time_calls(function, calls):
+
+    """Return the mean runtime in seconds of function(*args) over calls."""
+
+    start = time.perf_counter()
+    for args in calls:
+        function(*args)
+    return (time.perf_counter() - start) / len(calls)
+
+
+def legacy_write(filename, frames, n_frames):
+
+    """Write a stack with iwrhdr_opened() and iwrsec_opened()."""
+
+    with open(filename, 'wb') as f:
+        funcs_mrcio.iwrhdr_opened(f, nxyz=[frames.shape[2], frames.shape[1],
+                                           n_frames])
+        for i in range(n_frames):
+            funcs_mrcio.iwrsec_opened(frames[i % len(frames)].T, f)
+
+
+def buffered_write(filename, frames, n_frames):
+
+    """Write a stack with MRCWriter."""
+
+    with funcs_mrcio.MRCWriter(filename) as writer:
+        for i in range(n_frames):
+            writer.write(frames[i % len(frames)])
+
+
+parser = argparse.ArgumentParser(description='Benchmark MRC input/output.')
+parser.add_argument('--size_gb', type=float, default=2,
+                    help='Size of the synthetic stack in GB.')
+parser.add_argument('--frame', type=int, default=4096,
+                    help='Side length of each frame in pixels.')
+parser.add_argument('--patch', type=int, default=256,
+                    help='Side length of each patch in pixels.')
+parser.add_argument('--n_patches', type=int, default=200,
+                    help='Number of random patches to read.')
+parser.add_argument('--directory', type=str, default=None,
+                    help='Directory for the stack (a temporary one if unset).')
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+frames = rng.standard_normal((4, args.frame, args.frame)).astype(np.float32)
+n_frames = max(1, int(args.size_gb * 1e9 / frames[0].nbytes))
+size_gb = n_frames * frames[0].nbytes / 1e9
+
+with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+    filename = os.path.join(directory, 'stack.mrc')
+
+    print(f"{'operation':>12} {'reader':>8} {'time (s)':>10} {'GB/s':>7}")
+
+    for name, write in [('legacy', legacy_write), ('MRC', buffered_write)]:
+        start = time.perf_counter()
+        write(filename, frames, n_frames)
+        elapsed = time.perf_counter() - start
+        print(f"{'write':>12} {name:>8} {elapsed:>10.3f} "
+              f"{size_gb / elapsed:>7.2f}")
+
+    # Whole frames, copied into memory as a caller would use them
+    frame_gb = frames[0].nbytes / 1e9
+    calls = [(filename, i) for i in range(n_frames)]
+    legacy = time_calls(funcs_mrcio.irdsec_closed, calls)
+    mrc = funcs_mrcio.MRC(filename)
+    mapped = time_calls(lambda _, i: np.array(mrc.section(i)), calls)
+    for name, elapsed in [('legacy', legacy), ('MRC', mapped)]:
+        print(f"{'frame':>12} {name:>8} {elapsed:>10.4f} "
+              f"{frame_gb / elapsed:>7.2f}")
+
+    # Small patches at random positions in random frames
+    patch_gb = args.patch**2 * 4 / 1e9
+    calls = []
+    for _ in range(args.n_patches):
+        x, y = rng.integers(0, args.frame - args.patch, size=2)
+        calls.append((filename, x, x + args.patch, y, y + args.patch,
+                      rng.integers(n_frames)))
+    legacy = time_calls(funcs_mrcio.irdpasMRC, calls)
+    mrc = funcs_mrcio.MRC(filename)
+    mapped = time_calls(lambda _, *region: np.array(mrc.patch(*region)),
+                        calls)
+    for name, elapsed in [('legacy', legacy), ('MRC', mapped)]:
+        print(f"{'patch':>12} {name:>8} {elapsed:>10.6f} "
+              f"{patch_gb / elapsed:>7.2f}")
@@ -0,0 +1,116 @@
+# Compare building the cryosparc Dataset of all picks with a
+# PickAccumulator against appending each micrograph's Dataset to a growing
+# one, as generate_picks.py used to, checking that both give the same
+# picks. Appending is quadratic, so it is only run on the first
+# micrographs by default.
+
+from vesicle_picker import external_export
+from cryosparc.dataset import Dataset
+import numpy as np
+import argparse
+import time
+
+
+def synthetic_micrographs(n_micrographs, seed=0):
+
+    """Generate a Dataset of micrographs with the fields of exposures."""
+
+    rng = np.random.default_rng(seed)
+    return Dataset([
+        ('uid', rng.integers(1, 2**63, n_micrographs, dtype=np.uint64)),
+        ('micrograph_blob/path', np.array(
+            [f"J1/motioncorrected/{index:06d}_patch_aligned_doseweighted.mrc"
+             for index in range(n_micrographs)], dtype=object)),
+        ('micrograph_blob/exp_group_id',
+         rng.integers(0, 4, n_micrographs).astype(np.uint32)),
+        ('micrograph_blob/shape',
+         np.tile(np.array([4092, 5760], dtype=np.uint32),
+                 (n_micrographs, 1))),
+        ('micrograph_blob/psize_A',
+         np.full(n_micrographs, 0.83, dtype=np.float32))
+    ])
+
+
+def synthetic_picks(n_micrographs, n_picks, seed=0):
+
+    """Split n_picks random pick indices between the micrographs."""
+
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(n_picks, np.ones(n_micrographs) / n_micrographs)
+    return [
+        (rng.integers(0, 4092, count), rng.integers(0, 5760, count))
+        for count in counts
+    ]
+
+
+def append_datasets(micrographs, picks):
+
+    """The per-micrograph append previously used by generate_picks.py."""
+
+    vesicle_picks = Dataset()
+    vesicle_picks.add_fields(
+        [field for field, _ in external_export.PICK_FIELDS],
+        [dtype for _, dtype in external_export.PICK_FIELDS]
+    )
+    for micrograph, pick_indices in zip(micrographs, picks):
+        pick_dataset = external_export.construct_csparc_dataset(
+            micrograph, pick_indices
+        )
+        vesicle_picks = vesicle_picks.append(pick_dataset)
+    return vesicle_picks
+
+
+def accumulate_picks(micrographs, picks):
+
+    """Build the Dataset of all picks with a PickAccumulator."""
+
+    pick_accumulator = external_export.PickAccumulator()
+    for micrograph, pick_indices in zip(micrographs, picks):
+        pick_accumulator.add(micrograph, pick_indices)
+    return pick_accumulator.dataset()
+
+
+def same_picks(a, b):
+
+    """Check that two pick Datasets hold the same locations."""
+
+    return len(a) == len(b) and all(
+        np.array_equal(a[field], b[field])
+        for field, _ in external_export.PICK_FIELDS
+    )
+
+
+parser = argparse.ArgumentParser(description='Benchmark pick Datasets.')
+parser.add_argument('--micrographs', type=int, default=10000,
+                    help='Number of micrographs.')
+parser.add_argument('--picks', type=int, default=1000000,
+                    help='Total number of picks over all micrographs.')
+parser.add_argument('--append_micrographs', type=int, default=1000,
+                    help='Number of micrographs to run the appending '
+                         'loop on, or 0 to skip it.')
+args = parser.parse_args()
+
+micrographs = synthetic_micrographs(args.micrographs)
+picks = synthetic_picks(args.micrographs, args.picks)
+rows = micrographs.rows()
+
+start = time.perf_counter()
+vesicle_picks = accumulate_picks(rows, picks)
+accumulate_time = time.perf_counter() - start
+print(f"PickAccumulator: {args.micrographs} micrographs, "
+      f"{len(vesicle_picks)} picks in {accumulate_time:.2f} s")
+
+# Compare both on the first micrographs
+n_append = min(args.append_micrographs, args.micrographs)
+if n_append > 0:
+    subset = [rows[index] for index in range(n_append)]
+    start = time.perf_counter()
+    appended = append_datasets(subset, picks[:n_append])
+    append_time = time.perf_counter() - start
+    start = time.perf_counter()
+    accumulated = accumulate_picks(subset, picks[:n_append])
+    subset_time = time.perf_counter() - start
+    print(f"On the first {n_append} micrographs ({len(appended)} picks): "
+          f"append {append_time:.2f} s, accumulate {subset_time:.2f} s, "
+          f"{append_time / subset_time:.1f}x, "
+          f"identical: {same_picks(appended, accumulated)}")
@@ -0,0 +1,145 @@
+# Compare the runtime of each lowpass mode of preprocess_micrograph() with
+# the exact bilateral filter on a synthetic micrograph, and how much each
+# changes the image segment-anything sees. Given model weights, also
+# segment each preprocessed image and compare the masks and picks with
+# those found after bilateral filtering.
+
+from vesicle_picker import preprocess, generate_masks, postprocess, helpers
+from scipy.spatial import cKDTree
+import numpy as np
+import argparse
+import cv2
+import time
+
+# Each mode with the options it is run with; bilateral is the reference
+MODES = {
+    'bilateral': {'d': 17, 'sigmaColor': 71, 'sigmaSpace': 71},
+    'bilateral_grid': {'d': 17, 'sigmaColor': 71, 'sigmaSpace': 71},
+    'guided': {'radius': 4, 'eps': 10},
+    'fourier': {'sigma': 2},
+    'gaussian': {'ksize': (0, 0), 'sigmaX': 2},
+}
+
+
+def synthetic_micrograph(size, n_vesicles, seed=0):
+
+    """
+    Generate a noisy micrograph of vesicles, drawn as dark rings
+    (membranes) around slightly dark disks (lumens).
+    """
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.ogrid[:size, :size]
+    image = np.zeros((size, size), dtype=np.float32)
+    for _ in range(n_vesicles):
+        radius = rng.uniform(0.02, 0.06) * size
+        cy, cx = rng.uniform(0, size, size=2)
+        distance = np.sqrt((yy - cy)**2 + (xx - cx)**2)
+        image -= 0.5 * (distance < radius)
+        image -= 2.0 * (np.abs(distance - radius) < 0.004 * size)
+    image += rng.poisson(20, size=image.shape).astype(np.float32)
+    return image
+
+
+def normalized(image):
+
+    """Normalize an image to uint8, as generate_masks() does."""
+
+    return cv2.normalize(image, None, 0, 255,
+                         cv2.NORM_MINMAX).astype("uint8")
+
+
+def mean_best_iou(reference, masks):
+
+    """The mean over reference masks of their best IoU with any mask."""
+
+    if len(reference) == 0 or len(masks) == 0:
+        return 0.0
+    a = np.array([helpers.expand_mask(mask).ravel() for mask in reference],
+                 dtype=np.float32)
+    b = np.array([helpers.expand_mask(mask).ravel() for mask in masks],
+                 dtype=np.float32)
+    intersection = a @ b.T
+    union = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - intersection
+    return float((intersection / union).max(axis=1).mean())
+
+
+def pick_recall(reference, picks, radius):
+
+    """The fraction of reference picks within radius of any pick."""
+
+    reference = np.stack(reference, axis=1)
+    picks = np.stack(picks, axis=1)
+    if len(reference) == 0 or len(picks) == 0:
+        return 0.0
+    distances, _ = cKDTree(picks).query(reference)
+    return float(np.mean(distances <= radius))
+
+
+parser = argparse.ArgumentParser(description='Benchmark lowpass modes.')
+parser.add_argument('--size', type=int, default=4096,
+                    help='Side length of the full-resolution micrograph.')
+parser.add_argument('--downsample', type=int, default=4,
+                    help='Downsampling factor.')
+parser.add_argument('--n_vesicles', type=int, default=30,
+                    help='Number of vesicles in the synthetic micrograph.')
+parser.add_argument('--repeats', type=int, default=3,
+                    help='Number of runs of each mode; the best is kept.')
+parser.add_argument('--model_weights_path', type=str, default=None,
+                    help='Segment-anything weights, to compare masks/picks.')
+parser.add_argument('--model_type', type=str, default='vit_b',
+                    help='Segment-anything model type of the weights.')
+parser.add_argument('--device', type=str, default='cpu',
+                    help='Device to run segment-anything on.')
+parser.add_argument('--psize', type=float, default=1.0,
+                    help='Pixel size in Angstrom, for picking.')
+parser.add_argument('--box_size', type=float, default=100,
+                    help='Pick spacing in Angstrom.')
+args = parser.parse_args()
+
+image_fullres = synthetic_micrograph(args.size, args.n_vesicles)
+model = None
+if args.model_weights_path is not None:
+    model = generate_masks.initialize_model(
+        args.model_weights_path, args.model_type, args.device
+    )
+
+print(f"{'mode':>15} {'time (s)':>9} {'speedup':>8} {'image r':>8}"
+      + (f" {'masks':>6} {'mask IoU':>9} {'picks':>6} {'pick recall':>12}"
+         if model is not None else ""))
+
+reference = {}
+for mode, kwargs in MODES.items():
+    runtimes = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        blur = preprocess.preprocess_micrograph(
+            image_fullres, args.downsample, mode, **kwargs
+        )
+        runtimes.append(time.perf_counter() - start)
+    runtime = min(runtimes)
+
+    if mode == 'bilateral':
+        reference = {'time': runtime, 'image': normalized(blur)}
+    image_r = np.corrcoef(normalized(blur).ravel(),
+                          reference['image'].ravel())[0, 1]
+    line = (f"{mode:>15} {runtime:>9.3f} "
+            f"{reference['time'] / runtime:>7.1f}x {image_r:>8.3f}")
+
+    if model is not None:
+        masks = postprocess.measure_masks(
+            generate_masks.generate_masks(blur, model, args.psize,
+                                          args.downsample, output_mode='crop'),
+            blur
+        )
+        picks = postprocess.generate_picks(masks, args.psize, args.downsample,
+                                           args.box_size)
+        if mode == 'bilateral':
+            reference.update(masks=masks, picks=picks)
+        iou = mean_best_iou(reference['masks'], masks)
+        recall = pick_recall(reference['picks'], picks,
+                             args.box_size / args.psize / 2)
+        line += (f" {len(masks):>6} {iou:>9.3f} "
+                 f"{len(picks[0]):>6} {recall:>12.3f}")
+
+    print(line)
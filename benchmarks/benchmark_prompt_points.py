@@ -0,0 +1,131 @@
+# Compare prompting segment-anything on a uniform grid with prompting it
+# only at the blobs found by prompts.blob_prompts(): the prompt points
+# given to the decoder, the decoder batches saved, the runtime, and the
+# recall of the masks found on the full grid.
+
+from vesicle_picker import generate_masks, helpers, prompts
+from vesicle_picker.embedding_cache import MemoryEmbeddingCache
+import numpy as np
+import argparse
+import cv2
+import time
+
+
+def synthetic_micrograph(size, n_vesicles, seed=0):
+
+    """
+    Generate a noisy, preprocessed-looking micrograph of vesicles,
+    drawn as dark rings around slightly dark disks.
+    """
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.ogrid[:size, :size]
+    image = np.zeros((size, size), dtype=np.float32)
+    for _ in range(n_vesicles):
+        radius = rng.uniform(0.03, 0.08) * size
+        cy, cx = rng.uniform(0, size, size=2)
+        distance = np.sqrt((yy - cy)**2 + (xx - cx)**2)
+        image -= 0.5 * (distance < radius)
+        image -= 2.0 * (np.abs(distance - radius) < 0.006 * size)
+    image += rng.normal(0, 0.3, size=image.shape).astype(np.float32)
+    return cv2.GaussianBlur(image, (0, 0), 2)
+
+
+def recall(reference, masks, threshold=0.5):
+
+    """The fraction of reference masks matched by a mask above an IoU."""
+
+    if len(reference) == 0:
+        return 1.0
+    if len(masks) == 0:
+        return 0.0
+    a = np.array([helpers.expand_mask(mask).ravel() for mask in reference],
+                 dtype=np.float32)
+    b = np.array([helpers.expand_mask(mask).ravel() for mask in masks],
+                 dtype=np.float32)
+    intersection = a @ b.T
+    union = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - intersection
+    return float(((intersection / union).max(axis=1) >= threshold).mean())
+
+
+parser = argparse.ArgumentParser(description='Benchmark prompt points.')
+parser.add_argument('model_weights_path', type=str,
+                    help='Segment-anything weights.')
+parser.add_argument('--model_type', type=str, default='vit_h',
+                    help='Segment-anything model type of the weights.')
+parser.add_argument('--device', type=str, default='cpu',
+                    help='Device to run the model on.')
+parser.add_argument('--micrographs', type=int, default=3,
+                    help='Number of synthetic micrographs to segment.')
+parser.add_argument('--size', type=int, default=1024,
+                    help='Side length of the preprocessed micrographs.')
+parser.add_argument('--points_per_side', type=int, default=32,
+                    help='Points per side of the uniform grid.')
+parser.add_argument('--points_per_batch', type=int, default=64,
+                    help='Prompt points per decoder batch.')
+args = parser.parse_args()
+
+model = generate_masks.initialize_model(
+    args.model_weights_path, args.model_type, device=args.device
+)
+micrographs = [synthetic_micrograph(args.size, 12, seed)
+               for seed in range(args.micrographs)]
+
+# The synthetic vesicles are 0.03 to 0.08 of the micrograph across,
+# at a pixel size of 1 Angstrom
+methods = {
+    'grid': None,
+    'log': {'method': 'log'},
+    'dog': {'method': 'dog'},
+    'log + 8x8 grid': {'method': 'log', 'grid_points_per_side': 8},
+}
+detector_kwargs = {'min_radius_A': 0.025 * args.size,
+                   'max_radius_A': 0.09 * args.size}
+
+# Encode each micrograph once, so the runtimes compare prompting
+cache = MemoryEmbeddingCache()
+mask_generator = generate_masks.build_mask_generator(
+    model, 'crop', cache, points_per_side=args.points_per_side,
+    points_per_batch=args.points_per_batch
+)
+for micrograph in micrographs:
+    generate_masks.encode_images(
+        model, generate_masks.crop_images(micrograph, mask_generator), cache
+    )
+
+print(f"{'prompts':>15} {'points':>7} {'batches':>8} {'detect (s)':>11} "
+      f"{'segment (s)':>12} {'masks':>6} {'recall':>7}")
+
+reference = None
+for name, kwargs in methods.items():
+    points, batches, detect, segment, counts, recalls = [], [], [], [], [], []
+    results = []
+    for micrograph in micrographs:
+        start = time.perf_counter()
+        micrograph_prompts = None
+        if kwargs is not None:
+            micrograph_prompts = prompts.blob_prompts(
+                micrograph, psize=1.0, downsample=1,
+                **detector_kwargs, **kwargs
+            )
+        detect.append(time.perf_counter() - start)
+        n_points = (args.points_per_side**2 if micrograph_prompts is None
+                    else len(micrograph_prompts))
+        points.append(n_points)
+        batches.append(-(-n_points // args.points_per_batch))
+
+        start = time.perf_counter()
+        results.append(generate_masks.generate_masks(
+            micrograph, model, psize=1.0, downsample=1, output_mode='crop',
+            mask_generator=mask_generator, prompts=micrograph_prompts
+        ))
+        segment.append(time.perf_counter() - start)
+        counts.append(len(results[-1]))
+
+    if reference is None:
+        reference = results
+    recalls = [recall(truth, masks)
+               for truth, masks in zip(reference, results)]
+    print(f"{name:>15} {np.mean(points):>7.0f} {np.mean(batches):>8.1f} "
+          f"{np.mean(detect):>11.3f} {np.mean(segment):>12.2f} "
+          f"{np.mean(counts):>6.1f} {np.mean(recalls):>7.2f}")
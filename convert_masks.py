@@ -0,0 +1,45 @@
+from vesicle_picker import (
+    external_import,
+    external_export
+)
+from tqdm import tqdm
+import argparse
+import glob
+import os
+
+# Read in the directory of mask files to convert
+parser = argparse.ArgumentParser(
+    description='Convert prime-product mask files to the packed encoding.'
+)
+parser.add_argument(
+    'directory',
+    type=str,
+    help='Directory containing *_vesicles.pkl or *_vesicles_filtered.pkl files.'
+)
+parser.add_argument(
+    '--output',
+    type=str,
+    default=None,
+    help='Directory to write converted files to. Defaults to in place.'
+)
+args = parser.parse_args()
+output_directory = args.output if args.output is not None else args.directory
+os.makedirs(output_directory, exist_ok=True)
+
+# Loop over all mask files in the input directory
+for masks_filename in tqdm(
+    sorted(glob.glob(os.path.join(args.directory, '*_vesicles*.pkl')))
+):
+
+    # Skip files that are already in the packed encoding
+    masks_file = external_import.load_masks_file(masks_filename)
+    if masks_file['encoding'] != 'prime_product':
+        continue
+
+    # Decode the composite mask and write the masks back out
+    masks = external_import.import_masks_from_disk(masks_filename)
+    external_export.export_masks_to_disk(
+        masks,
+        os.path.join(output_directory, os.path.basename(masks_filename)),
+        micrograph_uid=masks_file['uid']
+    )
@@ -2,10 +2,14 @@ from vesicle_picker import (
     postprocess,
     helpers,
     external_import,
-    external_export
+    external_export,
+    sharding,
+    manifest
 )
 from tqdm import tqdm
 import argparse
+import os
+import time
 
 # Read in the job parameters file
 parser = argparse.ArgumentParser(description='Description of your script')
@@ -14,6 +18,7 @@ parser.add_argument(
     type=str,
     help='Path to .ini file containing the parameters for vesicle picking.'
 )
+sharding.add_sharding_arguments(parser)
 args = parser.parse_args()
 parameters_filepath = args.parameters
 parameters = helpers.read_config(parameters_filepath)
@@ -29,8 +34,19 @@ micrographs = external_import.micrographs_from_csparc(
     job_type=parameters.get('csparc_input', 'type')
 )
 
-# Loop over all micrographs in the job directory
-for micrograph in tqdm(micrographs[:]):
+# Fingerprint the parameters that produce the filtered masks
+section_fingerprints = manifest.section_fingerprints(parameters, ['general'])
+section_fingerprints['filters'] = manifest.fingerprint(
+    helpers.read_filters(parameters_filepath)
+)
+
+# The status of each micrograph handled by this run, for the manifest
+statuses = {}
+start_time = time.time()
+
+# Loop over all micrographs in the job directory,
+# or over this process's share of them
+for micrograph in tqdm(sharding.select_micrographs(micrographs, args)):
 
     # Extract the micrograph UID
     uid = micrograph['uid']
@@ -40,25 +56,70 @@ for micrograph in tqdm(micrographs[:]):
         parameters.get('input', 'directory')+str(uid)+"_vesicles.pkl"
     )
 
-    # Read in the masks from that UID
-    masks = external_import.import_masks_from_disk(masks_filename)
-
-    # Filter these masks based on min and max values recorded in job parameters
-    filtered_masks = postprocess.apply_filters(masks, parameters_filepath)
-
-    # Don't write out if no masks pass filtering
-    if len(filtered_masks) == 0:
-        continue
-
     # Construct the filepath of the masks to save to disk
     filtered_masks_filename = (
         parameters.get('output', 'directory')+str(uid)+"_vesicles_filtered.pkl"
     )
 
+    # Skip the micrograph if its filtered masks are up to date with both
+    # the input masks and the filters, reading only the files' headers.
+    # Older input files without a fingerprint are identified by their
+    # size and modification time.
+    masks_header = external_import.load_masks_header(masks_filename)
+    fingerprint = {
+        'input': manifest.fingerprint(
+            masks_header['fingerprint']
+            or [os.path.getsize(masks_filename),
+                os.path.getmtime(masks_filename)]
+        ),
+        'sections': section_fingerprints
+    }
+    if not manifest.stale_parts(
+        manifest.read_fingerprint(filtered_masks_filename), fingerprint
+    ):
+        statuses[str(uid)] = 'up to date'
+        continue
+
+    # Micrographs without masks get an empty filtered file, so reruns
+    # know they are done
+    if masks_header['n_masks'] == 0:
+        external_export.export_masks_to_disk(
+            [],
+            filtered_masks_filename,
+            micrograph_uid=uid,
+            fingerprint=fingerprint
+        )
+        statuses[str(uid)] = 'no masks found'
+        continue
+
+    # Read in the masks from that UID
+    masks = external_import.import_masks_from_disk(masks_filename,
+                                                   compact=True)
+
+    # Filter these masks based on min and max values recorded in job parameters
+    filtered_masks = postprocess.apply_filters(masks, parameters_filepath)
+
     # Save the vesicles to the output directory
-    # on a micrograph-by-micrograph basis
+    # on a micrograph-by-micrograph basis, even if none pass filtering,
+    # so reruns know the micrograph is done
     external_export.export_masks_to_disk(
         filtered_masks,
         filtered_masks_filename,
         micrograph_uid=uid,
-        compression='uint64')
+        fingerprint=fingerprint
+    )
+    statuses[str(uid)] = (
+        'computed' if len(filtered_masks) > 0 else 'no masks passed'
+    )
+
+# Record what this run did in the run manifest
+manifest.update_manifest(
+    manifest.manifest_filename(
+        parameters.get('output', 'directory'), sharding.worker_name(args)
+    ),
+    parameters=parameters_filepath,
+    sections=section_fingerprints,
+    started=time.ctime(start_time),
+    finished=time.ctime(),
+    micrographs=statuses
+)
@@ -1,13 +1,23 @@
 from vesicle_picker import (
+    autotune,
     preprocess,
+    prompts,
     generate_masks,
+    classical_masks,
     postprocess,
     helpers,
     external_import,
-    external_export
+    external_export,
+    pipeline,
+    sharding,
+    manifest,
+    sources,
+    embedding_cache,
+    segmentation_service
 )
 from tqdm import tqdm
 import argparse
+import time
 
 # Read in the job parameters file
 parser = argparse.ArgumentParser(description='Description of your script')
@@ -16,6 +26,7 @@ parser.add_argument(
     type=str,
     help='Path to .ini file containing the parameters for vesicle picking.'
 )
+sharding.add_sharding_arguments(parser)
 args = parser.parse_args()
 parameters_filepath = args.parameters
 parameters = helpers.read_config(parameters_filepath)
@@ -26,6 +37,10 @@ cs = external_import.load_cryosparc(parameters.get('csparc_input', 'login'))
 # Define the project
 project = cs.find_project(parameters.get('csparc_input', 'PID'))
 
+# Read micrographs from local MRC files if a [local_input] section is
+# given, otherwise download them from cryoSPARC
+source = sources.micrograph_source(parameters, project)
+
 # Pull micrographs object from the output of a curate exposures job
 micrographs = external_import.micrographs_from_csparc(
     cs=cs,
@@ -34,68 +49,405 @@ micrographs = external_import.micrographs_from_csparc(
     job_type=parameters.get('csparc_input', 'type')
 )
 
-# Initialize the model
-model = generate_masks.initialize_model(
-    model_weights_path=parameters.get('segmentation', 'model_weights_path'),
-    model_type=parameters.get('segmentation', 'model_type'),
-    device=parameters.get('segmentation', 'device')
-)
+# Read the lowpass filter used in preprocessing
+lowpass_mode, lowpass_kwargs = preprocess.lowpass_parameters(parameters)
 
-# Loop over all micrographs in the job directory
-for micrograph in tqdm(micrographs[:]):
+# Read the segmentation backend: segment-anything ("sam"), or the faster
+# but less accurate detector of classical_masks ("classical")
+backend = parameters.get('segmentation', 'backend', fallback='sam')
+if backend not in ['sam', 'classical']:
+    raise Exception(
+        "Please input a valid segmentation backend (sam, classical)."
+    )
+classical_kwargs = classical_masks.classical_parameters(parameters)
 
-    # Extract the image
-    header, image_fullres = project.download_mrc(
-        micrograph["micrograph_blob/path"]
+# Read the segment-anything mask generator parameters
+segmentation_kwargs = generate_masks.segmentation_parameters(parameters)
+
+# Segment large micrographs in overlapping tiles if a tile_size is given
+tiling_kwargs = generate_masks.tiling_parameters(parameters)
+
+# Prompt the model on the blobs found by a detector if a [prompts]
+# section is given, otherwise on a uniform grid of points
+prompt_method, prompt_kwargs = prompts.prompt_parameters(parameters)
+
+# Submit micrographs to a running segmentation service if a [service]
+# section is given, otherwise initialize the model in this process
+client = None
+cache = None
+if backend == 'sam' and parameters.has_section('service'):
+    client = segmentation_service.SegmentationClient(
+        *segmentation_service.service_address(parameters)
+    )
+    if tiling_kwargs is not None:
+        print("The segmentation service segments whole micrographs, "
+              "ignoring tile_size.")
+elif backend == 'sam':
+    model = generate_masks.initialize_model(
+        **generate_masks.model_parameters(parameters)
+    )
+
+    # Keep image embeddings on disk if a cache directory is given, so that
+    # re-segmenting with new thresholds skips the image encoder
+    cache = embedding_cache.cache_from_parameters(parameters)
+
+# Fingerprint the parameters that produce the masks. A change to
+# [postprocessing] alone lets the masks on disk be re-measured
+# without segmenting the micrograph again.
+segmentation_sections = ['general', 'preprocessing', 'segmentation']
+for section in ['prompts', 'classical']:
+    if parameters.has_section(section):
+        segmentation_sections.append(section)
+
+
+def fingerprint_sections():
+
+    """Fingerprint the parameter sections that produce the masks."""
+
+    section_fingerprints = manifest.section_fingerprints(
+        parameters,
+        segmentation_sections + ['postprocessing'],
+        ignore={'segmentation': ['device', 'points_per_batch', 'compile',
+                                 'embedding_cache',
+                                 'embedding_cache_size_gb']}
+    )
+    if parameters.has_option('postprocessing', 'filters'):
+        section_fingerprints['filters'] = manifest.fingerprint(
+            helpers.read_filters(parameters.get('postprocessing', 'filters'))
+        )
+    return section_fingerprints
+
+
+def masks_filename(uid):
+
+    """Construct the filepath of the masks of a micrograph on disk."""
+
+    return parameters.get('output', 'directory')+str(uid)+"_vesicles.pkl"
+
+
+def current_fingerprint(micrograph):
+
+    """The fingerprint the masks of a micrograph would have if recomputed."""
+
+    return {
+        'input': manifest.micrograph_fingerprint(micrograph),
+        'sections': section_fingerprints,
+        # Masks dropped by filters or as duplicates cannot be
+        # re-measured later
+        'complete': (
+            'filters' not in section_fingerprints
+            and not parameters.has_option('postprocessing', 'deduplicate')
+        )
+    }
+
+
+def apply_tuning(chosen):
+
+    """Replace the [segmentation] options with tuned values."""
+
+    global segmentation_kwargs
+    for option, value in chosen.items():
+        parameters.set('segmentation', option, str(value))
+    segmentation_kwargs = generate_masks.segmentation_parameters(parameters)
+
+
+# Tune points_per_batch, and any other options with candidate values in
+# an [autotune] section, on the first few micrographs, and segment with
+# the fastest configuration that fits within the memory budget. The
+# chosen values replace those in [segmentation], so they are fingerprinted.
+# Tuning depends on timings, so a choice recorded by an earlier run (or
+# another worker) with the same candidates and budget is reused instead,
+# and tuning only runs if there is no such choice and some masks need
+# to be computed.
+tuning = None
+if (parameters.has_section('autotune') and backend == 'sam'
+        and client is None):
+    autotune_kwargs = autotune.autotune_parameters(parameters)
+    recorded_tuning = manifest.recorded_entry(
+        parameters.get('output', 'directory'), 'autotune',
+        sharding.worker_name(args)
     )
-    image_fullres = image_fullres[0]
+    if (recorded_tuning is not None
+            and recorded_tuning.get('candidates')
+            == autotune_kwargs['candidates']
+            and recorded_tuning.get('memory_budget')
+            == autotune_kwargs['memory_budget']):
+        tuning = recorded_tuning
+        if tuning['chosen'] is not None:
+            print(f"Reusing tuned segmentation options: {tuning['chosen']}")
+            apply_tuning(tuning['chosen'])
+    else:
+        # Work queue workers claim micrographs as they go, so check all
+        section_fingerprints = fingerprint_sections()
+        if any(
+            manifest.stale_parts(
+                manifest.read_fingerprint(masks_filename(micrograph['uid'])),
+                current_fingerprint(micrograph)
+            )
+            for micrograph in (
+                micrographs if args.work_queue is not None
+                else sharding.select_micrographs(micrographs, args)
+            )
+        ):
+            tuning = autotune.tune_segmentation(
+                [
+                    preprocess.preprocess_micrograph(
+                        source.read(micrograph),
+                        downsample=parameters.getint('general', 'downsample'),
+                        lowpass_mode=lowpass_mode,
+                        **lowpass_kwargs
+                    )
+                    for micrograph in
+                    micrographs[:autotune_kwargs['micrographs']]
+                ],
+                model,
+                psize=parameters.getfloat('general', 'psize'),
+                downsample=parameters.getint('general', 'downsample'),
+                candidates=autotune_kwargs['candidates'],
+                memory_budget=autotune_kwargs['memory_budget'],
+                **segmentation_kwargs
+            )
+            tuning['candidates'] = autotune_kwargs['candidates']
+            if tuning['chosen'] is None:
+                print("No configuration fits within the memory budget, "
+                      "keeping the [segmentation] options.")
+            else:
+                print(f"Tuned segmentation options: {tuning['chosen']}")
+                apply_tuning(tuning['chosen'])
+
+section_fingerprints = fingerprint_sections()
+
+# The status of each micrograph handled by this run, for the manifest
+statuses = {}
+
+
+def plan(micrograph):
+
+    """
+    Decide what to recompute for a micrograph by comparing the fingerprint
+    of its masks on disk with the current one. Returns None if the masks
+    are up to date.
+    """
 
-    # Extract the micrograph UID
     uid = micrograph['uid']
+    fingerprint = current_fingerprint(micrograph)
+    recorded = manifest.read_fingerprint(masks_filename(uid))
+    stale = manifest.stale_parts(recorded, fingerprint)
+
+    if len(stale) == 0:
+        statuses[str(uid)] = 'up to date'
+        sharding.finish_micrograph(args, uid)
+        progress.update()
+        return None
+
+    reuse_masks = (
+        recorded is not None
+        and recorded.get('complete', False)
+        and stale.isdisjoint(['input'] + segmentation_sections)
+    )
+
+    return {'micrograph': micrograph, 'uid': uid,
+            'fingerprint': fingerprint, 'reuse_masks': reuse_masks}
+
+
+def download_stage(job):
+
+    """Download stage: fetch the full-resolution image of a micrograph."""
+
+    # Extract the image
+    job['image_fullres'] = source.read(job['micrograph'])
 
-    # Use the preprocess module to get micrograph ready for segmentation.
-    # This script uses bilateral filtering,
-    # can be adjusted for Gaussian if desired.
-    preprocessed_micrograph = preprocess.preprocess_micrograph(
-        image_fullres,
+    return job
+
+
+def preprocess_stage(job):
+
+    """Preprocessing stage: downsample and lowpass filter the image."""
+
+    # Use the preprocess module to get micrograph ready for segmentation,
+    # with the lowpass mode and options given in [preprocessing]
+    job['preprocessed_micrograph'] = preprocess.preprocess_micrograph(
+        job.pop('image_fullres'),
         downsample=parameters.getint('general', 'downsample'),
-        lowpass_mode=parameters.get('preprocessing', 'lowpass_mode'),
-        d=parameters.getint('preprocessing', 'd'),
-        sigmaColor=parameters.getint('preprocessing', 'sigmaColor'),
-        sigmaSpace=parameters.getint('preprocessing', 'sigmaSpace'))
+        lowpass_mode=lowpass_mode,
+        **lowpass_kwargs)
 
-    # Generate masks with user-optimized parameters
-    masks = generate_masks.generate_masks(
+    return job
+
+
+def prompt_points(preprocessed_micrograph):
+
+    """Find the prompt points of a micrograph, or None for the grid."""
+
+    if prompt_method is None:
+        return None
+    return prompts.blob_prompts(
         preprocessed_micrograph,
-        model,
         psize=parameters.getfloat('general', 'psize'),
         downsample=parameters.getint('general', 'downsample'),
-        points_per_side=parameters.getint('segmentation', 'points_per_side'),
-        points_per_batch=parameters.getint('segmentation', 'points_per_batch'),
-        pred_iou_thresh=parameters.getfloat('segmentation', 'pred_iou_thresh'),
-        stability_score_thresh=(
-            parameters.getfloat('segmentation', 'stability_score_thresh')
-        ),
-        crop_n_layers=parameters.getint('segmentation', 'crop_n_layers'),
-        crop_n_points_downscale_factor=(
-            parameters.getint('segmentation', 'crop_n_points_downscale_factor')
-        ),
-        crop_nms_thresh=parameters.getfloat('segmentation', 'crop_nms_thresh'),
-        min_mask_region_area=(
-            parameters.getint('segmentation', 'min_mask_region_area')
+        method=prompt_method,
+        **prompt_kwargs
+    )
+
+
+def segment_stage(job):
+
+    """
+    Segmentation stage: find masks with the model or the classical
+    detector, or read them back from disk if only the postprocessing
+    parameters have changed.
+    """
+
+    if job['reuse_masks']:
+        job['masks'] = external_import.import_masks_from_disk(
+            masks_filename(job['uid']),
+            compact=True
+        )
+        return job
+
+    if backend == 'classical':
+        job['masks'] = classical_masks.generate_masks_classical(
+            job['preprocessed_micrograph'],
+            psize=parameters.getfloat('general', 'psize'),
+            downsample=parameters.getint('general', 'downsample'),
+            output_mode='crop',
+            **classical_kwargs
+        )
+        return job
+
+    # Generate masks with user-optimized parameters
+    if client is not None:
+        job['masks'] = client.generate_masks(
+            job['preprocessed_micrograph'],
+            psize=parameters.getfloat('general', 'psize'),
+            downsample=parameters.getint('general', 'downsample'),
+            prompts=prompt_points(job['preprocessed_micrograph']),
+            **segmentation_kwargs
+        )
+        return job
+
+    if tiling_kwargs is not None:
+        job['masks'] = generate_masks.generate_masks_tiled(
+            job['preprocessed_micrograph'],
+            model,
+            psize=parameters.getfloat('general', 'psize'),
+            downsample=parameters.getint('general', 'downsample'),
+            output_mode='crop',
+            embedding_cache=cache,
+            prompts=prompt_points(job['preprocessed_micrograph']),
+            batch_size=encoder_batch_size,
+            **tiling_kwargs,
+            **segmentation_kwargs
         )
+        return job
+
+    job['masks'] = generate_masks.generate_masks(
+        job['preprocessed_micrograph'],
+        model,
+        psize=parameters.getfloat('general', 'psize'),
+        downsample=parameters.getint('general', 'downsample'),
+        output_mode='crop',
+        embedding_cache=cache,
+        prompts=prompt_points(job['preprocessed_micrograph']),
+        **segmentation_kwargs
     )
 
-    if len(masks) == 0:
-        continue
+    return job
 
-    # Use the postprocess module to compute statistics
-    # on the vesicles for downstream filtering
-    postprocessed_masks = postprocess.postprocess_masks(
-        masks,
-        eval(parameters.get('postprocessing', 'functions')),
-        preprocessed_micrograph
+
+def segment_batch_stage(jobs):
+
+    """
+    Batched segmentation stage: run the image encoder on the micrographs
+    of several jobs at once, then decode each. Jobs whose masks are read
+    back from disk or segmented by a service are handled one at a time.
+    """
+
+    batched = []
+    for job in jobs:
+        if job['reuse_masks'] or client is not None:
+            segment_stage(job)
+        else:
+            batched.append(job)
+    if len(batched) == 0:
+        return jobs
+
+    masks = generate_masks.generate_masks_batch(
+        [job['preprocessed_micrograph'] for job in batched],
+        model,
+        psize=parameters.getfloat('general', 'psize'),
+        downsample=parameters.getint('general', 'downsample'),
+        batch_size=encoder_batch_size,
+        output_mode='crop',
+        embedding_cache=cache,
+        prompts=[prompt_points(job['preprocessed_micrograph'])
+                 for job in batched],
+        **segmentation_kwargs
     )
+    for job, job_masks in zip(batched, masks):
+        job['masks'] = job_masks
+
+    return jobs
+
+
+def export_stage(job):
+
+    """Export stage: compute statistics on the masks and save them."""
+
+    uid = job['uid']
+    masks = job['masks']
+    preprocessed_micrograph = job['preprocessed_micrograph']
+
+    # Drop duplicate masks of the same vesicle before measuring them,
+    # keeping one of each set by the policy given in [postprocessing]
+    if parameters.has_option('postprocessing', 'deduplicate'):
+        masks, duplicate_report = postprocess.deduplicate_masks(
+            masks,
+            keep=parameters.get('postprocessing', 'deduplicate'),
+            iou_thresh=parameters.getfloat(
+                'postprocessing', 'duplicate_iou_thresh', fallback=0.8),
+            containment_thresh=parameters.getfloat(
+                'postprocessing', 'duplicate_containment_thresh',
+                fallback=0.9)
+        )
+        tqdm.write(
+            f"Micrograph {uid}: dropped "
+            f"{duplicate_report['masks'] - duplicate_report['kept']} "
+            f"duplicate masks."
+        )
+
+    # Use the postprocess module to compute statistics
+    # on the vesicles for downstream filtering, either with the fused
+    # single-pass engine or with a list of postprocessing functions.
+    # If a filters file is given, only compute the statistics it needs
+    # and drop the masks that fail its filters along the way.
+    if parameters.has_option('postprocessing', 'filters'):
+        postprocessed_masks, filter_report = (
+            postprocess.measure_and_filter_masks(
+                masks,
+                helpers.read_filters(
+                    parameters.get('postprocessing', 'filters')
+                ),
+                preprocessed_micrograph
+            )
+        )
+        tqdm.write(
+            f"Micrograph {uid}: kept {filter_report['kept']} of "
+            f"{filter_report['masks']} masks, skipped "
+            f"{filter_report['skipped']} metric evaluations."
+        )
+    elif parameters.get('postprocessing', 'engine',
+                        fallback='fused') == 'fused':
+        postprocessed_masks = postprocess.measure_masks(
+            masks,
+            preprocessed_micrograph
+        )
+    else:
+        postprocessed_masks = postprocess.postprocess_masks(
+            masks,
+            eval(parameters.get('postprocessing', 'functions')),
+            preprocessed_micrograph
+        )
 
     # Modify the ellipse fitting key-value pairs to convert to Angstrom
     for mask in postprocessed_masks:
@@ -112,16 +464,81 @@ for micrograph in tqdm(micrographs[:]):
                 mask['semi_major'] * psize * downsample
             )
 
-    # Construct the filepath of the masks to save to disk
-    masks_filename = (
-        parameters.get('output', 'directory')+str(uid)+"_vesicles.pkl"
-    )
-
-    # Save the vesicles to the output directory
-    # on a micrograph-by-micrograph basis
+    # Save the vesicles to the output directory on a micrograph-by-micrograph
+    # basis, even if there are none, so reruns know the micrograph is done
     external_export.export_masks_to_disk(
         postprocessed_masks,
-        masks_filename,
+        masks_filename(uid),
         micrograph_uid=uid,
-        compression='uint64'
+        fingerprint=job['fingerprint']
     )
+    statuses[str(uid)] = 'remeasured' if job['reuse_masks'] else 'computed'
+    sharding.finish_micrograph(args, uid)
+
+    progress.update()
+
+
+# Run the stages as a pipeline over all micrographs in the job directory,
+# so downloads and preprocessing run ahead while the model is busy
+# and export runs behind it. The segmentation stage can gather several
+# micrographs, or the tiles of one micrograph, and run the image encoder
+# on them together.
+encoder_batch_size = parameters.getint(
+    'pipeline', 'segmentation_batch_size', fallback=1
+)
+segmentation_batch_size = (
+    encoder_batch_size if backend == 'sam' and tiling_kwargs is None else 1
+)
+# Work queue micrographs are marked done once exported, since the
+# pipeline claims micrographs ahead of finishing them
+micrographs = sharding.select_micrographs(micrographs, args,
+                                          finish_on_next=False)
+progress = tqdm(total=(
+    len(micrographs) if args.work_queue is None else None
+))
+start_time = time.time()
+report = pipeline.run_pipeline(
+    (job for job in map(plan, micrographs) if job is not None),
+    [
+        pipeline.Stage('download', download_stage, workers=parameters.getint(
+            'pipeline', 'download_workers', fallback=1)),
+        pipeline.Stage('preprocess', preprocess_stage,
+                       workers=parameters.getint(
+                           'pipeline', 'preprocess_workers', fallback=1)),
+        pipeline.Stage(
+            'segment',
+            segment_batch_stage if segmentation_batch_size > 1
+            else segment_stage,
+            workers=parameters.getint(
+                'pipeline', 'segmentation_workers', fallback=1),
+            batch_size=segmentation_batch_size
+        ),
+        pipeline.Stage('export', export_stage, workers=parameters.getint(
+            'pipeline', 'export_workers', fallback=1)),
+    ],
+    queue_depth=parameters.getint('pipeline', 'queue_depth', fallback=2)
+)
+progress.close()
+
+# Show how busy each stage was, to find the bottleneck
+print(pipeline.format_report(report))
+summary = source.summary()
+print(f"Read {summary['micrographs']} micrographs ({summary['mode']}) at "
+      f"{summary['bandwidth_MBps']:.1f} MB/s, "
+      f"{summary['mean_first_pixel_seconds']:.3f} s to first pixel")
+
+# Record what this run did in the run manifest
+manifest.update_manifest(
+    manifest.manifest_filename(
+        parameters.get('output', 'directory'), sharding.worker_name(args)
+    ),
+    parameters=parameters_filepath,
+    sections=section_fingerprints,
+    started=time.ctime(start_time),
+    finished=time.ctime(),
+    pipeline=report,
+    source=summary,
+    embedding_cache=cache.summary() if cache is not None else None,
+    autotune=tuning,
+    micrographs=statuses
+)
@@ -2,7 +2,8 @@ from vesicle_picker import (
     postprocess,
     helpers,
     external_import,
-    external_export
+    external_export,
+    sharding
 )
 from tqdm import tqdm
 import argparse
@@ -16,6 +17,13 @@ parser.add_argument(
     type=str,
     help='Path to .ini file containing the parameters for vesicle picking.'
 )
+parser.add_argument(
+    '--merge',
+    action='store_true',
+    help='Instead of generating picks, merge the pick datasets saved by '
+         'sharded runs into a single Vesicle Picks job.'
+)
+sharding.add_sharding_arguments(parser)
 args = parser.parse_args()
 parameters_filepath = args.parameters
 parameters = helpers.read_config(parameters_filepath)
@@ -31,20 +39,28 @@ micrographs = external_import.micrographs_from_csparc(
     job_type=parameters.get('csparc_input', 'type')
 )
 
-# Initialize the final Dataset
-vesicle_picks = Dataset()
-vesicle_picks.add_fields(
-    ['location/micrograph_uid',
-     'location/exp_group_id',
-     'location/micrograph_path',
-     'location/micrograph_shape',
-     'location/center_x_frac',
-     'location/center_y_frac',
-     'location/micrograph_psize_A'],
-    ["<u8", "<u4", "str", "<u4", "<f4", "<f4", "<f4"])
-
-# Loop over all micrographs in the job directory
-for micrograph in tqdm(micrographs[0:]):
+# Sharded runs save their picks to the output directory for a later merge
+worker_name = sharding.worker_name(args)
+if args.merge and worker_name is not None:
+    raise Exception("Please run --merge once, without --shard or --work-queue.")
+if args.merge:
+    sharding.run_id(args)
+output_directory = parameters.get(
+    'output', 'directory', fallback=parameters.get('input', 'directory')
+)
+
+# Collect the picks of every micrograph, to build the final Dataset
+# in one go once all micrographs are done
+pick_accumulator = external_export.PickAccumulator()
+
+# Loop over all micrographs in the job directory,
+# or over this process's share of them
+if args.merge:
+    micrographs = []
+else:
+    micrographs = sharding.select_micrographs(micrographs, args)
+
+for micrograph in tqdm(micrographs):
 
     # Extract the micrograph UID
     uid = micrograph['uid']
@@ -60,7 +76,14 @@ for micrograph in tqdm(micrographs[0:]):
         continue
 
     # Read in the masks from that UID
-    masks = external_import.import_masks_from_disk(masks_filename)
+    masks = external_import.import_masks_from_disk(
+        masks_filename,
+        compact=True
+    )
+
+    # Micrographs without masks have no picks
+    if len(masks) == 0:
+        continue
 
     # Apply the erosion or dilation set in the parameters
     # and generate picks based on the masks.
@@ -92,27 +115,41 @@ for micrograph in tqdm(micrographs[0:]):
         mode=parameters.get('picking', 'mode')
     )
 
-    # Generate the picks dataset
-    pick_dataset = external_export.construct_csparc_dataset(
-        micrograph,
-        pick_indices
-    )
+    # Add the picks to those of the other micrographs
+    pick_accumulator.add(micrograph, pick_indices)
 
-    # Append it to the master dataset
-    vesicle_picks = vesicle_picks.append(pick_dataset)
+# Build the final Dataset of all picks
+vesicle_picks = pick_accumulator.dataset()
 
-# Push vesicle_picks to cryosparc
-# Initialize project and job
-project = cs.find_project(parameters.get('csparc_input', 'PID'))
-job = project.create_external_job(
-    parameters.get('csparc_input', 'WID'),
-    title="Vesicle Picks"
-)
+# Combine the picks saved by each shard of this run
+if args.merge:
+    vesicle_picks = Dataset.append_many(
+        vesicle_picks,
+        *[Dataset.load(shard_filename)
+          for shard_filename in sharding.run_files(
+              output_directory, 'vesicle_picks', args, '.cs'
+          )]
+    )
+
+# A shard saves its picks to disk, to be merged with the other shards
+if worker_name is not None:
+    os.makedirs(output_directory, exist_ok=True)
+    vesicle_picks.save(
+        os.path.join(output_directory, f"vesicle_picks_{worker_name}.cs")
+    )
+else:
+    # Push vesicle_picks to cryosparc
+    # Initialize project and job
+    project = cs.find_project(parameters.get('csparc_input', 'PID'))
+    job = project.create_external_job(
+        parameters.get('csparc_input', 'WID'),
+        title="Vesicle Picks"
+    )
 
-# Tell the job what kind of output to expect
-job.add_output("particle", "vesicle_picks", slots=["location"])
+    # Tell the job what kind of output to expect
+    job.add_output("particle", "vesicle_picks", slots=["location"])
 
-# Start the job, push the output to cryosparc, stop the job
-job.start()
-job.save_output("vesicle_picks", vesicle_picks)
-job.stop()
+    # Start the job, push the output to cryosparc, stop the job
+    job.start()
+    job.save_output("vesicle_picks", vesicle_picks)
+    job.stop()
@@ -0,0 +1,31 @@
+from vesicle_picker import (
+    generate_masks,
+    helpers,
+    embedding_cache,
+    segmentation_service
+)
+import argparse
+
+# Load the segment-anything model once and serve segmentation requests
+# from find_vesicles.py, other scripts and notebooks until shut down
+parser = argparse.ArgumentParser(
+    description='Run a resident segmentation service with a warm model.'
+)
+parser.add_argument(
+    'parameters',
+    type=str,
+    help='Path to .ini file with [segmentation] and [service] sections.'
+)
+args = parser.parse_args()
+parameters = helpers.read_config(args.parameters)
+
+# Initialize the model
+model = generate_masks.initialize_model(
+    **generate_masks.model_parameters(parameters)
+)
+cache = embedding_cache.cache_from_parameters(parameters)
+
+address, authkey = segmentation_service.service_address(parameters)
+print(f"Serving segmentation at {address}.")
+segmentation_service.SegmentationService(model, cache).serve(address, authkey)
+print("Segmentation service stopped.")
@@ -0,0 +1,131 @@
+from vesicle_picker import (
+    preprocess,
+    generate_masks,
+    postprocess,
+    helpers,
+    external_import,
+    external_export,
+    sources,
+    embedding_cache
+)
+from tqdm import tqdm
+import pandas as pd
+import argparse
+import os
+
+# Segment a subset of micrographs with several sets of segmentation
+# parameters, encoding each micrograph only once, to choose between them
+parser = argparse.ArgumentParser(
+    description='Compare segmentation parameters on a few micrographs.'
+)
+parser.add_argument(
+    'parameters',
+    type=str,
+    help='Path to .ini file containing the parameters for vesicle picking.'
+)
+parser.add_argument(
+    'configurations',
+    type=str,
+    help='Path to .ini file with one section per configuration, each '
+         'overriding options of the [segmentation] section.'
+)
+parser.add_argument(
+    '--micrographs',
+    type=int,
+    default=10,
+    help='Number of micrographs to segment, from the start of the job.'
+)
+parser.add_argument(
+    '--output',
+    type=str,
+    default=None,
+    help='Directory for the masks and summary. Defaults to sweep/ in the '
+         'output directory of the parameters file.'
+)
+args = parser.parse_args()
+parameters = helpers.read_config(args.parameters)
+configurations_file = helpers.read_config(args.configurations)
+output_directory = args.output or os.path.join(
+    parameters.get('output', 'directory'), 'sweep'
+)
+
+# Use the csparc_import module to initialize a cryosparc session
+cs = external_import.load_cryosparc(parameters.get('csparc_input', 'login'))
+project = cs.find_project(parameters.get('csparc_input', 'PID'))
+source = sources.micrograph_source(parameters, project)
+micrographs = external_import.micrographs_from_csparc(
+    cs=cs,
+    project_id=parameters.get('csparc_input', 'PID'),
+    job_id=parameters.get('csparc_input', 'JID'),
+    job_type=parameters.get('csparc_input', 'type')
+)
+
+# Read the shared parameters, and the options each configuration changes
+lowpass_mode, lowpass_kwargs = preprocess.lowpass_parameters(parameters)
+segmentation_kwargs = generate_masks.segmentation_parameters(parameters)
+configurations = {
+    name: generate_masks.segmentation_parameters(configurations_file, name)
+    for name in configurations_file.sections()
+}
+psize = parameters.getfloat('general', 'psize')
+downsample = parameters.getint('general', 'downsample')
+
+# Initialize the model
+model = generate_masks.initialize_model(
+    **generate_masks.model_parameters(parameters)
+)
+cache = embedding_cache.cache_from_parameters(parameters)
+
+rows = []
+for micrograph in tqdm(micrographs[:args.micrographs]):
+    uid = micrograph['uid']
+    preprocessed_micrograph = preprocess.preprocess_micrograph(
+        source.read(micrograph),
+        downsample=downsample,
+        lowpass_mode=lowpass_mode,
+        **lowpass_kwargs
+    )
+
+    # Encode once, then decode with every configuration
+    results = generate_masks.generate_mask_sweep(
+        preprocessed_micrograph,
+        model,
+        psize=psize,
+        downsample=downsample,
+        configurations=configurations,
+        embedding_cache=cache,
+        **segmentation_kwargs
+    )
+
+    # Save each configuration's masks side by side, measured as
+    # find_vesicles.py would, so they can be filtered and compared
+    for name, result in results.items():
+        masks = postprocess.measure_masks(result['masks'],
+                                          preprocessed_micrograph)
+        for mask in masks:
+            if 'average_radius' in mask:
+                mask['average_radius_A'] = (
+                    mask['average_radius'] * psize * downsample
+                )
+                mask['semi_minor_A'] = mask['semi_minor'] * psize * downsample
+                mask['semi_major_A'] = mask['semi_major'] * psize * downsample
+        os.makedirs(os.path.join(output_directory, name), exist_ok=True)
+        external_export.export_masks_to_disk(
+            masks,
+            os.path.join(output_directory, name, f"{uid}_vesicles.pkl"),
+            micrograph_uid=uid
+        )
+        rows.append({'uid': uid, 'configuration': name,
+                     'masks': result['count'], 'seconds': result['seconds'],
+                     'encoded': result['encoded']})
+
+# Summarize the masks found and time taken by each configuration
+summary = pd.DataFrame(rows)
+summary.to_csv(os.path.join(output_directory, 'sweep_summary.csv'),
+               index=False)
+print(summary.groupby('configuration', sort=False).agg(
+    micrographs=('uid', 'count'),
+    mean_masks=('masks', 'mean'),
+    seconds=('seconds', 'sum'),
+    encoded=('encoded', 'sum')
+))
@@ -0,0 +1,188 @@
+# Tune the segment-anything options that trade speed against memory
+# (points_per_batch, and optionally points_per_side and crop_n_layers)
+# on a few representative micrographs, choosing the fastest configuration
+# whose peak memory fits within a budget.
+
+from vesicle_picker import generate_masks
+from vesicle_picker.embedding_cache import MemoryEmbeddingCache
+import itertools
+import os
+import resource
+import sys
+import threading
+import time
+import torch
+
+# The [autotune] options listing candidate values of each tuned option
+TUNED_OPTIONS = ['points_per_batch', 'points_per_side', 'crop_n_layers']
+
+
+def autotune_parameters(parameters):
+
+    """
+    Read the [autotune] section of a parsed parameters file: the
+    memory_budget_gb (8 by default), the number of representative
+    micrographs (2 by default), and comma-separated candidate values of
+    each tuned option. Options without candidates keep the value in
+    [segmentation], except points_per_batch, which is tried at 16 to 256.
+    """
+
+    segmentation_kwargs = generate_masks.segmentation_parameters(parameters)
+    candidates = {}
+    for option in TUNED_OPTIONS:
+        if parameters.has_option('autotune', option):
+            candidates[option] = [
+                int(value)
+                for value in parameters.get('autotune', option).split(',')
+            ]
+        elif option == 'points_per_batch':
+            candidates[option] = [16, 32, 64, 128, 256]
+        elif option in segmentation_kwargs:
+            candidates[option] = [segmentation_kwargs[option]]
+
+    return {
+        'memory_budget': int(1e9 * parameters.getfloat(
+            'autotune', 'memory_budget_gb', fallback=8
+        )),
+        'micrographs': parameters.getint('autotune', 'micrographs',
+                                         fallback=2),
+        'candidates': candidates
+    }
+
+
+def _resident_bytes():
+
+    """Return the resident memory of this process in bytes."""
+
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class PeakMemory:
+
+    """
+    Measure the peak memory used within a with block: the peak CUDA
+    allocation on a CUDA device, otherwise the peak resident memory of
+    the process, sampled by a background thread. Where resident memory
+    cannot be sampled, the process's lifetime peak is used, which can
+    only overestimate.
+    """
+
+    def __init__(self, device='cpu', interval=0.005):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, _resident_bytes())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return self
+
+        self.stopped = threading.Event()
+        self.sampler = None
+        if os.path.exists('/proc/self/statm'):
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.device.type == 'cuda':
+            self.peak = torch.cuda.max_memory_allocated(self.device)
+            return
+
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+            self.peak = max(self.peak, _resident_bytes())
+        else:
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = maxrss if sys.platform == 'darwin' else 1024 * maxrss
+
+
+def tune_segmentation(preprocessed_micrographs, model, psize, downsample,
+                      candidates, memory_budget, **kwargs):
+
+    """
+    Segment representative micrographs with every combination of the
+    candidate values, and choose the combination with the lowest mean
+    latency whose peak memory fits within the budget. Each micrograph is
+    encoded once per set of crops, so the latencies compare the prompt
+    decoder, while the peak memory includes the image encoder.
+    Configurations are tried from the smallest values up, so memory the
+    allocator keeps after earlier trials does not inflate later ones.
+
+    Arguments:
+    preprocessed_micrographs (list): The representative micrographs.
+    model (PyTorch model): An initialized segment-anything model.
+    psize, downsample: As for generate_masks.generate_masks().
+    candidates (dict): Tuned option name to a list of values to try.
+    memory_budget (int): The peak memory allowed, in bytes.
+    **kwargs: The other mask generator options.
+
+    Outputs:
+    result (dict): The 'chosen' options, or None if no configuration fits
+    within the budget, with the 'memory_budget', and the 'latency'
+    (seconds per micrograph), 'peak_memory' (bytes) and 'masks' (mean
+    count) of each tried configuration under 'trials'.
+    """
+
+    names = list(candidates)
+    cache = MemoryEmbeddingCache()
+    encoder_peaks = {}
+    trials = []
+    for values in itertools.product(*(sorted(candidates[name])
+                                      for name in names)):
+        options = {**kwargs, **dict(zip(names, values))}
+        mask_generator = generate_masks.build_mask_generator(
+            model, 'crop', cache, **options
+        )
+
+        # Encode each set of crops once, first, so the timings below
+        # only cover decoding
+        crop_n_layers = mask_generator.crop_n_layers
+        if crop_n_layers not in encoder_peaks:
+            with PeakMemory(model.device) as encoder_memory:
+                for preprocessed_micrograph in preprocessed_micrographs:
+                    generate_masks.encode_images(
+                        model,
+                        generate_masks.crop_images(preprocessed_micrograph,
+                                                   mask_generator),
+                        cache
+                    )
+            encoder_peaks[crop_n_layers] = encoder_memory.peak
+
+        runtimes, counts = [], []
+        with PeakMemory(model.device) as decoder_memory:
+            for preprocessed_micrograph in preprocessed_micrographs:
+                start = time.perf_counter()
+                masks = generate_masks.generate_masks(
+                    preprocessed_micrograph, model, psize, downsample,
+                    output_mode='crop', mask_generator=mask_generator
+                )
+                runtimes.append(time.perf_counter() - start)
+                counts.append(len(masks))
+
+        trials.append({
+            'options': dict(zip(names, values)),
+            'latency': sum(runtimes) / len(runtimes),
+            'peak_memory': max(encoder_peaks[crop_n_layers],
+                               decoder_memory.peak),
+            'masks': sum(counts) / len(counts)
+        })
+
+    fitting = [trial for trial in trials
+               if trial['peak_memory'] <= memory_budget]
+    chosen = min(fitting, key=lambda trial: trial['latency'],
+                 default=None)
+    return {
+        'chosen': chosen['options'] if chosen is not None else None,
+        'memory_budget': memory_budget,
+        'trials': trials
+    }
+
@@ -0,0 +1,269 @@
+# A fast segmentation backend without segment-anything, for quick triage
+# and first-pass picks. Candidate vesicles are found by a Hough circle
+# transform or a blob detector, and each outline is refined by a closed
+# active contour in polar coordinates that snaps to the dark membrane.
+# The masks have the same schema as those of generate_masks.generate_masks().
+
+from vesicle_picker import helpers, prompts
+from cv2 import (
+    HoughCircles, normalize, remap, fillPoly, HOUGH_GRADIENT, NORM_MINMAX,
+    INTER_LINEAR, BORDER_REPLICATE
+)
+import numpy as np
+
+# The [classical] options read for the classical backend, with their types
+CLASSICAL_OPTIONS = {
+    'min_radius_A': float,
+    'max_radius_A': float,
+    'threshold': float,
+    'max_points': int,
+    'scales': int,
+    'rays': int,
+    'iterations': int,
+    'stiffness': float,
+    'min_contrast': float,
+    'nms_thresh': float,
+}
+CLASSICAL_METHODS = ['hough'] + prompts.PROMPT_METHODS
+
+
+def classical_parameters(parameters):
+
+    """
+    Read the blob detector and outline options of the classical backend
+    from the [classical] section of a parsed parameters file, as keyword
+    arguments for generate_masks_classical(). Options missing from the
+    section, or the whole section, take the defaults.
+    """
+
+    if not parameters.has_section('classical'):
+        return {}
+
+    kwargs = {
+        option: option_type(parameters.get('classical', option))
+        for option, option_type in CLASSICAL_OPTIONS.items()
+        if parameters.has_option('classical', option)
+    }
+    if parameters.has_option('classical', 'method'):
+        kwargs['method'] = parameters.get('classical', 'method')
+        if kwargs['method'] not in CLASSICAL_METHODS:
+            raise Exception(
+                "Please input a valid classical method "
+                f"({', '.join(CLASSICAL_METHODS)})."
+            )
+    return kwargs
+
+
+def detect_circles(preprocessed_micrograph, psize, downsample,
+                   min_radius_A=150, max_radius_A=600, threshold=30,
+                   max_points=512, edge_threshold=60):
+
+    """
+    Find circular vesicles in a preprocessed micrograph with a Hough
+    transform, which votes for circle centres along the gradients at
+    strong edges, such as membranes.
+
+    Arguments:
+    preprocessed_micrograph (np.ndarray): A 2D downsampled, blurred
+    micrograph from preprocess_micrograph().
+    psize (float): The pixel size of the original micrograph (Angstrom/pixel).
+    downsample (int): The downsampling factor applied in preprocessing.
+    min_radius_A, max_radius_A (float): The range of vesicle radii to
+    detect, in Angstrom.
+    threshold (float): The votes a circle centre needs.
+    max_points (int): The maximum number of circles, strongest first.
+    edge_threshold (float): The upper threshold of the Canny edge
+    detector, on the micrograph scaled to 0-255.
+
+    Outputs:
+    circles (np.ndarray): One row per circle, as for
+    prompts.detect_blobs(), of its (x, y) pixel coordinates, its radius
+    in pixels, and its rank.
+    """
+
+    image = normalize(np.asarray(preprocessed_micrograph, dtype=np.float32),
+                      None, 0, 255, NORM_MINMAX).astype(np.uint8)
+    pixel_size = psize * downsample
+    min_radius = max(int(min_radius_A / pixel_size), 1)
+    max_radius = max(int(np.ceil(max_radius_A / pixel_size)), min_radius)
+
+    circles = HoughCircles(image, HOUGH_GRADIENT, dp=1.5,
+                           minDist=min_radius, param1=edge_threshold,
+                           param2=threshold, minRadius=min_radius,
+                           maxRadius=max_radius)
+    if circles is None:
+        return np.zeros((0, 4))
+
+    # Circles come strongest first
+    circles = circles[0, :max_points, :3].astype(np.float64)
+    rank = np.arange(len(circles), 0, -1)[:, None]
+    return np.concatenate([circles, rank], axis=1)
+
+
+def refine_outlines(image, blobs, rays=64, iterations=4, stiffness=1.0):
+
+    """
+    Refine the circular outlines of blobs to the dark membranes around
+    them, all blobs at once. Along each of a number of rays from a blob's
+    centre, the outline moves to the darkest point within 40% of the
+    blob's radius, traded off against staying close to the smoothed
+    outline of the previous iteration, like a closed snake.
+
+    Arguments:
+    image (np.ndarray): The 2D preprocessed micrograph.
+    blobs (np.ndarray): Rows of (x, y, radius, ...) from detect_blobs().
+    rays (int): The number of rays, i.e. vertices of each outline.
+    iterations (int): The number of refinement iterations.
+    stiffness (float): How strongly the outline resists bending.
+
+    Outputs:
+    radii (np.ndarray): The radius of each outline along each ray, of
+    shape (blobs, rays).
+    contrast (np.ndarray): How much darker each outline is than the
+    mean of its search band, in standard deviations of the band.
+    """
+
+    image = np.asarray(image, dtype=np.float32)
+    angles = np.linspace(0, 2 * np.pi, rays, endpoint=False)
+    steps = np.linspace(0.6, 1.4, 33)
+
+    # Sample the image along every ray of every blob: (blobs, rays, steps)
+    x, y, radius = (blobs[:, index, None, None] for index in range(3))
+    search = radius * steps[None, None, :]
+    map_x = (x + search * np.cos(angles)[None, :, None]).astype(np.float32)
+    map_y = (y + search * np.sin(angles)[None, :, None]).astype(np.float32)
+    profiles = remap(image, map_x.reshape(len(blobs), -1),
+                     map_y.reshape(len(blobs), -1), INTER_LINEAR,
+                     borderMode=BORDER_REPLICATE).reshape(map_x.shape)
+
+    # Normalize each blob's profiles, so stiffness means the same for all
+    mean = profiles.mean(axis=(1, 2), keepdims=True)
+    std = profiles.std(axis=(1, 2), keepdims=True) + 1e-6
+    profiles = (profiles - mean) / std
+
+    radii = np.broadcast_to(radius[:, :, 0], (len(blobs), rays)).copy()
+    for _ in range(max(iterations, 1)):
+
+        # Smooth the outline along its rays, wrapping around
+        smoothed = (np.roll(radii, 1, axis=1) + 2 * radii
+                    + np.roll(radii, -1, axis=1)) / 4
+        energy = profiles + stiffness * np.square(
+            (search - smoothed[:, :, None]) / (0.4 * search[:, :, -1:])
+        )
+        best = energy.argmin(axis=2)
+        radii = np.take_along_axis(search, best[:, :, None], axis=2)[:, :, 0]
+
+    contrast = -np.take_along_axis(profiles, best[:, :, None],
+                                   axis=2)[:, :, 0].mean(axis=1)
+    return radii, contrast
+
+
+def generate_masks_classical(preprocessed_micrograph, psize, downsample,
+                             output_mode='binary_mask', method='hough',
+                             rays=64, iterations=4, stiffness=1.0,
+                             min_contrast=0.5, nms_thresh=0.3, **kwargs):
+
+    """
+    Segment the vesicles of a micrograph with a circle or blob detector
+    and active contours instead of segment-anything. Much faster,
+    especially on the CPU, but less accurate on crowded or irregular
+    vesicles.
+
+    Arguments:
+    preprocessed_micrograph (np.ndarray): A 2D numpy array of a downsampled,
+    blurred micrograph.
+    psize (float): The pixel size of the original micrograph (Angstrom/pixel).
+    downsample (int): The downsampling factor applied in preprocessing.
+    output_mode (str): "crop" to return compact masks, or "binary_mask"
+    for full-frame segmentations, as for generate_masks().
+    method (str): The detector of candidate vesicles, "hough" for
+    detect_circles(), or "log" or "dog" for prompts.detect_blobs().
+    rays, iterations, stiffness: As for refine_outlines().
+    min_contrast (float): The minimum contrast of a kept outline.
+    nms_thresh (float): The intersection over union with a stronger
+    detection above which an outline is dropped as a duplicate.
+    **kwargs: Keyword arguments for the detector, such as the range of
+    vesicle radii.
+
+    Outputs:
+    masks (list): A list of dictionaries, each dictionary representing a
+    detected mask in preprocessed_micrograph, with the keys of masks from
+    generate_masks() ('segmentation' or its crop, 'area', 'area_asq',
+    'bbox', 'point_coords' and 'crop_box'), plus the detector's
+    'detection_score' and the outline's 'contrast'.
+    """
+
+    if output_mode not in ('crop', 'binary_mask'):
+        raise Exception(
+            "Please input a valid output mode (crop, binary_mask)."
+        )
+
+    image = np.asarray(preprocessed_micrograph, dtype=np.float32)
+    h_img, w_img = image.shape
+    if method == 'hough':
+        kwargs.pop('scales', None)
+        blobs = detect_circles(image, psize, downsample, **kwargs)
+    else:
+        blobs = prompts.detect_blobs(image, psize, downsample, method,
+                                     **kwargs)
+    if len(blobs) == 0:
+        return []
+    radii, contrast = refine_outlines(image, blobs, rays, iterations,
+                                      stiffness)
+
+    angles = np.linspace(0, 2 * np.pi, rays, endpoint=False)
+    masks = []
+    for blob, blob_radii, blob_contrast in zip(blobs, radii, contrast):
+        if blob_contrast < min_contrast:
+            continue
+
+        # Rasterize the outline within its rectangle, clipped to the image
+        outline = np.stack([blob[0] + blob_radii * np.cos(angles),
+                            blob[1] + blob_radii * np.sin(angles)], axis=1)
+        x0, y0 = np.maximum(np.floor(outline.min(axis=0)), 0).astype(int)
+        x1 = min(int(np.ceil(outline[:, 0].max())) + 1, w_img)
+        y1 = min(int(np.ceil(outline[:, 1].max())) + 1, h_img)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        crop = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        fillPoly(crop, [np.round(outline - [x0, y0] - 0.5).astype(np.int32)],
+                 1)
+        crop = crop.astype(bool)
+
+        # Trim the rectangle to the rasterized outline
+        bx, by, bw, bh = helpers.bounding_box(crop)
+        if bw == 0:
+            continue
+        mask = {
+            'mask_box': [int(x0 + bx), int(y0 + by), bw, bh],
+            'image_shape': (h_img, w_img),
+            'segmentation_crop': crop[by:by+bh, bx:bx+bw],
+            'area': int(crop.sum()),
+            'bbox': [int(x0 + bx), int(y0 + by), bw, bh],
+            'point_coords': [[float(blob[0]), float(blob[1])]],
+            'crop_box': [0, 0, w_img, h_img],
+            'detection_score': float(blob[3]),
+            'contrast': float(blob_contrast),
+        }
+
+        # Weaker detections of a vesicle already found are dropped
+        if any(mask_iou(mask, kept) > nms_thresh for kept in masks):
+            continue
+        masks.append(mask)
+
+    if output_mode == 'binary_mask':
+        masks = [helpers.full_mask(mask) for mask in masks]
+
+    # Modify the area of each mask to be in Angstrom squared
+    for mask in masks:
+        mask['area_asq'] = mask['area']*(downsample**2)*(psize**2)
+
+    return masks
+
+
+def mask_iou(mask, other):
+
+    """Compute the intersection over union of two compact masks."""
+
+    intersection = helpers.mask_intersection(mask, other)
+    return intersection / (mask['area'] + other['area'] - intersection)
@@ -0,0 +1,270 @@
+# Caches of segment-anything image embeddings, on disk or in memory, so
+# that re-segmenting a micrograph with new prompt or threshold parameters
+# only runs the prompt decoder, not the image encoder.
+
+from segment_anything import SamPredictor
+from vesicle_picker import manifest
+import numpy as np
+import hashlib
+import os
+import threading
+import torch
+
+
+def model_key(model_weights_path, model_type, precision='fp32'):
+
+    """
+    Identify a model by its type, precision, and the name, size and
+    modification time of its weights file, so embeddings from other
+    weights or precisions never match.
+    """
+
+    stat = os.stat(model_weights_path)
+    identity = [model_type, os.path.basename(model_weights_path),
+                stat.st_size, stat.st_mtime_ns]
+    if precision != 'fp32':
+        identity.append(precision)
+    return manifest.fingerprint(identity)
+
+
+def cache_from_parameters(parameters):
+
+    """
+    Build the EmbeddingCache described by the [segmentation] section of a
+    parsed parameters file (embedding_cache, the directory, and
+    embedding_cache_size_gb, 20 by default), or None if there is none.
+    """
+
+    if not parameters.has_option('segmentation', 'embedding_cache'):
+        return None
+    return EmbeddingCache(
+        parameters.get('segmentation', 'embedding_cache'),
+        max_bytes=int(1e9 * parameters.getfloat(
+            'segmentation', 'embedding_cache_size_gb', fallback=20
+        )),
+        model_key=model_key(
+            parameters.get('segmentation', 'model_weights_path'),
+            parameters.get('segmentation', 'model_type'),
+            parameters.get('segmentation', 'precision', fallback='fp32')
+        )
+    )
+
+
+def image_key(image, model_key=''):
+
+    """Hash an image given to the encoder, together with the model."""
+
+    digest = hashlib.sha256(model_key.encode())
+    digest.update(str(image.shape).encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+
+    """
+    A directory of image embeddings, one .npz file per image, bounded in
+    size by evicting the least recently used embeddings. Embeddings are
+    keyed by a hash of the exact image given to the encoder, which
+    depends on the micrograph, its preprocessing and the crop, together
+    with the model. Several processes can share a cache directory.
+    """
+
+    def __init__(self, directory, max_bytes, model_key=''):
+
+        """
+        Arguments:
+        directory (str): The directory holding the cache.
+        max_bytes (int): The size above which old embeddings are evicted.
+        model_key (str): Identifies the model, as given by model_key().
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.model_key = model_key
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+
+        """List the (last use, path, size) of every cached embedding."""
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def key(self, image):
+
+        """Return the cache key of an image given to the encoder."""
+
+        return image_key(image, self.model_key)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+
+        """
+        Return the cached embedding under key as a dictionary with the
+        'features', 'original_size' and 'input_size' of the image, or
+        None if there is none. Marks the embedding as recently used.
+        """
+
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                embedding = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (FileNotFoundError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return embedding
+
+    def put(self, key, features, original_size, input_size):
+
+        """Cache an embedding, then evict old ones if over the size bound."""
+
+        path = self._path(key)
+
+        # Write to a temporary file first, so readers in other
+        # processes never see a half-written embedding
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as file:
+            np.savez(file, features=features,
+                     original_size=np.asarray(original_size),
+                     input_size=np.asarray(input_size))
+        os.replace(temporary, path)
+
+        with self.lock:
+            self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+
+        """Delete the least recently used embeddings until within bounds."""
+
+        entries = sorted(self._entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def summary(self):
+
+        """Summarize the cache's hits, misses and size."""
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+class MemoryEmbeddingCache:
+
+    """
+    Embeddings kept in memory, for segmenting the same micrograph several
+    times in a row, optionally in front of an EmbeddingCache on disk.
+    Has the same interface as EmbeddingCache.
+    """
+
+    def __init__(self, backing=None):
+
+        """
+        Arguments:
+        backing (EmbeddingCache): A cache on disk to read embeddings
+        missing from memory from, and to add new embeddings to, or None.
+        """
+
+        self.backing = backing
+        self.embeddings = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image):
+        return image_key(image, self.backing.model_key
+                         if self.backing is not None else '')
+
+    def get(self, key):
+        embedding = self.embeddings.get(key)
+        if embedding is None and self.backing is not None:
+            embedding = self.backing.get(key)
+            if embedding is not None:
+                self.embeddings[key] = embedding
+        if embedding is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return embedding
+
+    def put(self, key, features, original_size, input_size):
+        self.embeddings[key] = {
+            'features': features,
+            'original_size': np.asarray(original_size),
+            'input_size': np.asarray(input_size)
+        }
+        if self.backing is not None:
+            self.backing.put(key, features, original_size, input_size)
+
+    def clear(self):
+
+        """Drop the embeddings held in memory, keeping those on disk."""
+
+        self.embeddings = {}
+
+
+class CachingSamPredictor(SamPredictor):
+
+    """
+    A SamPredictor that reads image embeddings from an EmbeddingCache
+    when it can, and caches the embeddings it computes.
+    """
+
+    def __init__(self, sam_model, cache):
+
+        """
+        Arguments:
+        sam_model (Sam): The model to use for mask prediction.
+        cache (EmbeddingCache): The cache of embeddings.
+        """
+
+        super().__init__(sam_model)
+        self.cache = cache
+
+    def set_image(self, image, image_format="RGB"):
+
+        """Set the image to segment, as SamPredictor.set_image()."""
+
+        key = self.cache.key(image)
+        embedding = self.cache.get(key)
+
+        if embedding is None:
+            super().set_image(image, image_format)
+            self.cache.put(key, self.features.cpu().numpy(),
+                           self.original_size, self.input_size)
+            return
+
+        self.reset_image()
+        self.original_size = tuple(int(size) for size in
+                                   embedding['original_size'])
+        self.input_size = tuple(int(size) for size in embedding['input_size'])
+        self.features = torch.from_numpy(embedding['features']).to(
+            self.device
+        )
+        self.is_image_set = True
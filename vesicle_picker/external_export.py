@@ -1,18 +1,118 @@
 from cryosparc.dataset import Dataset
 import numpy as np
-import primefac
-import itertools
 from vesicle_picker import helpers
 import pickle
 
 
+# The fields and dtypes of a dataset of particle picks
+PICK_FIELDS = [
+    ('location/micrograph_uid', '<u8'),
+    ('location/exp_group_id', '<u4'),
+    ('location/micrograph_path', 'str'),
+    ('location/micrograph_shape', '<u4'),
+    ('location/center_x_frac', '<f4'),
+    ('location/center_y_frac', '<f4'),
+    ('location/micrograph_psize_A', '<f4')
+]
+
+
+class PickAccumulator:
+
+    """
+    Collects the picks of many micrographs and builds a single cryosparc
+    Dataset of them at the end. Appending each micrograph's Dataset to a
+    growing Dataset copies every earlier pick each time, which is
+    quadratic in the number of micrographs; here each micrograph only
+    adds its pick coordinates as one chunk, and its own fields once, and
+    every column is built with a single concatenation or repeat.
+    """
+
+    def __init__(self):
+        self.y_chunks = []
+        self.x_chunks = []
+        self.counts = []
+        self.uids = []
+        self.exposure_groups = []
+        self.paths = []
+        self.shapes = []
+        self.psizes = []
+
+    def __len__(self):
+
+        """Return the number of picks collected so far."""
+
+        return sum(self.counts)
+
+    def add(self, micrograph, pick_indices):
+
+        """
+        Add the picks of a micrograph.
+
+        Arguments:
+        micrograph (cryosparc Micrograph object): A single micrograph and
+        associated parameters as a cryosparc object.
+        pick_indices (list): A list of numpy arrays containing the 0th axis
+        and 1st axis indices of particle pick locations, respectively,
+        upsampled to map back onto the full-resolution micrograph.
+        """
+
+        # Extract micrograph information, reading the row only once
+        micrograph_fields = micrograph.to_list()
+        self.uids.append(micrograph_fields[0])
+        self.paths.append(micrograph_fields[1])
+        self.exposure_groups.append(micrograph_fields[2])
+        self.shapes.append(micrograph['micrograph_blob/shape'][:2])
+        self.psizes.append(micrograph_fields[4])
+
+        self.y_chunks.append(np.asarray(pick_indices[0]))
+        self.x_chunks.append(np.asarray(pick_indices[1]))
+        self.counts.append(len(pick_indices[0]))
+
+    def dataset(self):
+
+        """
+        Build the Dataset of all the picks collected.
+
+        Outputs:
+        pick_dataset (cryosparc Dataset object): A cryosparc Dataset
+        containing pick locations for further manipulation in cryosparc,
+        one row per pick, in the order the micrographs were added.
+        """
+
+        counts = np.array(self.counts, dtype=np.int64)
+        shapes = np.array(self.shapes, dtype=np.uint32).reshape(-1, 2)
+        pick_shapes = np.repeat(shapes, counts, axis=0)
+
+        # Concatenate the pick coordinates of all micrographs at once
+        pick_y = np.concatenate(self.y_chunks or [np.zeros(0)])
+        pick_x = np.concatenate(self.x_chunks or [np.zeros(0)])
+
+        columns = {
+            'location/micrograph_uid': np.repeat(
+                np.array(self.uids, dtype=np.dtype('<u8')), counts),
+            'location/exp_group_id': np.repeat(
+                np.array(self.exposure_groups, dtype=np.dtype('<u4')), counts),
+            'location/micrograph_path': np.repeat(
+                np.array(self.paths, dtype=object), counts),
+            'location/micrograph_shape': pick_shapes,
+            'location/center_x_frac': (
+                pick_x / pick_shapes[:, 1]).astype(np.dtype('<f4')),
+            'location/center_y_frac': (
+                pick_y / pick_shapes[:, 0]).astype(np.dtype('<f4')),
+            'location/micrograph_psize_A': np.repeat(
+                np.array(self.psizes, dtype=np.dtype('<f4')), counts)
+        }
+        return Dataset([(field, columns[field]) for field, _ in PICK_FIELDS])
+
+
 def construct_csparc_dataset(micrograph, pick_indices):
 
     """
     Takes a micrograph and its pick indices found by segmentation and
     postprocessing, and returns a cryosparc-compatible dataset of
     particle pick locations for combination with other micrographs'
-    datasets or direct export to cryosparc.
+    datasets or direct export to cryosparc. To combine the picks of many
+    micrographs, add them to a PickAccumulator instead.
 
     Arguments:
     micrographs (cryosparc Micrograph object): A single micrograph and
@@ -26,38 +126,9 @@ def construct_csparc_dataset(micrograph, pick_indices):
     containing pick locations for further manipulation in cryosparc.
     """
 
-    # Define the number of picks explicitly
-    n_picks = len(pick_indices[0])
-
-    # Extract micrograph information
-    micrograph_uid = micrograph.to_list()[0]
-    micrograph_path = micrograph.to_list()[1]
-    micrograph_exposure_group = micrograph.to_list()[2]
-    micrograph_shape = micrograph['micrograph_blob/shape']
-    micrograph_psize = micrograph.to_list()[4]
-
-    # Initialize a Dataset to hold these particle picks
-    pick_dataset = Dataset([
-        ('location/micrograph_uid',
-         np.repeat(micrograph_uid, n_picks).astype(np.dtype('<u8'))),
-        ('location/exp_group_id',
-         np.repeat(micrograph_exposure_group,
-                   n_picks).astype(np.dtype('<u4'))),
-        ('location/micrograph_path',
-         [micrograph_path] * n_picks),
-        ('location/micrograph_shape',
-         [[np.uint32(micrograph_shape[0]),
-           np.uint32(micrograph_shape[1])]] * n_picks),
-        ('location/center_y_frac',
-         pick_indices[0].astype(np.dtype('<f4'))/micrograph_shape[0]),
-        ('location/center_x_frac',
-         pick_indices[1].astype(np.dtype('<f4'))/micrograph_shape[1]),
-        ('location/micrograph_psize_A',
-         np.repeat(micrograph_psize, n_picks).astype(np.dtype('<f4')))
-    ])
-
-    # Return the dataset of picks
-    return pick_dataset
+    pick_accumulator = PickAccumulator()
+    pick_accumulator.add(micrograph, pick_indices)
+    return pick_accumulator.dataset()
 
 
 def export_to_csparc(cs, pick_dataset, project_id, workspace_id):
@@ -87,57 +158,101 @@ def export_to_csparc(cs, pick_dataset, project_id, workspace_id):
     job.stop()
 
 
+def encode_mask(segmentation):
+
+    """
+    Takes a single boolean segmentation array and bit-packs
+    the smallest rectangle that contains all of its nonzero pixels.
+
+    Arguments:
+    segmentation (np.ndarray): A 2D boolean array, such as the
+    'segmentation' key of a mask generated by generate_masks().
+
+    Outputs:
+    packed_segmentation (np.ndarray): A 1D uint8 array holding the
+    bit-packed pixels of the cropped rectangle in row-major order.
+    mask_box (list): The cropped rectangle as [x0, y0, width, height],
+    in the same XYWH convention as the 'bbox' key of segment-anything masks.
+    """
+
+    # Find the rectangle that contains the mask
+    x0, y0, w, h = helpers.bounding_box(segmentation)
+
+    # Pack eight pixels of the cropped mask into each byte
+    packed_segmentation = np.packbits(
+        segmentation[y0:y0+h, x0:x0+w], axis=None
+    )
+
+    return packed_segmentation, [x0, y0, w, h]
+
+
 def export_masks_to_disk(masks, filename, micrograph_uid=None,
-                         compression='uint16'):
+                         fingerprint=None):
 
     """
     Takes (postprocessed and filtered) masks from the generate_masks module
-    and saves them to disk in a space-efficient format
-    using a prime number encoding algorithm.
+    and saves them to disk in a space-efficient format. Each mask is cropped
+    to the rectangle that contains it and bit-packed on its own with
+    encode_mask(), so encoding is linear in the number of pixels, any
+    number of overlapping masks is stored exactly, and any single mask
+    can be decoded without touching the others.
 
     Arguments:
     masks (list): Masks found by segmentation of a micrograph with
-    generate_masks() or filtered masks generated by apply_filters().
+    generate_masks() or filtered masks generated by apply_filters(),
+    either full-frame or compact.
     filename (str): The desired filename of the exported masks on disk.
-    compression (str): The data type of the saved composite mask.
-    uint16 lets you safely compress about 250 masks,
-    and uint32 lets you safely compress about 65,000 masks.
+    micrograph_uid (int): The cryosparc UID of the micrograph the
+    masks were found in.
+    fingerprint (dict): A fingerprint of the input and parameters that
+    produced the masks, as compared by manifest.stale_parts(). It is
+    also written in a header before the masks, which
+    external_import.load_masks_header() reads on its own.
     """
 
-    primes = itertools.islice(primefac.primegen(), len(masks))
-    primes = [prime for prime in primes]
-
-    # Multiply each mask by its prime key
-    for mask, prime in zip(masks, primes):
-        mask['prime_key'] = prime
-        mask['prime_segmentation'] = (
-            np.ones_like(mask['segmentation']).astype(int)
-        )
-        mask['prime_segmentation'][mask['segmentation']] = prime
-
-    # Generate the composite mask to be stored
-    composite_mask = (
-        helpers.multiply_masks(masks, 'prime_segmentation')
-        .astype(compression)
-    )
-
-    # Delete the segmentation key from each mask to be written out,
+    # Drop the segmentation key from each mask to be written out,
     # as well as derivatives of the segmentation key.
-
     keys_to_delete = ['segmentation',
-                      'prime_segmentation',
+                      'segmentation_crop',
                       'edge',
-                      'contours']
+                      'edge_crop',
+                      'contours',
+                      'mask_box',
+                      'image_shape']
 
+    masks_to_export = []
     for mask in masks:
-        for key in keys_to_delete:
-            mask.pop(key, None)
+        mask_to_export = {
+            key: value for key, value in mask.items()
+            if key not in keys_to_delete
+        }
+
+        # Store the segmentation as a bit-packed crop
+        crop, x0, y0 = helpers.mask_crop(mask)
+        packed_segmentation, mask_box = encode_mask(crop)
+        mask_box[0] += x0
+        mask_box[1] += y0
+        mask_to_export['packed_segmentation'] = packed_segmentation
+        mask_to_export['mask_box'] = mask_box
+
+        masks_to_export.append(mask_to_export)
+
+    # Record the full-frame shape so masks can be decoded later
+    shape = helpers.image_shape(masks[0]) if len(masks) > 0 else None
 
     # Generate the export list
-    masks_export = {'masks': masks,
-                    'composite_mask': composite_mask,
-                    'uid': micrograph_uid}
+    masks_export = {'masks': masks_to_export,
+                    'shape': shape,
+                    'encoding': 'packed_crop',
+                    'uid': micrograph_uid,
+                    'fingerprint': fingerprint}
 
-    # Save the masks as a pickle object
+    # Save the masks as a pickle object, after a small header pickle that
+    # can be read without loading the masks
+    header = {key: value for key, value in masks_export.items()
+              if key != 'masks'}
+    header['header'] = True
+    header['n_masks'] = len(masks_to_export)
     with open(filename, 'wb') as file:
+        pickle.dump(header, file)
         pickle.dump(masks_export, file)
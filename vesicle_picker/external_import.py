@@ -1,5 +1,6 @@
 from cryosparc.tools import CryoSPARC
-from vesicle_picker.helpers import read_config
+from vesicle_picker.helpers import read_config, compact_mask
+import numpy as np
 import pickle
 
 # Functions to take a cryosparc initialization, test the connection,
@@ -73,28 +74,185 @@ def micrographs_from_csparc(cs, project_id, job_id, job_type):
     return micrographs
 
 
-def import_masks_from_disk(filename):
+def decode_mask(mask, shape=None):
+
+    """
+    Decode the segmentation of a single mask stored by
+    export_masks_to_disk(), without touching any other mask in the file.
+
+    Arguments:
+    mask (dictionary): A single exported mask, carrying the
+    'packed_segmentation' and 'mask_box' keys written by encode_mask().
+    shape (tuple): The full-frame shape of the micrograph the mask was
+    found in, as stored under the 'shape' key of the exported file.
+    If None, only the crop within 'mask_box' is returned.
+
+    Outputs:
+    segmentation (np.ndarray): A full-frame 2D boolean array of the mask,
+    or the cropped array if shape is None.
+    """
+
+    x0, y0, w, h = mask['mask_box']
+
+    # Unpack only as many bits as the cropped rectangle holds
+    crop = np.unpackbits(
+        mask['packed_segmentation'], count=w*h
+    ).reshape(h, w).view(bool)
+
+    if shape is None:
+        return crop
+
+    # Place the crop back into a full-frame array
+    segmentation = np.zeros(shape, dtype=bool)
+    segmentation[y0:y0+h, x0:x0+w] = crop
+
+    return segmentation
+
+
+def load_masks_file(filename):
+
+    """
+    Read a pickle object written by export_masks_to_disk() without
+    decoding any of the masks it contains.
+
+    Arguments:
+    filename (str): The filename of the compressed masks on disk.
+
+    Outputs:
+    masks_file (dictionary): The exported masks, full-frame shape,
+    encoding and micrograph UID, as stored on disk.
+    """
+
+    with open(filename, 'rb') as file:
+        masks_file = pickle.load(file)
+
+        # Skip the header of files that have one
+        if masks_file.get('header', False):
+            masks_file = pickle.load(file)
+
+    # Files written before the packed encoding store a single composite
+    # mask, made of the product of one prime number per mask.
+    masks_file.setdefault('encoding', 'prime_product')
+
+    return masks_file
+
+
+def load_masks_header(filename):
+
+    """
+    Read the header of a pickle object written by export_masks_to_disk(),
+    without loading its masks. Files written before headers were added
+    are read whole.
+
+    Arguments:
+    filename (str): The filename of the compressed masks on disk.
+
+    Outputs:
+    header (dictionary): The full-frame 'shape', 'encoding', micrograph
+    'uid', 'fingerprint' (None if not recorded) and number of masks
+    ('n_masks') of the file.
+    """
+
+    with open(filename, 'rb') as file:
+        header = pickle.load(file)
+    if not header.get('header', False):
+        header = {key: value for key, value in header.items()
+                  if key not in ('masks', 'composite_mask')} | {
+                      'n_masks': len(header['masks'])}
+    header.setdefault('encoding', 'prime_product')
+    header.setdefault('fingerprint', None)
+    return header
+
+
+def import_mask_from_disk(filename, index, compact=False):
+
+    """
+    Import a single mask from a pickle object written by
+    export_masks_to_disk(), decoding only that mask. The file is a
+    single pickle, so it is still read and unpickled whole, packed
+    segmentations of the other masks included; only the unpacking of
+    the other masks is saved.
+
+    Arguments:
+    filename (str): The filename of the compressed masks on disk.
+    index (int): The position of the mask within the file.
+    compact (bool): Whether to return a compact mask, holding the
+    segmentation cropped to its rectangle, instead of a full-frame one.
+
+    Outputs:
+    mask (dictionary): The uncompressed mask with the 'segmentation' key
+    (or 'segmentation_crop', if compact) repopulated and prepared
+    for downstream analysis.
+    """
+
+    masks_file = load_masks_file(filename)
+    return _decode_masks(
+        masks_file, [masks_file['masks'][index]], compact
+    )[0]
+
+
+def import_masks_from_disk(filename, compact=False):
 
     """
     Import a pickle object containing masks compressed
-    by export_masks_to_disk().
+    by export_masks_to_disk(). Files written with the older
+    prime-product encoding are decoded as well.
 
     Arguments:
     filename (str): The filename of the compressed masks on disk.
+    compact (bool): Whether to return compact masks, holding each
+    segmentation cropped to its rectangle, instead of full-frame ones.
 
     Outputs:
     masks (list): The uncompressed masks with the 'segmentation' key
-    repopulated and prepared for downstream analysis.
+    (or 'segmentation_crop', if compact) repopulated and prepared
+    for downstream analysis.
     """
 
-    # Read in the exported masks from disk
-    with open(filename, 'rb') as file:
-        # Read the pickle file
-        loaded_masks_pickle = pickle.load(file)
+    return decode_masks_file(load_masks_file(filename), compact)
+
+
+def decode_masks_file(masks_file, compact=False):
+
+    """
+    Decode all masks of a file already read with load_masks_file().
+
+    Arguments:
+    masks_file (dictionary): The exported masks, as read from disk.
+    compact (bool): Whether to return compact masks, holding each
+    segmentation cropped to its rectangle, instead of full-frame ones.
+
+    Outputs:
+    masks (list): The uncompressed masks, as from import_masks_from_disk().
+    """
+
+    return _decode_masks(masks_file, masks_file['masks'], compact)
+
+
+def _decode_masks(masks_file, masks, compact):
+
+    """Repopulate the segmentation of masks from a loaded file."""
 
     # Regenerate the segmentation arrays
-    for mask in loaded_masks_pickle['masks']:
-        mask['segmentation'] = (
-            loaded_masks_pickle['composite_mask'] % mask['prime_key'] == 0
+    if masks_file['encoding'] == 'prime_product':
+        for mask in masks:
+            mask['segmentation'] = (
+                masks_file['composite_mask'] % mask.pop('prime_key') == 0
+            )
+        if compact:
+            masks = [compact_mask(mask) for mask in masks]
+    elif masks_file['encoding'] == 'packed_crop':
+        for mask in masks:
+            if compact:
+                mask['segmentation_crop'] = decode_mask(mask)
+                mask['image_shape'] = masks_file['shape']
+            else:
+                mask['segmentation'] = decode_mask(mask, masks_file['shape'])
+                mask.pop('mask_box')
+            mask.pop('packed_segmentation')
+    else:
+        raise Exception(
+            f"Unknown mask encoding {masks_file['encoding']} in file."
         )
-    return loaded_masks_pickle['masks']
+
+    return masks
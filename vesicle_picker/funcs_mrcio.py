@@ -11,6 +11,320 @@ import numpy as n
 # lin = line
 # hdr = header
 
+# The data type of each MRC mode. Mode 3 (complex int16) pixels are pairs
+# of int16 (real, imaginary), and mode 101 packs two 4-bit pixels per byte.
+MODES = {
+    0: n.int8,
+    1: n.int16,
+    2: n.float32,
+    3: n.dtype((n.int16, 2)),
+    4: n.complex64,
+    6: n.uint16,
+    12: n.float16,
+    101: n.uint8,
+}
+
+
+def _mode_dtype(hdr):
+
+    """Return the data type of the pixels of an MRC file, given its header."""
+
+    if hdr['datatype'] not in MODES:
+        raise Exception(
+            f"Please input an MRC file with a valid mode "
+            f"({', '.join(str(mode) for mode in MODES)}), "
+            f"not {hdr['datatype']}."
+        )
+    dtype = n.dtype(MODES[hdr['datatype']])
+    if dtype.subdtype is not None:
+        base, shape = dtype.subdtype
+        return n.dtype((base.newbyteorder(hdr['byteorder']), shape))
+    return dtype.newbyteorder(hdr['byteorder'])
+
+
+def _row_bytes(hdr):
+
+    """Return the number of bytes in one row of an MRC section."""
+
+    if hdr['datatype'] == 101:
+        return (hdr['nx'] + 1) // 2
+    return hdr['nx'] * _mode_dtype(hdr).itemsize
+
+
+def _unpack_4bit(packed, nx):
+
+    """
+    Unpack mode 101 data, two 4-bit pixels per byte with the first pixel
+    in the low bits and each row padded to a whole byte, into uint8 pixels.
+    """
+
+    pixels = n.empty(packed.shape[:-1] + (2 * packed.shape[-1],), n.uint8)
+    pixels[..., 0::2] = packed & 0x0F
+    pixels[..., 1::2] = packed >> 4
+    return pixels[..., :nx]
+
+
+def _pack_4bit(pixels):
+
+    """Pack uint8 pixels below 16 into mode 101 data, the inverse of
+    _unpack_4bit()."""
+
+    pixels = n.asarray(pixels, dtype=n.uint8)
+    if pixels.shape[-1] % 2:
+        pixels = n.concatenate(
+            [pixels, n.zeros(pixels.shape[:-1] + (1,), n.uint8)], axis=-1
+        )
+    return (pixels[..., 0::2] & 0x0F) | (pixels[..., 1::2] << 4)
+
+
+def _decode_sections(data, hdr):
+
+    """Interpret raw bytes read from an MRC file as (z, y, x) pixels."""
+
+    nz = data.size // (_row_bytes(hdr)*hdr['ny'])
+    if hdr['datatype'] == 101:
+        return _unpack_4bit(data.reshape(nz, hdr['ny'], -1), hdr['nx'])
+    return data.view(_mode_dtype(hdr)).reshape(
+        (nz, hdr['ny'], hdr['nx']) + _mode_dtype(hdr).shape
+    )
+
+
+def _parse_header(raw):
+
+    """
+    Parse the 1024-byte main header of an MRC file into a dictionary,
+    detecting its byte order from the machine stamp.
+    """
+
+    raw = bytes(raw)
+    if len(raw) < 1024:
+        raise Exception("Please input a valid MRC file (header too short).")
+
+    # The machine stamp starts with 0x11 for big-endian files. Older files
+    # may lack one, in which case the byte order giving a valid mode wins.
+    byteorder = '>' if raw[212] == 0x11 else '<'
+    if raw[212] not in (0x11, 0x44):
+        mode = n.frombuffer(raw, dtype='<i4', count=4)[3]
+        byteorder = '<' if mode in MODES else '>'
+
+    header = n.frombuffer(raw, dtype=byteorder + 'i4', count=256)
+    header_f = header.view(byteorder + 'f4')
+
+    hdr = {}
+    [hdr['nx'], hdr['ny'], hdr['nz'], hdr['datatype']] = \
+        (int(value) for value in header[:4])
+    [hdr['mx'], hdr['my'], hdr['mz']] = (int(value) for value in header[7:10])
+    [hdr['xlen'], hdr['ylen'], hdr['zlen']] = header_f[10:13]
+    [hdr['dmin'], hdr['dmax'], hdr['dmean']] = header_f[19:22]
+    hdr['nsymbt'] = int(header[23])
+    hdr['exttyp'] = raw[104:108].decode('ascii', errors='replace')
+    hdr['origin'] = header_f[49:52]
+    hdr['rms'] = header_f[54]
+    hdr['labels'] = [
+        raw[224 + 80 * i:304 + 80 * i].decode('ascii', errors='replace')
+        .rstrip('\x00 ')
+        for i in range(min(max(int(header[55]), 0), 10))
+    ]
+    hdr['byteorder'] = byteorder
+    hdr['psize'] = hdr['xlen'] / hdr['mx'] if hdr['mx'] else 1.0
+    hdr['data_offset'] = 1024 + hdr['nsymbt']
+    return hdr
+
+
+class MRC:
+
+    """
+    An MRC file whose header is parsed once and whose data is exposed as
+    memory-mapped NumPy views, without copying, in row-major (z, y, x)
+    order. Supports modes 0, 1, 2, 3, 4, 6, 12 and 101, extended headers,
+    and either byte order. Mode 101 packs two pixels per byte, so its
+    pixels cannot be viewed in place and are unpacked into copies.
+    """
+
+    def __init__(self, filename):
+
+        """
+        Arguments:
+        filename (str): The path of the MRC file.
+        """
+
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.header = _parse_header(f.read(1024))
+            self.extended_header = f.read(self.header['nsymbt'])
+        self.dtype = _mode_dtype(self.header)
+        self._data = None
+
+    @property
+    def shape(self):
+
+        """The shape (nz, ny, nx) of the stack."""
+
+        return (self.header['nz'], self.header['ny'], self.header['nx'])
+
+    @property
+    def psize(self):
+
+        """The pixel size in Angstroms."""
+
+        return self.header['psize']
+
+    def _map(self):
+
+        """Memory-map the data once, as stored on disk."""
+
+        if self._data is None:
+            nz, ny, nx = self.shape
+            if self.header['datatype'] == 101:
+                dtype, shape = n.uint8, (nz, ny, _row_bytes(self.header))
+            else:
+                dtype, shape = self.dtype, (nz, ny, nx)
+            self._data = n.memmap(self.filename, dtype, 'r',
+                                  offset=self.header['data_offset'],
+                                  shape=shape, order='C')
+        return self._data
+
+    def _pixels(self, data):
+
+        """Turn data sliced from the memory map into pixels."""
+
+        if self.header['datatype'] == 101:
+            return _unpack_4bit(data, self.header['nx'])
+        return data
+
+    def stack(self):
+
+        """Return the whole stack as a (nz, ny, nx) view."""
+
+        return self._pixels(self._map())
+
+    def sections(self, start, stop):
+
+        """Return sections start to stop (exclusive) as a view."""
+
+        return self._pixels(self._map()[start:stop])
+
+    def section(self, sec=0):
+
+        """Return section sec as a (ny, nx) view."""
+
+        return self._pixels(self._map()[sec])
+
+    def patch(self, xstart, xstop, ystart, ystop, sec=0):
+
+        """
+        Return the sub-rectangle [ystart:ystop, xstart:xstop] of section
+        sec as a view, using Python numbering. Only the pages holding
+        the patch's rows are read from disk.
+        """
+
+        if self.header['datatype'] == 101:
+            packed = self._map()[sec, ystart:ystop,
+                                 xstart // 2:(xstop + 1) // 2]
+            pixels = _unpack_4bit(packed, 2 * packed.shape[-1])
+            return pixels[:, xstart % 2:xstart % 2 + xstop - xstart]
+        return self._map()[sec, ystart:ystop, xstart:xstop]
+
+
+class MRCWriter:
+
+    """
+    Writes a stack to an MRC file one or more sections at a time through a
+    large write buffer, and fills in the header (dimensions and data
+    statistics) when closed. Use as a context manager:
+
+        with MRCWriter('stack.mrc', psize=1.06) as writer:
+            for image in images:
+                writer.write(image)
+    """
+
+    def __init__(self, filename, mode=2, psize=1,
+                 buffer_size=8 * 1024 * 1024):
+
+        """
+        Arguments:
+        filename (str): The path of the MRC file to write.
+        mode (int): The MRC mode of the data (see MODES).
+        psize (float): The pixel size in Angstroms.
+        buffer_size (int): The size of the write buffer in bytes. Small
+        sections are gathered into writes of this size, while sections
+        larger than it are written straight to the file.
+        """
+
+        self.filename = filename
+        self.mode = mode
+        self.psize = psize
+        self.dtype = _mode_dtype({'datatype': mode, 'byteorder': '<'})
+        self.file = open(filename, 'wb', buffering=buffer_size)
+        self.file.write(bytes(1024))
+
+        # Dimensions and running statistics for the header
+        self.nx, self.ny, self.nz = 0, 0, 0
+        self.dmin, self.dmax = n.inf, -n.inf
+        self.total, self.total_squares = 0.0, 0.0
+
+    def write(self, data):
+
+        """
+        Append a (ny, nx) section or a (nz, ny, nx) stack of sections
+        (with a trailing (real, imaginary) axis for mode 3).
+        """
+
+        data = n.asarray(data)
+        pixel_ndim = 3 if self.mode == 3 else 2
+        if data.ndim == pixel_ndim:
+            data = data[None]
+        if self.nz == 0:
+            self.ny, self.nx = data.shape[1:3]
+        elif data.shape[1:3] != (self.ny, self.nx):
+            raise Exception(
+                f"Please input sections of shape {(self.ny, self.nx)}, "
+                f"not {data.shape[1:3]}."
+            )
+
+        # Accumulate statistics of the (magnitude of the) pixels
+        values = data
+        if self.mode == 3:
+            values = n.hypot(data[..., 0], data[..., 1].astype(n.float64))
+        elif self.mode == 4:
+            values = n.abs(data)
+        # (one dot product per section avoids a float64 temporary copy)
+        self.dmin = min(self.dmin, float(values.min()))
+        self.dmax = max(self.dmax, float(values.max()))
+        for section in values.reshape(len(values), -1):
+            if section.dtype != n.float32 and section.dtype != n.float64:
+                section = section.astype(n.float32)
+            self.total += float(section.sum())
+            self.total_squares += float(n.dot(section, section))
+        self.nz += data.shape[0]
+
+        if self.mode == 101:
+            data = _pack_4bit(data)
+        else:
+            data = n.ascontiguousarray(data, dtype=self.dtype.base
+                                       if self.mode == 3 else self.dtype)
+        self.file.write(memoryview(data).cast('B'))
+
+    def close(self):
+
+        """Flush the buffer and write the header."""
+
+        count = self.nx * self.ny * self.nz
+        dmean = self.total / count if count else 0
+        rms = n.sqrt(max(self.total_squares / count - dmean**2, 0)) \
+            if count else 0
+        iwrhdr_opened(self.file, nxyz=[self.nx, self.ny, self.nz],
+                      dmin=self.dmin if count else 0,
+                      dmax=self.dmax if count else 0,
+                      dmean=dmean, mode=self.mode, psize=self.psize, rms=rms)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
 def iwrsec_opened(data, filename):
 
@@ -24,7 +338,7 @@ def iwrsec_opened(data, filename):
 
 
 def iwrhdr_opened(filename, nxyz=0, dmin=0, dmax=0,
-                  dmean=0, mode=2, psize=1):
+                  dmean=0, mode=2, psize=1, rms=0):
 
     """
     Image Write Header (opened) -
@@ -58,6 +372,7 @@ def iwrhdr_opened(filename, nxyz=0, dmin=0, dmax=0,
 
     # data stats
     header_f[19:22] = [dmin, dmax, dmean]
+    header_f[54] = rms
 
     # 'MAP ' chars
     header[52] = 542130509
@@ -73,15 +388,10 @@ def irdvol_opened(filename):
     """
 
     hdr = irdhdr_opened(filename)
-    nx = hdr['nx']
-    ny = hdr['ny']
-    nz = hdr['nz']
-    dtype = {0: n.int8, 1: n.int16, 2: n.float32,
-             6: n.uint16}[hdr['datatype']]
-    filename.seek(1024)
-    data = n.reshape(n.fromfile(filename, dtype, count=nx*ny*nz),
-                     (nz, ny, nx), order='C')
-    return data
+    filename.seek(hdr['data_offset'])
+    data = n.fromfile(filename, n.uint8,
+                      count=_row_bytes(hdr)*hdr['ny']*hdr['nz'])
+    return _decode_sections(data, hdr)
 
 
 def irdsec_opened(filename, sec):
@@ -92,21 +402,10 @@ def irdsec_opened(filename, sec):
     """
 
     hdr = irdhdr_opened(filename)
-    nx = hdr['nx']
-    ny = hdr['ny']
-    dtype = {0: n.int8, 1: n.int16, 2: n.float32,
-             6: n.uint16}[hdr['datatype']]
-    if hdr['datatype'] == 0:
-        nbytes = 1
-    elif hdr['datatype'] == 1 or hdr['datatype'] == 6:
-        nbytes = 2
-    else:
-        nbytes = 4
-    position = nx*ny*(sec)*nbytes+1024
-    filename.seek(position)
-    data = n.reshape(n.fromfile(filename, dtype, count=nx*ny),
-                     (nx, ny), order='F')
-    return data
+    section_bytes = _row_bytes(hdr)*hdr['ny']
+    filename.seek(hdr['data_offset'] + section_bytes*sec)
+    data = n.fromfile(filename, n.uint8, count=section_bytes)
+    return _decode_sections(data, hdr)[0].T
 
 
 def irdhdr_opened(fname):
@@ -117,13 +416,7 @@ def irdhdr_opened(fname):
     """
 
     fname.seek(0)
-    hdr = None
-    hdr = {}
-    header = n.fromfile(fname, dtype=n.int32, count=256)
-    header_f = header.view(n.float32)
-    [hdr['nx'], hdr['ny'], hdr['nz'], hdr['datatype']] = header[:4]
-    [hdr['xlen'], hdr['ylen'], hdr['zlen']] = header_f[10:13]
-    return hdr
+    return _parse_header(n.fromfile(fname, dtype=n.uint8, count=1024))
 
 
 def irdpas_opened(filename, xstart, xstop, ystart, ystop, sec):
@@ -134,30 +427,13 @@ def irdpas_opened(filename, xstart, xstop, ystart, ystop, sec):
     """
 
     hdr = irdhdr_opened(filename)
-    nx = hdr['nx']
-    ny = hdr['ny']
+    row_bytes = _row_bytes(hdr)
 
-    # Return to beginning of file
-    filename.seek(0)
-    dtype = {0: n.int8, 1: n.int16, 2: n.float32,
-             6: n.uint16}[hdr['datatype']]
-    if hdr['datatype'] == 0:
-        nbytes = 1
-    elif hdr['datatype'] == 1 or hdr['datatype'] == 6:
-        nbytes = 2
-    else:
-        nbytes = 4
-    # Assumes Python numbering
-    xsize = xstop - xstart
-    ysize = ystop - ystart
-    data = n.zeros([xsize, ysize], dtype=n.float32)
-    position = nx*ny*sec*nbytes + ystart*nx*nbytes + 1024
-    for line in range(ysize):
-        position = position + xstart*nbytes
-        filename.seek(position)
-        data[:, line] = n.fromfile(filename, dtype, count=xsize)
-        position = position + xsize*nbytes+nx*nbytes - xstop*nbytes
-    return data
+    # Read the rows holding the part in one go. Assumes Python numbering.
+    filename.seek(hdr['data_offset'] + row_bytes*(hdr['ny']*sec + ystart))
+    data = n.fromfile(filename, n.uint8, count=row_bytes*(ystop - ystart))
+    rows = _decode_sections(data, dict(hdr, ny=ystop - ystart))[0]
+    return n.array(rows[:, xstart:xstop].T, dtype=n.float32)
 
 
 def irdsec_closed(filename, sec):
@@ -167,73 +443,32 @@ def irdsec_closed(filename, sec):
     open an MRC file and then read a section.
     """
 
-    hdr = readMRCheader(filename)
-    nx = hdr['nx']
-    ny = hdr['ny']
-    dtype = {0: n.int8, 1: n.int16, 2: n.float32,
-             6: n.uint16}[hdr['datatype']]
-    data = n.zeros([nx, ny], dtype)
-    with open(filename) as f:
-        position = nx*ny*(sec) + 1024
-        f.seek(position)
-        data = n.reshape(n.fromfile(f, dtype, count=nx*ny),
-                         (nx, ny), order='F')
-    return data
+    return n.array(MRC(filename).section(sec).T)
 
 
 def readMRCmemmap(fname, inc_header=False):
 
     """Read a memory mapped MRC file and header."""
 
-    hdr = readMRCheader(fname)
-    nx = hdr['nx']
-    ny = hdr['ny']
-    nz = hdr['nz']
-    dtype = {0: n.int8, 1: n.int16, 2: n.float32,
-             6: n.uint16}[hdr['datatype']]
-    mm = n.memmap(fname, dtype, 'r',
-                  offset=1024, shape=(nx, ny, nz), order='F')
-    return (mm, hdr) if inc_header else mm
+    mrc = MRC(fname)
+
+    # The stack as (nx, ny, nz) in column-major order, as before
+    data = mrc.stack()
+    mm = data.transpose((2, 1, 0) + tuple(range(3, data.ndim)))
+    return (mm, mrc.header) if inc_header else mm
 
 
 def readMRCheader(fname):
 
     """Read values from MRC header into an array."""
 
-    hdr = None
-    with open(fname) as f:
-        hdr = {}
-        header = n.fromfile(f, dtype=n.int32, count=256)
-        header_f = header.view(n.float32)
-        [hdr['nx'], hdr['ny'], hdr['nz'], hdr['datatype']] = header[:4]
-        [hdr['xlen'], hdr['ylen'], hdr['zlen']] = header_f[10:13]
-    return hdr
+    return MRC(fname).header
 
 
 def irdpasMRC(filename, xstart, xstop, ystart, ystop, sec):
 
     """Image Read Part of a Section: Read part of an MRC section."""
 
-    hdr = readMRCheader(filename)
-    nx = hdr['nx']
-    ny = hdr['ny']
-    dtype = {0: n.int8, 1: n.int16, 2: n.float32,
-             6: n.uint16}[hdr['datatype']]
-    if hdr['datatype'] == 0:
-        nbytes = 1
-    elif hdr['datatype'] == 1 or hdr['datatype'] == 6:
-        nbytes = 2
-    else:
-        nbytes = 4
     # Assumes Python numbering
-    xsize = xstop - xstart
-    ysize = ystop - ystart
-    data = n.zeros([xsize, ysize], dtype=n.float32)
-    with open(filename) as f:
-        position = nx*ny*sec*nbytes + ystart*nx*nbytes + 1024
-        for line in range(ysize):
-            position = position + xstart*nbytes
-            f.seek(position)
-            data[:, line] = n.fromfile(f, dtype, count=xsize)
-            position = position + xsize*nbytes + nx*nbytes - xstop*nbytes
-    return data
+    return n.array(MRC(filename).patch(xstart, xstop, ystart, ystop, sec).T,
+                   dtype=n.float32)
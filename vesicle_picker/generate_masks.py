@@ -1,10 +1,87 @@
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+from segment_anything.utils.amg import generate_crop_boxes
+from segment_anything.utils.transforms import ResizeLongestSide
+from vesicle_picker import helpers, spatial_index
+from vesicle_picker.embedding_cache import (
+    CachingSamPredictor, MemoryEmbeddingCache
+)
 import numpy as np
+import copy
 import cv2
+import time
+import torch
 from torch.cuda import is_available
 
+# The segment-anything mask generator options that can be given in a
+# parameters file, with their types
+SEGMENTATION_OPTIONS = {
+    'points_per_side': int,
+    'points_per_batch': int,
+    'pred_iou_thresh': float,
+    'stability_score_thresh': float,
+    'stability_score_offset': float,
+    'box_nms_thresh': float,
+    'crop_n_layers': int,
+    'crop_nms_thresh': float,
+    'crop_overlap_ratio': float,
+    'crop_n_points_downscale_factor': int,
+    'min_mask_region_area': int,
+}
 
-def initialize_model(model_weights_path, model_type='vit_h', device='cuda'):
+
+def segmentation_parameters(parameters, section='segmentation'):
+
+    """
+    Read the segment-anything mask generator options given in a section
+    of a parsed parameters file, as keyword arguments for generate_masks().
+    Options missing from the section keep segment-anything's defaults.
+    """
+
+    return {
+        option: option_type(parameters.get(section, option))
+        for option, option_type in SEGMENTATION_OPTIONS.items()
+        if parameters.has_option(section, option)
+    }
+
+
+class Bfloat16Encoder(torch.nn.Module):
+
+    """
+    Wraps an image encoder to run it under bfloat16 autocast on the CPU,
+    returning float32 embeddings for the prompt decoder.
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.img_size = encoder.img_size
+
+    def forward(self, x):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return self.encoder(x).float()
+
+
+def model_parameters(parameters):
+
+    """
+    Read the options of initialize_model() from the [segmentation]
+    section of a parsed parameters file, as keyword arguments.
+    """
+
+    return {
+        'model_weights_path': parameters.get('segmentation',
+                                             'model_weights_path'),
+        'model_type': parameters.get('segmentation', 'model_type'),
+        'device': parameters.get('segmentation', 'device'),
+        'precision': parameters.get('segmentation', 'precision',
+                                    fallback='fp32'),
+        'compile': parameters.getboolean('segmentation', 'compile',
+                                         fallback=False),
+    }
+
+
+def initialize_model(model_weights_path, model_type='vit_h', device='cuda',
+                     precision='fp32', compile=False):
 
     """
     Initialize a Segment-Anything model.
@@ -15,6 +92,12 @@ def initialize_model(model_weights_path, model_type='vit_h', device='cuda'):
     model_type (str): The model type ('vit_h' by default).
     device (str): The device on which the model will run
     ('cuda', 'cpu', or 'mps'. 'cuda' by default).
+    precision (str): For models on the CPU, the precision of the image
+    encoder; "fp32" (default), "int8" for dynamic int8 quantization of
+    its linear layers, or "bf16" for bfloat16 autocast where the CPU
+    supports it. Other devices always run in fp32.
+    compile (bool): Whether to compile the image encoder with
+    torch.compile(). The first micrograph then takes longer.
 
     Outputs:
     model (PyTorch model): An initialized segment-anything model.
@@ -30,13 +113,158 @@ def initialize_model(model_weights_path, model_type='vit_h', device='cuda'):
 
     # Send the model to GPU
     model.to(device=device)
+    model.eval()
+
+    # Reduce the precision of the image encoder, which dominates the
+    # runtime on the CPU
+    if precision not in ('fp32', 'int8', 'bf16'):
+        raise Exception("Please input a valid precision (fp32, int8, bf16).")
+    if precision != 'fp32' and device != 'cpu':
+        print(f"{precision} is only supported on the CPU. Using fp32.")
+    elif precision == 'int8':
+        model.image_encoder = torch.ao.quantization.quantize_dynamic(
+            model.image_encoder, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif precision == 'bf16':
+        if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            model.image_encoder = Bfloat16Encoder(model.image_encoder)
+        else:
+            print("This CPU does not support bf16. Using fp32.")
+
+    if compile:
+        model.image_encoder = torch.compile(model.image_encoder)
 
     # Return the model
     return model
 
 
+def colour_image(preprocessed_micrograph):
+
+    """
+    Turn a preprocessed micrograph into the 8-bit pseudo-colour image
+    that segment-anything segments.
+    """
+
+    # Normalize the values
+    preprocessed_micrograph_uint8 = (
+        cv2.normalize(preprocessed_micrograph, None, 0, 255,
+                      cv2.NORM_MINMAX).astype("uint8")
+    )
+
+    # Generate a pseudo-colour image for segmentation
+    preprocessed_micrograph_colour = (
+        np.expand_dims(preprocessed_micrograph_uint8, axis=2)
+    )
+    return np.repeat(preprocessed_micrograph_colour, 3, axis=2)
+
+
+def crop_images(preprocessed_micrograph, mask_generator):
+
+    """
+    List the images a mask generator encodes when segmenting a
+    preprocessed micrograph: the whole image, then each of its crops.
+    """
+
+    return image_crops(colour_image(preprocessed_micrograph), mask_generator)
+
+
+def image_crops(image, mask_generator):
+
+    """
+    List the images a mask generator encodes when segmenting an 8-bit
+    RGB image, as crop_images().
+    """
+
+    crop_boxes, _ = generate_crop_boxes(
+        image.shape[:2], mask_generator.crop_n_layers,
+        mask_generator.crop_overlap_ratio
+    )
+    return [image[y0:y1, x0:x1] for x0, y0, x1, y1 in crop_boxes]
+
+
+@torch.no_grad()
+def encode_images(model, images, embedding_cache, batch_size=1):
+
+    """
+    Run the image encoder on a list of images, batch_size images per
+    forward pass, and add their embeddings to a cache. Images whose
+    embeddings are already cached are skipped.
+
+    Arguments:
+    model (PyTorch model): An initialized segment-anything model.
+    images (list): 8-bit RGB images, as given to SamPredictor.set_image().
+    embedding_cache (EmbeddingCache or MemoryEmbeddingCache): The cache.
+    batch_size (int): The number of images per forward pass.
+
+    Outputs:
+    encoded (int): The number of images encoded.
+    """
+
+    transform = ResizeLongestSide(model.image_encoder.img_size)
+
+    # The distinct images missing from the cache
+    pending = {}
+    for image in images:
+        key = embedding_cache.key(image)
+        if key not in pending and embedding_cache.get(key) is None:
+            pending[key] = image
+    pending = list(pending.items())
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+
+        # Resize and pad each image as SamPredictor.set_image() does
+        inputs, input_sizes = [], []
+        for _, image in batch:
+            input_image = torch.as_tensor(transform.apply_image(image),
+                                          device=model.device)
+            input_image = input_image.permute(2, 0, 1).contiguous()[None]
+            input_sizes.append(tuple(input_image.shape[-2:]))
+            inputs.append(model.preprocess(input_image))
+
+        features = model.image_encoder(torch.cat(inputs)).cpu().numpy()
+        for (key, image), feature, input_size in zip(batch, features,
+                                                     input_sizes):
+            embedding_cache.put(key, feature[None], image.shape[:2],
+                                input_size)
+
+    return len(pending)
+
+
+def build_mask_generator(model, output_mode='binary_mask',
+                         embedding_cache=None, **kwargs):
+
+    """
+    Build a segment-anything mask generator, which can be reused
+    across micrographs with generate_masks().
+
+    Arguments:
+    model, output_mode, embedding_cache, **kwargs: As for generate_masks().
+
+    Outputs:
+    mask_generator (SamAutomaticMaskGenerator): The mask generator.
+    """
+
+    # Initialize automatic mask generator class with desired params.
+    # Compact masks are built from run-length encodings,
+    # so full-frame masks are never materialized.
+    mask_generator = SamAutomaticMaskGenerator(
+        model=model,
+        output_mode=(
+            'uncompressed_rle' if output_mode == 'crop' else output_mode
+        ),
+        **kwargs
+    )
+    if embedding_cache is not None:
+        mask_generator.predictor = CachingSamPredictor(model,
+                                                       embedding_cache)
+    return mask_generator
+
+
 def generate_masks(preprocessed_micrograph, model,
-                   psize, downsample, **kwargs):
+                   psize, downsample, output_mode='binary_mask',
+                   embedding_cache=None, mask_generator=None, prompts=None,
+                   **kwargs):
 
     """
     Apply a Segment-Anything model to automatic segmentation of a micrograph.
@@ -45,6 +273,21 @@ def generate_masks(preprocessed_micrograph, model,
     preprocessed_micrograph (np.ndarray): A 2D numpy array of a downsampled,
     blurred micrograph.
     model (PyTorch model): An initialized segment-anything model.
+    psize (float): The pixel size of the original micrograph (Angstrom/pixel).
+    downsample (int): The downsampling factor applied in preprocessing.
+    output_mode (str): "crop" to return compact masks, holding each
+    segmentation cropped to its rectangle (see helpers.compact_mask()),
+    or any output mode of the segment-anything mask generator
+    ("binary_mask" by default, for full-frame segmentations).
+    embedding_cache (EmbeddingCache): A cache of image embeddings to read
+    from and add to, so that only the prompt decoder runs on micrographs
+    (and crops) that were segmented before. None to always run the encoder.
+    mask_generator (SamAutomaticMaskGenerator): A mask generator from
+    build_mask_generator() with the same output_mode, to reuse instead of
+    building a new one. If given, embedding_cache and kwargs are ignored.
+    prompts (np.ndarray): (x, y) pixel coordinates of the points to prompt
+    the model with, such as from prompts.blob_prompts(), instead of the
+    uniform grid of points_per_side. Crop layers keep their grids.
     **kwargs: Keyword arguments to be passed on to the segment-anything
     model. For more information, visit the segment-anything GitHub.
 
@@ -53,24 +296,29 @@ def generate_masks(preprocessed_micrograph, model,
     detected mask in preprocessed_micrograph.
     """
 
-    # Normalize the values
-    preprocessed_micrograph_uint8 = (
-        cv2.normalize(preprocessed_micrograph, None, 0, 255,
-                      cv2.NORM_MINMAX).astype("uint8")
-    )
+    preprocessed_micrograph_colour = colour_image(preprocessed_micrograph)
+    if mask_generator is None:
+        mask_generator = build_mask_generator(
+            model, output_mode, embedding_cache, **kwargs
+        )
 
-    # Generate a pseudo-colour image for segmentation
-    preprocessed_micrograph_colour = (
-        np.expand_dims(preprocessed_micrograph_uint8, axis=2)
-    )
-    preprocessed_micrograph_colour = (
-        np.repeat(preprocessed_micrograph_colour, 3, axis=2)
-    )
-    # Initialize automatic mask generator class with desired params
-    mask_generator = SamAutomaticMaskGenerator(model=model, **kwargs)
+    # Replace the grid of the whole micrograph with the prompts, on a copy
+    # so the mask generator can still be shared. Without any prompts,
+    # there is nothing to segment.
+    if prompts is not None:
+        if len(prompts) == 0:
+            return []
+        height, width = preprocessed_micrograph.shape[:2]
+        mask_generator = copy.copy(mask_generator)
+        mask_generator.point_grids = (
+            [np.reshape(prompts, (-1, 2)) / [width, height]]
+            + mask_generator.point_grids[1:]
+        )
 
     # Generate masks on the preprocessed_micrograph
     masks = mask_generator.generate(preprocessed_micrograph_colour)
+    if output_mode == 'crop':
+        masks = [helpers.compact_rle_mask(mask) for mask in masks]
 
     # Modify the area of each mask to be in Angstrom squared
     for mask in masks:
@@ -78,3 +326,317 @@ def generate_masks(preprocessed_micrograph, model,
 
     # Return the list of masks
     return masks
+
+
+def generate_mask_sweep(preprocessed_micrograph, model, psize, downsample,
+                        configurations, output_mode='crop',
+                        embedding_cache=None, **kwargs):
+
+    """
+    Segment a micrograph with several sets of mask generator parameters,
+    running the image encoder only once for each distinct image (the
+    micrograph and each of its crops) and the prompt decoder once per set.
+
+    Arguments:
+    preprocessed_micrograph, model, psize, downsample, output_mode:
+    As for generate_masks().
+    configurations (dict): The name of each configuration, to a
+    dictionary of mask generator parameters overriding kwargs.
+    embedding_cache (EmbeddingCache): A cache of image embeddings on disk
+    to read from and add to, or None.
+    **kwargs: Mask generator parameters shared by all configurations.
+
+    Outputs:
+    results (dict): The name of each configuration, to a dictionary with
+    its 'masks', number of masks 'count', runtime in 'seconds', and the
+    number of images it had to 'encode'.
+    """
+
+    memory_cache = MemoryEmbeddingCache(embedding_cache)
+
+    results = {}
+    for name, configuration in configurations.items():
+        start = time.perf_counter()
+        misses = memory_cache.misses
+        masks = generate_masks(
+            preprocessed_micrograph, model, psize, downsample,
+            output_mode=output_mode, embedding_cache=memory_cache,
+            **{**kwargs, **configuration}
+        )
+        results[name] = {
+            'masks': masks,
+            'count': len(masks),
+            'seconds': time.perf_counter() - start,
+            'encoded': memory_cache.misses - misses,
+        }
+
+    return results
+
+
+def generate_masks_batch(preprocessed_micrographs, model, psize, downsample,
+                         batch_size=4, output_mode='binary_mask',
+                         embedding_cache=None, prompts=None, **kwargs):
+
+    """
+    Segment several micrographs, as generate_masks(), but run the image
+    encoder on batches of images: first every micrograph and crop that
+    the mask generator will encode, batch_size per forward pass, then
+    the prompt decoder on each micrograph in turn. On many-core CPUs,
+    larger batches keep more cores busy, at the cost of more memory.
+
+    Arguments:
+    preprocessed_micrographs (list): The preprocessed micrographs.
+    batch_size (int): The number of images per encoder forward pass.
+    prompts (list): The prompt points of each micrograph, as for
+    generate_masks(), or None to prompt on the uniform grid.
+    model, psize, downsample, output_mode, embedding_cache, **kwargs:
+    As for generate_masks().
+
+    Outputs:
+    masks (list): The list of masks of each micrograph, in order.
+    """
+
+    memory_cache = MemoryEmbeddingCache(embedding_cache)
+    mask_generator = build_mask_generator(model, output_mode, memory_cache,
+                                          **kwargs)
+
+    # The images the mask generator will encode: each micrograph
+    # and each of its crops
+    images = []
+    for preprocessed_micrograph in preprocessed_micrographs:
+        images += crop_images(preprocessed_micrograph, mask_generator)
+    encode_images(model, images, memory_cache, batch_size)
+
+    if prompts is None:
+        prompts = [None] * len(preprocessed_micrographs)
+    return [
+        generate_masks(preprocessed_micrograph, model, psize, downsample,
+                       output_mode=output_mode, mask_generator=mask_generator,
+                       prompts=micrograph_prompts)
+        for preprocessed_micrograph, micrograph_prompts
+        in zip(preprocessed_micrographs, prompts)
+    ]
+
+
+def tiling_parameters(parameters):
+
+    """
+    Read the tile_size and tile_overlap of tiled segmentation from the
+    [segmentation] section of a parsed parameters file, as keyword
+    arguments for generate_masks_tiled(), or None if tile_size is not
+    given or is 0.
+    """
+
+    tile_size = parameters.getint('segmentation', 'tile_size', fallback=0)
+    if tile_size <= 0:
+        return None
+    return {
+        'tile_size': tile_size,
+        'tile_overlap': parameters.getint('segmentation', 'tile_overlap',
+                                          fallback=128)
+    }
+
+
+def tile_origins(length, tile_size, tile_overlap):
+
+    """
+    Return the starts of overlapping tiles covering a length, spaced
+    tile_size - tile_overlap apart, with the last tile flush with the end.
+    """
+
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, tile_size - tile_overlap))
+    return origins + [length - tile_size]
+
+
+def merge_tiled_masks(masks, min_overlap=0.5):
+
+    """
+    Merge the compact masks found in overlapping tiles into masks of the
+    whole micrograph. A mask is cut if it touches the edge of its tile
+    inside the micrograph. Cut masks contained in a whole mask from
+    another tile are dropped, and the remaining cut masks that overlap
+    are merged into one. Whole masks found twice, in the overlap of two
+    tiles, are kept once.
+
+    Arguments:
+    masks (list): Compact masks in micrograph coordinates, each with the
+    'tile' rectangle it was found in, as [x0, y0, width, height].
+    min_overlap (float): The fraction of the smaller of two masks they
+    must share to be the same vesicle.
+
+    Outputs:
+    merged (list): The masks of the micrograph, without 'tile'.
+    """
+
+    if len(masks) == 0:
+        return []
+
+    h_img, w_img = image_shape = tuple(masks[0]['image_shape'])
+    boxes = np.array([mask['mask_box'] for mask in masks])
+    tiles = np.array([mask['tile'] for mask in masks])
+    ends, tile_ends = boxes[:, :2] + boxes[:, 2:], tiles[:, :2] + tiles[:, 2:]
+    cut = (
+        ((boxes[:, 0] == tiles[:, 0]) & (tiles[:, 0] > 0))
+        | ((boxes[:, 1] == tiles[:, 1]) & (tiles[:, 1] > 0))
+        | ((ends[:, 0] == tile_ends[:, 0]) & (tile_ends[:, 0] < w_img))
+        | ((ends[:, 1] == tile_ends[:, 1]) & (tile_ends[:, 1] < h_img))
+    )
+
+    # Candidate pairs: masks from different tiles whose rectangles overlap
+    pairs = [
+        (i, j) for i, j in spatial_index.overlapping_pairs(boxes.tolist())
+        if masks[i]['tile'] != masks[j]['tile']
+    ]
+
+    # Union-find over the masks of the same vesicle
+    parent = list(range(len(masks)))
+
+    def root(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    dropped = np.zeros(len(masks), dtype=bool)
+    for i, j in pairs:
+        shared = helpers.mask_intersection(masks[i], masks[j])
+        if shared < min_overlap * min(masks[i]['area'], masks[j]['area']):
+            continue
+        if cut[i] and not cut[j]:
+            dropped[i] = True
+        elif cut[j] and not cut[i]:
+            dropped[j] = True
+        elif cut[i] and cut[j]:
+            parent[root(i)] = root(j)
+        elif masks[i].get('predicted_iou', 0) < masks[j].get(
+                'predicted_iou', 0):
+            dropped[i] = True
+        else:
+            dropped[j] = True
+
+    groups = {}
+    for index in range(len(masks)):
+        if not dropped[index]:
+            groups.setdefault(root(index), []).append(masks[index])
+
+    merged = []
+    for group in groups.values():
+        mask = helpers.union_masks(group) if len(group) > 1 else dict(group[0])
+        del mask['tile']
+        mask['image_shape'] = image_shape
+        merged.append(mask)
+    return merged
+
+
+def generate_masks_tiled(preprocessed_micrograph, model, psize, downsample,
+                         tile_size=1024, tile_overlap=128,
+                         output_mode='binary_mask', embedding_cache=None,
+                         prompts=None, batch_size=1, **kwargs):
+
+    """
+    Segment a micrograph, as generate_masks(), in overlapping square tiles
+    of tile_size pixels. segment-anything resizes each image it segments
+    to 1024 pixels, so with tiles of about that size every tile is
+    segmented at the micrograph's own resolution, whatever its size, and
+    memory is bounded by the tile size. Masks cut by the edges of tiles
+    are stitched back together with merge_tiled_masks(), so tile_overlap
+    should be at least the diameter of the largest vesicles.
+
+    Arguments:
+    tile_size (int): The side length of the tiles, in pixels.
+    tile_overlap (int): The overlap of neighbouring tiles, in pixels.
+    output_mode (str): "crop" or "binary_mask", as for generate_masks().
+    batch_size (int): The number of tiles per encoder forward pass. Only
+    the embeddings of one batch of tiles are held in memory at a time.
+    prompts (np.ndarray): As for generate_masks(). Tiles without any
+    prompt points are skipped.
+    preprocessed_micrograph, model, psize, downsample, embedding_cache,
+    **kwargs: As for generate_masks().
+
+    Outputs:
+    masks (list): A list of dictionaries, each dictionary representing a
+    detected mask in preprocessed_micrograph.
+    """
+
+    if output_mode not in ('crop', 'binary_mask'):
+        raise Exception(
+            "Please input a valid output mode (crop, binary_mask)."
+        )
+    if tile_overlap >= tile_size:
+        raise Exception(
+            "Please input a valid tile overlap (smaller than the tile size)."
+        )
+
+    memory_cache = MemoryEmbeddingCache(embedding_cache)
+    mask_generator = build_mask_generator(model, 'crop', memory_cache,
+                                          **kwargs)
+
+    # Normalize the whole micrograph once, so all tiles share one scale
+    colour = colour_image(preprocessed_micrograph)
+    h_img, w_img = colour.shape[:2]
+    tiles = [
+        (x0, y0, min(tile_size, w_img), min(tile_size, h_img))
+        for y0 in tile_origins(h_img, tile_size, tile_overlap)
+        for x0 in tile_origins(w_img, tile_size, tile_overlap)
+    ]
+
+    # The mask generator of each tile, prompted on the points inside it
+    tile_generators = []
+    for x0, y0, w, h in tiles:
+        tile_generator = mask_generator
+        if prompts is not None:
+            prompts = np.reshape(prompts, (-1, 2))
+            inside = np.all(
+                (prompts >= [x0, y0]) & (prompts < [x0 + w, y0 + h]), axis=1
+            )
+            if not inside.any():
+                continue
+            tile_generator = copy.copy(mask_generator)
+            tile_generator.point_grids = (
+                [(prompts[inside] - [x0, y0]) / [w, h]]
+                + mask_generator.point_grids[1:]
+            )
+        tile_generators.append(((x0, y0, w, h), tile_generator))
+
+    # Encode and decode batch_size tiles at a time, dropping the
+    # embeddings of each batch before the next, so memory does not
+    # grow with the number of tiles
+    masks = []
+    for start in range(0, len(tile_generators), batch_size):
+        batch = tile_generators[start:start + batch_size]
+        images = []
+        for (x0, y0, w, h), _ in batch:
+            images += image_crops(colour[y0:y0+h, x0:x0+w], mask_generator)
+        encode_images(model, images, memory_cache, batch_size)
+
+        for (x0, y0, w, h), tile_generator in batch:
+            for mask in tile_generator.generate(colour[y0:y0+h, x0:x0+w]):
+                mask = helpers.compact_rle_mask(mask)
+                if mask['mask_box'][2] == 0:
+                    continue
+                mask['mask_box'][:2] = [mask['mask_box'][0] + x0,
+                                        mask['mask_box'][1] + y0]
+                mask['bbox'] = [mask['bbox'][0] + x0, mask['bbox'][1] + y0,
+                                mask['bbox'][2], mask['bbox'][3]]
+                mask['point_coords'] = [[x + x0, y + y0]
+                                        for x, y in mask['point_coords']]
+                mask['crop_box'] = [mask['crop_box'][0] + x0,
+                                    mask['crop_box'][1] + y0,
+                                    mask['crop_box'][2], mask['crop_box'][3]]
+                mask['image_shape'] = (h_img, w_img)
+                mask['tile'] = [x0, y0, w, h]
+                masks.append(mask)
+
+        memory_cache.clear()
+
+    masks = merge_tiled_masks(masks)
+    if output_mode == 'binary_mask':
+        masks = [helpers.full_mask(mask) for mask in masks]
+
+    # Modify the area of each mask to be in Angstrom squared
+    for mask in masks:
+        mask['area_asq'] = mask['area']*(downsample**2)*(psize**2)
+
+    return masks
@@ -57,21 +57,33 @@ def show_anns(anns):
     ax = plt.gca()
     ax.set_autoscale_on(False)
 
-    img = np.ones((sorted_anns[0]['segmentation'].shape[0],
-                   sorted_anns[0]['segmentation'].shape[1], 4))
+    img = np.ones((*image_shape(sorted_anns[0]), 4))
     img[:, :, 3] = 0
     for ann in sorted_anns:
-        m = ann['segmentation']
+        m, x0, y0 = mask_crop(ann)
         color_mask = np.concatenate([np.random.random(3), [0.35]])
-        img[m] = color_mask
+        img[y0:y0+m.shape[0], x0:x0+m.shape[1]][m] = color_mask
     ax.imshow(img)
 
 
 def sum_masks(masks, key):
 
-    """Sum arrays stored in a list of masks by a given dictionary key."""
+    """
+    Sum arrays stored in a list of masks by a given dictionary key.
+    Compact masks are added into a full-frame array crop by crop.
+    Masks without the key, or without its crop, are skipped.
+    """
+
+    if len(masks) == 0 or not is_compact(masks[0]):
+        return sum(mask.get(key, 0) for mask in masks)
 
-    return sum(mask.get(key, 0) for mask in masks)
+    total = np.zeros(image_shape(masks[0]), dtype=int)
+    for mask in masks:
+        if key + '_crop' not in mask:
+            continue
+        crop, x0, y0 = mask_crop(mask, key)
+        total[y0:y0+crop.shape[0], x0:x0+crop.shape[1]] += crop
+    return total
 
 
 def multiply_masks(masks, key):
@@ -90,6 +102,23 @@ def read_config(config_file_path):
     return config
 
 
+def read_filters(filters_path):
+
+    """
+    Parse the filters in a config file, given a filepath, into a
+    dictionary of filter name to (min, max). Sections that hold
+    script settings rather than filters are skipped.
+    """
+
+    config = read_config(filters_path)
+    return {
+        section: (float(config.get(section, 'min')),
+                  float(config.get(section, 'max')))
+        for section in config.sections()
+        if section not in ('csparc_input', 'input', 'general', 'output')
+    }
+
+
 def factors(n):
 
     """
@@ -104,3 +133,245 @@ def factors(n):
             ([i, n // i] for i in range(1, int(n**0.5) + 1) if n % i == 0)
         )
     )
+
+
+# Masks can be held either with full-frame arrays under the 'segmentation'
+# and 'edge' keys, as returned by segment-anything, or in a compact form
+# with the same arrays cropped to a rectangle under 'segmentation_crop'
+# and 'edge_crop'. Compact masks record the rectangle under 'mask_box'
+# as [x0, y0, width, height] and the full-frame shape under 'image_shape'.
+
+
+def is_compact(mask):
+
+    """Check whether a mask holds cropped rather than full-frame arrays."""
+
+    return 'segmentation_crop' in mask
+
+
+def image_shape(mask):
+
+    """Return the full-frame shape of the micrograph a mask was found in."""
+
+    if is_compact(mask):
+        return tuple(mask['image_shape'])
+    return mask['segmentation'].shape
+
+
+def mask_crop(mask, key='segmentation'):
+
+    """
+    Return the array stored in a mask under a given key, cropped to the
+    mask's rectangle, along with the column and row of its top-left corner.
+    For full-frame masks, the whole array is returned at offset (0, 0).
+    """
+
+    if is_compact(mask):
+        x0, y0, _, _ = mask['mask_box']
+        return mask[key + '_crop'], x0, y0
+    return mask[key], 0, 0
+
+
+def set_mask_crop(mask, key, crop, mask_box=None):
+
+    """
+    Store an array returned by processing mask_crop() back on a mask,
+    in the same representation as the mask. A new rectangle can be
+    given in mask_box if the array was grown or shrunk.
+    """
+
+    if is_compact(mask):
+        if mask_box is not None:
+            mask['mask_box'] = [int(value) for value in mask_box]
+        mask[key + '_crop'] = crop
+    else:
+        mask[key] = crop
+
+
+def padded_mask_crop(mask, pad, key='segmentation'):
+
+    """
+    Return the array stored in a mask under a given key, cropped to the
+    mask's rectangle grown by pad pixels on every side (clipped to the
+    micrograph), along with that rectangle as [x0, y0, width, height].
+    """
+
+    crop, x0, y0 = mask_crop(mask, key)
+    if not is_compact(mask):
+        return crop, [0, 0, crop.shape[1], crop.shape[0]]
+
+    h_img, w_img = image_shape(mask)
+    h, w = crop.shape
+    top, left = min(pad, y0), min(pad, x0)
+    bottom = min(pad, h_img - y0 - h)
+    right = min(pad, w_img - x0 - w)
+    padded = np.pad(crop, ((top, bottom), (left, right)), 'constant')
+    return padded, [x0 - left, y0 - top, padded.shape[1], padded.shape[0]]
+
+
+def bounding_box(array):
+
+    """
+    Find the smallest rectangle containing every nonzero pixel of a
+    2D array, as [x0, y0, width, height]. Empty arrays give a 0x0 box.
+    """
+
+    rows = np.flatnonzero(array.any(axis=1))
+    cols = np.flatnonzero(array.any(axis=0))
+    if len(rows) == 0:
+        return [0, 0, 0, 0]
+    return [int(cols[0]), int(rows[0]),
+            int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1]
+
+
+def compact_mask(mask):
+
+    """
+    Convert a mask with full-frame arrays into a compact mask, cropping
+    'segmentation' (and 'edge', if present) to the rectangle that contains
+    the segmentation. Compact masks are returned unchanged.
+    """
+
+    if is_compact(mask):
+        return mask
+
+    x0, y0, w, h = bounding_box(mask['segmentation'])
+    compact = {
+        key: value for key, value in mask.items()
+        if key not in ('segmentation', 'edge')
+    }
+    compact['mask_box'] = [x0, y0, w, h]
+    compact['image_shape'] = mask['segmentation'].shape
+    for key in ('segmentation', 'edge'):
+        if key in mask:
+            compact[key + '_crop'] = mask[key][y0:y0+h, x0:x0+w].copy()
+    return compact
+
+
+def compact_rle_mask(mask):
+
+    """
+    Convert a mask returned by segment-anything with
+    output_mode='uncompressed_rle' into a compact mask, without
+    decoding the full-frame array.
+    """
+
+    rle = mask['segmentation']
+    h_img, w_img = rle['size']
+
+    # Runs alternate between background and mask, starting with background,
+    # over the pixels in column-major order
+    ends = np.cumsum(rle['counts'])
+    starts = ends - rle['counts']
+    starts, ends = starts[1::2], ends[1::2]
+    starts, ends = starts[ends > starts], ends[ends > starts]
+
+    compact = {key: value for key, value in mask.items()
+               if key != 'segmentation'}
+    compact['image_shape'] = (h_img, w_img)
+    if len(starts) == 0:
+        compact['mask_box'] = [0, 0, 0, 0]
+        compact['segmentation_crop'] = np.zeros((0, 0), dtype=bool)
+        return compact
+
+    # Decode only the columns that the runs cover
+    x0 = int(starts[0]) // h_img
+    x1 = (int(ends[-1]) - 1) // h_img + 1
+    changes = np.zeros((x1 - x0)*h_img + 1, dtype=np.int8)
+    np.add.at(changes, starts - x0*h_img, 1)
+    np.add.at(changes, ends - x0*h_img, -1)
+    columns = np.cumsum(changes[:-1]).astype(bool).reshape(x1 - x0, h_img).T
+
+    # Then trim the rows
+    _, y0, _, h = bounding_box(columns)
+    compact['mask_box'] = [x0, y0, x1 - x0, h]
+    compact['segmentation_crop'] = np.ascontiguousarray(columns[y0:y0+h])
+    return compact
+
+
+def full_mask(mask):
+
+    """
+    Convert a compact mask into a mask with full-frame arrays, the inverse
+    of compact_mask(). Full-frame masks are returned unchanged.
+    """
+
+    if not is_compact(mask):
+        return mask
+
+    full = {
+        key: value for key, value in mask.items()
+        if key not in ('mask_box', 'image_shape', 'segmentation_crop',
+                       'edge_crop')
+    }
+    for key in ('segmentation', 'edge'):
+        if key + '_crop' in mask:
+            full[key] = expand_mask(mask, key)
+    return full
+
+
+def expand_mask(mask, key='segmentation'):
+
+    """
+    Return the full-frame array stored in a mask under a given key,
+    materializing it from the crop if the mask is compact.
+    """
+
+    if not is_compact(mask):
+        return mask[key]
+
+    crop, x0, y0 = mask_crop(mask, key)
+    full = np.zeros(image_shape(mask), dtype=crop.dtype)
+    full[y0:y0+crop.shape[0], x0:x0+crop.shape[1]] = crop
+    return full
+
+
+def mask_rectangle(mask):
+
+    """
+    Return the rectangle of a mask as [x0, y0, width, height]: the
+    'mask_box' of a compact mask, or the bounding box of a full-frame one.
+    """
+
+    if is_compact(mask):
+        return list(mask['mask_box'])
+    return bounding_box(mask['segmentation'])
+
+
+def mask_intersection(mask, other):
+
+    """Count the pixels two masks of a micrograph share."""
+
+    a, ax, ay = mask_crop(mask)
+    b, bx, by = mask_crop(other)
+    x0, y0 = max(ax, bx), max(ay, by)
+    x1 = min(ax + a.shape[1], bx + b.shape[1])
+    y1 = min(ay + a.shape[0], by + b.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return 0
+    return int(np.count_nonzero(
+        a[y0-ay:y1-ay, x0-ax:x1-ax] & b[y0-by:y1-by, x0-bx:x1-bx]
+    ))
+
+
+def union_masks(masks):
+
+    """
+    Merge compact masks of a micrograph into one compact mask covering
+    the pixels of all of them. Other keys are taken from the first mask,
+    with 'area' and 'bbox' recomputed.
+    """
+
+    boxes = np.array([mask['mask_box'] for mask in masks])
+    x0, y0 = boxes[:, :2].min(axis=0)
+    x1, y1 = (boxes[:, :2] + boxes[:, 2:]).max(axis=0)
+    union = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for mask, (x, y, w, h) in zip(masks, boxes):
+        union[y-y0:y-y0+h, x-x0:x-x0+w] |= mask['segmentation_crop']
+
+    merged = dict(masks[0])
+    merged['mask_box'] = [int(x0), int(y0), int(x1 - x0), int(y1 - y0)]
+    merged['segmentation_crop'] = union
+    merged['area'] = int(union.sum())
+    merged['bbox'] = list(merged['mask_box'])
+    return merged
@@ -0,0 +1,164 @@
+# Fingerprints of the inputs and parameters that produced each output file,
+# so that interrupted or re-parameterized runs only recompute what changed,
+# and a run manifest summarizing what each run did.
+
+from vesicle_picker import external_import
+import glob
+import hashlib
+import json
+import os
+
+
+def fingerprint(value):
+
+    """Hash any JSON-serializable value (NumPy values included)."""
+
+    encoded = json.dumps(
+        value, sort_keys=True,
+        default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)
+    )
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+
+def section_fingerprints(parameters, sections, ignore=None):
+
+    """
+    Fingerprint each of the given sections of a parsed parameters file.
+
+    Arguments:
+    parameters (ConfigParser): The parsed parameters file.
+    sections (list): The names of the sections that affect an output.
+    Sections missing from the file are fingerprinted as empty.
+    ignore (dict): Section name to a list of options that do not
+    affect the output (e.g. the device the model runs on).
+
+    Outputs:
+    fingerprints (dict): Section name to its fingerprint.
+    """
+
+    ignore = ignore or {}
+    return {
+        section: fingerprint({
+            option: value
+            for option, value in (
+                parameters.items(section)
+                if parameters.has_section(section) else []
+            )
+            if option not in ignore.get(section, [])
+        })
+        for section in sections
+    }
+
+
+def micrograph_fingerprint(micrograph):
+
+    """
+    Fingerprint a cryosparc micrograph by its UID, path, shape and pixel
+    size. cryoSPARC never rewrites a micrograph in place, so these identify
+    its content without having to download it.
+    """
+
+    return fingerprint([
+        micrograph['uid'],
+        micrograph['micrograph_blob/path'],
+        micrograph['micrograph_blob/shape'],
+        micrograph['micrograph_blob/psize_A'],
+    ])
+
+
+def read_fingerprint(filename):
+
+    """
+    Read the fingerprint recorded in a file written by
+    export_masks_to_disk(), or None if the file does not exist
+    or was written without a fingerprint.
+    """
+
+    if not os.path.isfile(filename):
+        return None
+    return external_import.load_masks_header(filename)['fingerprint']
+
+
+def stale_parts(recorded, current):
+
+    """
+    Compare a recorded fingerprint with the current one.
+
+    Arguments:
+    recorded (dict): The fingerprint recorded in an existing output, with
+    an 'input' fingerprint and a 'sections' dictionary, or None.
+    current (dict): The fingerprint the output would have if recomputed.
+
+    Outputs:
+    stale (set): 'input' if the input changed, plus the name of each
+    section that changed, was added or was removed. Empty if the output
+    is up to date, and {'input'} if there is no recorded fingerprint.
+    """
+
+    if recorded is None:
+        return {'input'}
+
+    stale = set()
+    if recorded.get('input') != current['input']:
+        stale.add('input')
+    recorded_sections = recorded.get('sections', {})
+    for section in set(current['sections']) | set(recorded_sections):
+        if recorded_sections.get(section) != current['sections'].get(section):
+            stale.add(section)
+    return stale
+
+
+def update_manifest(filename, **entries):
+
+    """
+    Update the run manifest at filename, a JSON file, with the given
+    entries, creating it if needed. Entries replace any existing
+    entries of the same name.
+    """
+
+    manifest = {}
+    if os.path.isfile(filename):
+        with open(filename) as file:
+            manifest = json.load(file)
+    manifest.update(entries)
+
+    # Write to a temporary file first, so a crash never leaves
+    # a half-written manifest behind
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(
+            manifest, file, indent=2, sort_keys=True,
+            default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)
+        )
+    os.replace(filename + '.tmp', filename)
+
+
+def manifest_filename(directory, worker_name=None):
+
+    """
+    Return the path of the run manifest in an output directory. Sharded
+    workers each keep their own manifest, named after the worker.
+    """
+
+    if worker_name is None:
+        return os.path.join(directory, 'manifest.json')
+    return os.path.join(directory, f'manifest_{worker_name}.json')
+
+
+def recorded_entry(directory, key, worker_name=None):
+
+    """
+    Return an entry recorded in the run manifests of an output directory,
+    or None if no manifest records it. This process's own manifest is
+    read first, then those of any other workers.
+    """
+
+    own = manifest_filename(directory, worker_name)
+    others = sorted(glob.glob(os.path.join(directory, 'manifest*.json')))
+    for filename in [own] + [name for name in others if name != own]:
+        if not os.path.isfile(filename):
+            continue
+        with open(filename) as file:
+            entry = json.load(file).get(key)
+        if entry is not None:
+            return entry
+    return None
@@ -0,0 +1,148 @@
+# A columnar (struct-of-arrays) container for the masks of one micrograph
+
+import numpy as np
+import numbers
+import pandas as pd
+
+
+class MaskTable:
+
+    """
+    Holds the scalar statistics of a list of masks as one NumPy column per
+    key (e.g. 'area', 'area_asq', 'roundness', 'average_radius',
+    'intensity'), along with the bounding boxes as an (n, 4) 'bbox' column.
+    The mask dictionaries themselves, which carry the (compact) segmentation
+    arrays, are kept alongside the columns in the same order.
+
+    Filtering evaluates all filters as one vectorized boolean expression
+    over the columns, and statistics are returned as DataFrames that view
+    the columns without copying them.
+    """
+
+    def __init__(self, columns, masks):
+
+        """
+        Arguments:
+        columns (dict): Column name to a NumPy array of one value per mask.
+        masks (list): The mask dictionaries, in the same order as the columns.
+        """
+
+        self.columns = columns
+        self.masks = masks
+
+    @classmethod
+    def from_masks(cls, masks):
+
+        """
+        Build a MaskTable from a list of mask dictionaries. Every key that
+        holds a number in all of the masks becomes a column.
+
+        Arguments:
+        masks (list): Masks found by segmentation of a micrograph, with or
+        without postprocessing, either full-frame or compact.
+
+        Outputs:
+        table (MaskTable): The masks, in columnar form.
+        """
+
+        keys = [
+            key for key, value in (masks[0].items() if masks else [])
+            if isinstance(value, numbers.Number)
+            and all(isinstance(mask.get(key), numbers.Number)
+                    for mask in masks)
+        ]
+        columns = {
+            key: np.array([mask[key] for mask in masks]) for key in keys
+        }
+        if masks and all('bbox' in mask for mask in masks):
+            columns['bbox'] = np.array(
+                [mask['bbox'] for mask in masks], dtype=float
+            )
+        return cls(columns, list(masks))
+
+    def to_masks(self):
+
+        """
+        Return the masks as a list of dictionaries, with the column values
+        written back onto each mask. The arrays of each mask are shared,
+        not copied.
+        """
+
+        masks = [dict(mask) for mask in self.masks]
+        for key, column in self.columns.items():
+            values = column.tolist()
+            for mask, value in zip(masks, values):
+                mask[key] = value
+        return masks
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def select(self, keep):
+
+        """
+        Return a new MaskTable holding only the masks selected by keep,
+        a boolean array or an array of indices.
+        """
+
+        keep = np.asarray(keep)
+        indices = np.flatnonzero(keep) if keep.dtype == bool else keep
+        return MaskTable(
+            {key: column[indices] for key, column in self.columns.items()},
+            [self.masks[i] for i in indices]
+        )
+
+    def passes_filters(self, filters):
+
+        """
+        Evaluate filters over the columns.
+
+        Arguments:
+        filters (dict): Column name to a (min, max) tuple of accepted
+        values, as returned by helpers.read_filters().
+
+        Outputs:
+        keep (np.ndarray): A boolean array, True for masks whose values
+        lie within every filter's range.
+        """
+
+        keep = np.ones(len(self), dtype=bool)
+
+        # A table without masks has no columns to filter on
+        if len(self) == 0:
+            return keep
+
+        for key, (minimum, maximum) in filters.items():
+            keep &= (self.columns[key] >= minimum)
+            keep &= (self.columns[key] <= maximum)
+        return keep
+
+    def apply_filters(self, filters):
+
+        """Return a new MaskTable holding only the masks that pass filters."""
+
+        return self.select(self.passes_filters(filters))
+
+    def statistics(self, keys=None):
+
+        """
+        Return the given columns (all one-dimensional columns by default)
+        as a pandas DataFrame that views the column arrays without copying.
+        """
+
+        if keys is None:
+            keys = [key for key, column in self.columns.items()
+                    if column.ndim == 1]
+
+        # A table without masks has no columns, so return empty ones
+        if len(self) == 0:
+            return pd.DataFrame({key: np.zeros(0) for key in keys})
+
+        return pd.DataFrame({key: self.columns[key] for key in keys},
+                            copy=False)
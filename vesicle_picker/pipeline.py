@@ -0,0 +1,197 @@
+# A staged producer/consumer pipeline, so that downloading, preprocessing,
+# segmentation and export of different micrographs can overlap.
+
+import queue
+import threading
+import time
+
+# Marks the end of the items flowing into a stage
+_DONE = object()
+
+
+class Stage:
+
+    """
+    One stage of a pipeline: a function applied to every item by a pool
+    of worker threads. The function returns the item to pass on to the
+    next stage, or None to drop it. A stage with a batch_size above one
+    instead applies its function to lists of up to batch_size items,
+    and the function returns a list with the next item, or None, for each.
+    """
+
+    def __init__(self, name, function, workers=1, batch_size=1):
+
+        """
+        Arguments:
+        name (str): The name of the stage in the utilisation report.
+        function (callable): Takes one item and returns the next, or None.
+        workers (int): The number of threads running the function.
+        batch_size (int): The number of items the function takes at once,
+        or 1 to apply it to single items.
+        """
+
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+
+        # Statistics for the utilisation report
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.lock = threading.Lock()
+
+
+def run_pipeline(items, stages, queue_depth=2):
+
+    """
+    Pass every item through a list of stages, each running on its own pool
+    of threads and connected to the next by a bounded queue. Upstream
+    stages run ahead of downstream ones by at most queue_depth items.
+    Threads suit this work because downloads wait on the network and
+    OpenCV and PyTorch release the GIL while they compute.
+
+    Arguments:
+    items (iterable): The inputs to the first stage.
+    stages (list): The Stage objects, in order.
+    queue_depth (int): The capacity of the queue in front of each stage.
+
+    Outputs:
+    report (list): One dictionary per stage, as described in
+    utilisation_report().
+    """
+
+    queues = [queue.Queue(maxsize=queue_depth) for _ in stages]
+    remaining = [stage.workers for stage in stages]
+    errors = []
+
+    def worker(index):
+        stage = stages[index]
+        while True:
+            item = queues[index].get()
+
+            # Gather a batch, cut short by the end of the items
+            if stage.batch_size > 1 and item is not _DONE:
+                batch = [item]
+                while len(batch) < stage.batch_size:
+                    item = queues[index].get()
+                    if item is _DONE:
+                        break
+                    batch.append(item)
+                process(index, batch)
+                if item is not _DONE:
+                    continue
+
+            # Once every worker of this stage is done, close the next stage
+            if item is _DONE:
+                with stage.lock:
+                    remaining[index] -= 1
+                    last = remaining[index] == 0
+                if last and index + 1 < len(stages):
+                    for _ in range(stages[index + 1].workers):
+                        queues[index + 1].put(_DONE)
+                return
+
+            process(index, [item])
+
+    def process(index, batch):
+        stage = stages[index]
+
+        # After an error, keep draining so that no thread blocks
+        if errors:
+            return
+
+        start = time.perf_counter()
+        try:
+            if stage.batch_size > 1:
+                results = stage.function(batch)
+            else:
+                results = [stage.function(batch[0])]
+        except Exception as error:
+            errors.append(error)
+            return
+        finished = time.perf_counter()
+
+        if index + 1 < len(stages):
+            for result in results:
+                if result is not None:
+                    queues[index + 1].put(result)
+
+        with stage.lock:
+            stage.items += len(batch)
+            stage.busy += finished - start
+            stage.blocked += time.perf_counter() - finished
+
+    threads = [
+        threading.Thread(target=worker, args=(index,), daemon=True)
+        for index, stage in enumerate(stages)
+        for _ in range(stage.workers)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    # Feed the first stage, stopping early if a stage has failed
+    for item in items:
+        if errors:
+            break
+        queues[0].put(item)
+    for _ in range(stages[0].workers):
+        queues[0].put(_DONE)
+
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+    return utilisation_report(stages, wall)
+
+
+def utilisation_report(stages, wall):
+
+    """
+    Summarize how busy each stage of a finished pipeline was.
+
+    Arguments:
+    stages (list): The Stage objects of the pipeline.
+    wall (float): The wall-clock runtime of the pipeline in seconds.
+
+    Outputs:
+    report (list): One dictionary per stage with its 'name', 'workers',
+    number of 'items' processed, total 'busy' seconds, seconds 'blocked'
+    waiting for room in the next queue, and 'utilisation', the fraction
+    of the stage's worker time spent busy. The busiest stage is the
+    bottleneck of the pipeline.
+    """
+
+    return [
+        {
+            'name': stage.name,
+            'workers': stage.workers,
+            'items': stage.items,
+            'busy': stage.busy,
+            'blocked': stage.blocked,
+            'utilisation': stage.busy / (wall * stage.workers) if wall else 0,
+        }
+        for stage in stages
+    ]
+
+
+def format_report(report):
+
+    """Format a utilisation report as a table, naming the bottleneck."""
+
+    lines = [f"{'stage':>14} {'workers':>8} {'items':>6} {'busy (s)':>9} "
+             f"{'blocked (s)':>12} {'utilisation':>12}"]
+    for stage in report:
+        lines.append(
+            f"{stage['name']:>14} {stage['workers']:>8} {stage['items']:>6} "
+            f"{stage['busy']:>9.1f} {stage['blocked']:>12.1f} "
+            f"{stage['utilisation']:>11.0%}"
+        )
+    bottleneck = max(report, key=lambda stage: stage['utilisation'])
+    lines.append(f"Bottleneck: {bottleneck['name']}")
+    return "\n".join(lines)
@@ -1,9 +1,8 @@
-from vesicle_picker import helpers
+from vesicle_picker import helpers, spatial_index
+from vesicle_picker.mask_table import MaskTable
 import numpy as np
 import copy
 import cv2
-import configparser
-import pandas as pd
 
 
 def find_mask_intensity(input_mask, preprocessed_micrograph):
@@ -27,7 +26,10 @@ def find_mask_intensity(input_mask, preprocessed_micrograph):
     mask = copy.deepcopy(input_mask)
 
     # Find the average pixel value within the mask and assign it to a new key
-    mask['intensity'] = np.mean(preprocessed_micrograph[mask['segmentation']])
+    crop, x0, y0 = helpers.mask_crop(mask)
+    mask['intensity'] = np.mean(
+        preprocessed_micrograph[y0:y0+crop.shape[0], x0:x0+crop.shape[1]][crop]
+    )
 
     # Return the mask
     return mask
@@ -45,19 +47,21 @@ def find_contour(input_mask):
 
     Outputs:
     mask (dictionary): The input mask with two new keys added
-    ('contours' and 'edge_mask') containing the openCV contour object
+    ('contours' and 'edge') containing the openCV contour object
     and a new segmentation array of just edges, respectively.
+    Compact masks get their edges as 'edge_crop' instead of 'edge'.
     """
 
     # Make a copy of the input mask
     mask = copy.deepcopy(input_mask)
 
     # Isolate the 2D image array from the mask dictionary
-    mask_array = mask['segmentation']
+    mask_array, x0, y0 = helpers.mask_crop(mask)
 
-    # Find the contours with openCV
+    # Find the contours with openCV, in full-frame coordinates
     contours, _ = cv2.findContours(mask_array.astype(np.uint8)*255,
-                                   cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+                                   cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE,
+                                   offset=(x0, y0))
 
     # Create a blank image with the same size and type as binary_image
     contour_image = (
@@ -67,10 +71,11 @@ def find_contour(input_mask):
     )
 
     # Draw the contour onto a new 2D array
-    cv2.drawContours(contour_image, contours, -1, (255, 255, 255), 1)
+    cv2.drawContours(contour_image, contours, -1, (255, 255, 255), 1,
+                     offset=(-x0, -y0))
 
     # Assign the contour object to a new slot in the masks dictionary
-    mask['edge'] = contour_image.astype(bool)
+    helpers.set_mask_crop(mask, 'edge', contour_image.astype(bool))
     mask['contours'] = contours
 
     if len(mask['contours']) == 0:
@@ -200,6 +205,281 @@ def postprocess_masks(input_masks, postprocess_list,
     return masks
 
 
+def _measure_intensity(mask, preprocessed_micrograph):
+
+    """Add the mean pixel value within a mask as 'intensity'."""
+
+    crop, x0, y0 = helpers.mask_crop(mask)
+    mask['intensity'] = np.mean(
+        preprocessed_micrograph[y0:y0+crop.shape[0],
+                                x0:x0+crop.shape[1]][crop]
+    )
+    return True
+
+
+def _measure_contour(mask):
+
+    """
+    Add the contours of a mask in full-frame coordinates as 'contours',
+    the edge drawn in its crop, and its 'roundness'. Returns False if
+    the mask has no contour.
+    """
+
+    crop, x0, y0 = helpers.mask_crop(mask)
+    crop_uint8 = crop.astype(np.uint8)
+    contours, _ = cv2.findContours(crop_uint8,
+                                   cv2.RETR_EXTERNAL,
+                                   cv2.CHAIN_APPROX_NONE,
+                                   offset=(x0, y0))
+    if len(contours) == 0:
+        return False
+    crop_uint8[:] = 0
+    cv2.drawContours(crop_uint8, contours, -1, 1, 1, offset=(-x0, -y0))
+    helpers.set_mask_crop(mask, 'edge', crop_uint8.view(bool))
+    mask['contours'] = contours
+
+    # Roundness from the perimeter of the first contour
+    perimeter = cv2.arcLength(contours[0], closed=True)
+    mask['roundness'] = (
+        (4*np.pi*mask['area'])/(perimeter**2) if perimeter > 0 else 0
+    )
+    return True
+
+
+def _measure_ellipse(mask):
+
+    """
+    Add the parameters of the ellipse fitted to a mask's first contour,
+    which needs at least five contour points.
+    """
+
+    if len(mask['contours'][0]) >= 5:
+        _, (semi_minor_axis, semi_major_axis), _ = (
+            cv2.fitEllipse(mask['contours'][0])
+        )
+    else:
+        semi_minor_axis, semi_major_axis = 0, 0
+    mask['semi_minor'] = semi_minor_axis/2
+    mask['semi_major'] = semi_major_axis/2
+    mask['average_radius'] = np.sqrt(semi_major_axis*semi_minor_axis)/2
+    mask['radii_ratio'] = (
+        semi_minor_axis/semi_major_axis if semi_major_axis > 0 else 0
+    )
+    return True
+
+
+# The stages of measure_masks(), cheapest first, and the keys each adds.
+# Keys not listed here (e.g. 'area', 'area_asq', 'predicted_iou')
+# come with the masks from segmentation at no cost.
+METRIC_STAGES = {
+    'intensity': ['intensity'],
+    'contour': ['roundness'],
+    'ellipse': ['semi_minor', 'semi_major', 'average_radius', 'radii_ratio'],
+}
+
+
+def measure_masks(input_masks, preprocessed_micrograph=None):
+
+    """
+    Takes a list of untransformed masks and computes the keys added by
+    find_mask_intensity(), find_contour(), find_roundness() and
+    fit_ellipse() in a single pass over each mask's crop. Unlike
+    postprocess_masks(), no arrays are copied: each returned mask is a
+    new dictionary sharing the arrays of its input mask.
+
+    Arguments:
+    input_masks (list): Masks found by segmentation of a
+    micrograph with generate_masks(), either full-frame or compact.
+    preprocessed_micrograph (np.ndarray): The preprocessed micrograph
+    used to generate the masks. If None, the 'intensity' key is skipped.
+
+    Outputs:
+    measured_masks (list): List of mask dictionaries (masks) with the
+    'intensity', 'edge' (or 'edge_crop'), 'contours', 'roundness',
+    'semi_minor', 'semi_major', 'average_radius' and 'radii_ratio' keys
+    added. Masks without a contour are dropped.
+    """
+
+    measured_masks = []
+    for input_mask in input_masks:
+        mask = dict(input_mask)
+        if preprocessed_micrograph is not None:
+            _measure_intensity(mask, preprocessed_micrograph)
+        if _measure_contour(mask):
+            _measure_ellipse(mask)
+            measured_masks.append(mask)
+
+    return measured_masks
+
+
+def plan_metrics(filters):
+
+    """
+    Work out which stages of measure_masks() are needed to evaluate
+    a set of filters.
+
+    Arguments:
+    filters (dict): Filter name to (min, max), as returned
+    by helpers.read_filters().
+
+    Outputs:
+    stages (list): The names of the needed stages in METRIC_STAGES,
+    cheapest first. The ellipse stage implies the contour stage.
+    """
+
+    stages = [
+        stage for stage, keys in METRIC_STAGES.items()
+        if any(key in filters for key in keys)
+    ]
+    if 'ellipse' in stages and 'contour' not in stages:
+        stages.insert(stages.index('ellipse'), 'contour')
+    return stages
+
+
+def measure_and_filter_masks(input_masks, filters,
+                             preprocessed_micrograph=None):
+
+    """
+    Takes a list of untransformed masks and computes only the metrics
+    that a set of filters needs, cheapest first, dropping the masks that
+    fail a filter as soon as its metric is known, so that expensive
+    metrics are only computed for the masks that survive the cheap ones.
+
+    Arguments:
+    input_masks (list): Masks found by segmentation of a
+    micrograph with generate_masks(), either full-frame or compact.
+    filters (dict): Filter name to (min, max), as returned
+    by helpers.read_filters().
+    preprocessed_micrograph (np.ndarray): The preprocessed micrograph
+    used to generate the masks, needed for intensity filters.
+
+    Outputs:
+    filtered_masks (list): List of mask dictionaries (masks) that pass
+    every filter, with the keys of the stages that were run added.
+    report (dict): The number of masks in and out, and the number of
+    metric stage evaluations run and skipped compared to measure_masks().
+    """
+
+    masks = [dict(mask) for mask in input_masks]
+    stages = plan_metrics(filters)
+    measure = {
+        'intensity': lambda mask: _measure_intensity(
+            mask, preprocessed_micrograph
+        ),
+        'contour': _measure_contour,
+        'ellipse': _measure_ellipse,
+    }
+
+    # Keys the masks come with, and the filters that can run on them
+    available = [key for key in filters
+                 if not any(key in keys for keys in METRIC_STAGES.values())]
+
+    evaluated = 0
+    for stage in [None] + stages:
+        if len(masks) == 0:
+            break
+        if stage is not None:
+            evaluated += len(masks)
+            masks = [mask for mask in masks if measure[stage](mask)]
+            available += METRIC_STAGES[stage]
+
+        # Drop the masks that fail the filters known so far
+        table = MaskTable.from_masks(masks)
+        masks = table.apply_filters({
+            key: filters[key] for key in available if key in filters
+        }).masks
+
+    report = {
+        'masks': len(input_masks),
+        'kept': len(masks),
+        'evaluated': evaluated,
+        'skipped': len(input_masks)*len(METRIC_STAGES) - evaluated,
+    }
+    return masks, report
+
+
+# The policies deduplicate_masks() can keep one of a set of duplicate
+# masks by, each the key of the mask to keep the largest value of
+KEEP_POLICIES = {
+    'largest': 'area',
+    'roundest': 'roundness',
+    'predicted_iou': 'predicted_iou',
+}
+
+
+def deduplicate_masks(input_masks, keep='predicted_iou', iou_thresh=0.8,
+                      containment_thresh=0.9):
+
+    """
+    Takes a list of masks and drops duplicate masks of the same vesicle,
+    such as the near-identical or nested masks that segment-anything finds
+    in overlapping crops. Pairs of masks whose rectangles overlap are
+    found with a spatial index, and only those are compared pixel by
+    pixel. Masks are kept in order of the keep policy, and a mask is
+    dropped if it duplicates a mask already kept.
+
+    Arguments:
+    input_masks (list): Masks found by segmentation of a
+    micrograph with generate_masks(), either full-frame or compact.
+    keep (str): Which of a set of duplicates to keep: the 'largest', the
+    'roundest' (computing the roundness of masks without it), or the one
+    with the highest 'predicted_iou'.
+    iou_thresh (float): The intersection over union above which two
+    masks are duplicates.
+    containment_thresh (float): The fraction of the smaller mask inside
+    the larger above which two masks are duplicates.
+
+    Outputs:
+    deduplicated_masks (list): The masks that were kept, in their
+    original order.
+    report (dict): The number of masks in and out, and the number of
+    pairs of masks compared pixel by pixel.
+    """
+
+    if keep not in KEEP_POLICIES:
+        raise Exception(
+            "Please input a valid keep policy "
+            f"({', '.join(KEEP_POLICIES)})."
+        )
+
+    masks = list(input_masks)
+    if keep == 'roundest':
+        masks = [dict(mask) for mask in masks]
+        for mask in masks:
+            if 'roundness' not in mask and not _measure_contour(mask):
+                mask['roundness'] = 0
+
+    key = KEEP_POLICIES[keep]
+    order = sorted(range(len(masks)),
+                   key=lambda index: masks[index].get(key, 0), reverse=True)
+    boxes = [helpers.mask_rectangle(mask) for mask in masks]
+
+    grid = spatial_index.BoxGrid(spatial_index.box_cell_size(boxes))
+    kept, compared = [], 0
+    for index in order:
+        mask = masks[index]
+        duplicate = False
+        for other in grid.query(boxes[index]):
+            compared += 1
+            shared = helpers.mask_intersection(mask, masks[other])
+            smaller = min(mask['area'], masks[other]['area'])
+            union = mask['area'] + masks[other]['area'] - shared
+            if (shared >= iou_thresh * union
+                    or shared >= containment_thresh * smaller):
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(index)
+            grid.insert(index, boxes[index])
+
+    report = {
+        'masks': len(masks),
+        'kept': len(kept),
+        'compared': compared,
+    }
+    return [masks[index] for index in sorted(kept)], report
+
+
 def apply_filters(postprocessed_masks, filters_path):
 
     """
@@ -218,27 +498,12 @@ def apply_filters(postprocessed_masks, filters_path):
     filters specified in the INI file at filters_path.
     """
 
-    config = configparser.ConfigParser()
-    config.read(filters_path)
-
-    # Make a copy of postprocessed masks
-    filtered_masks = copy.deepcopy(postprocessed_masks)
-
-    # For each section heading in the config file
-    for filter in config.sections():
-        if filter in ('csparc_input', 'input', 'general', 'output'):
-            continue
-        else:
-            # Set filtered masks equal to a filtered mask list
-            # with list comprehension
-            filtered_masks = [
-                mask for mask in filtered_masks
-                if mask[filter] >= float(config.get(filter, 'min'))
-                and mask[filter] <= float(config.get(filter, 'max'))
-            ]
+    # Evaluate all filters at once over the columns of a MaskTable
+    table = MaskTable.from_masks(postprocessed_masks)
+    filters = helpers.read_filters(filters_path)
 
     # Return the filtered set of masks
-    return filtered_masks
+    return table.apply_filters(filters).masks
 
 
 def extract_statistics(postprocessed_masks, filters_path):
@@ -263,46 +528,88 @@ def extract_statistics(postprocessed_masks, filters_path):
     and the values for each mask as rows with the filters applied.
     """
 
-    config = configparser.ConfigParser()
-    config.read(filters_path)
+    table = MaskTable.from_masks(postprocessed_masks)
+    filters = helpers.read_filters(filters_path)
 
     # Instead of filtering off masks that don't meet the criteria,
     # use that to generate a filtered and unfiltered Pandas dataset
-    unfiltered_masks = copy.deepcopy(postprocessed_masks)
-    filtered_masks = apply_filters(copy.deepcopy(unfiltered_masks),
-                                   filters_path)
-
-    # Extract stats from unfiltered dataset
-    unfiltered_stats = {
-        filter: [
-            unfiltered_mask[filter] for unfiltered_mask in unfiltered_masks
-        ]
-        for filter in config.sections()
-    }
+    unfiltered_stats = table.statistics(list(filters))
+    filtered_stats = table.apply_filters(filters).statistics(list(filters))
 
-    # Turn it into a pandas dataset
-    unfiltered_stats = pd.DataFrame(unfiltered_stats)
+    # Return unfiltered stats
+    return unfiltered_stats, filtered_stats
 
-    # Extract stats from filtered dataset
-    filtered_stats = {
-        filter: [
-            filtered_mask[filter] for filtered_mask in filtered_masks
-        ]
-        for filter in config.sections()
-    }
 
-    # Turn it into a pandas dataset
-    filtered_stats = pd.DataFrame(filtered_stats)
+def offset_masks(masks, offset, psize, downsample):
 
-    # Return unfiltered stats
-    return unfiltered_stats, filtered_stats
+    """
+    Takes a list of masks and grows (dilates) or shrinks (erodes) each one
+    by a Euclidean distance in Angstrom, with one distance transform of
+    each mask's crop, thresholded at the offset, so any distance costs the
+    same and the offset is round rather than square. Distances come from
+    OpenCV's 5x5 approximation of the Euclidean distance, which is within
+    about 2% of the exact distance and over twice as fast. The edge of
+    each offset mask is its outer contour drawn with OpenCV, as by
+    find_contour(), so edge picks match those of a mask offset by any
+    other means. Offsets shorter than a pixel are rounded up to one
+    pixel, since neighbouring pixel centres are a pixel apart, and longer
+    offsets are thresholded at their exact (sub-pixel) distance.
+
+    Arguments:
+    masks (list): List of mask dictionaries (masks) with additional
+    keys added from postprocessing steps.
+    offset (float): The distance in Angstrom, positive to dilate and
+    negative to erode.
+    psize (float): The pixel size of the original micrograph (Angstrom/pixel).
+    downsample (int): The downsampling factor applied when generating masks.
+    """
+
+    radius = abs(offset) / (psize * downsample)
+    if offset != 0:
+        radius = max(radius, 1)
+    pad = int(np.ceil(radius)) if offset > 0 else 1
+    for mask in masks:
+        # Grow compact masks' crops so the dilation has room, or pad them
+        # with background, so that a mask filling its crop still erodes
+        crop, mask_box = helpers.padded_mask_crop(mask, pad)
+
+        if offset > 0:
+            # Distance from each background pixel to the mask
+            distance = cv2.distanceTransform(
+                np.logical_not(crop).astype(np.uint8),
+                cv2.DIST_L2, cv2.DIST_MASK_5
+            )
+            segmentation = distance <= radius
+        else:
+            # Distance from each mask pixel to the background. Pixels
+            # beyond the edges of the micrograph do not count as
+            # background, so masks do not erode from there.
+            distance = cv2.distanceTransform(
+                crop.astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_5
+            )
+            segmentation = distance > radius
+
+        helpers.set_mask_crop(mask, 'segmentation', segmentation, mask_box)
+
+        # Draw the edge along the contours of the offset mask, which
+        # replace the contours of the mask before the offset
+        crop, x0, y0 = helpers.mask_crop(mask)
+        contours, _ = cv2.findContours(crop.astype(np.uint8),
+                                       cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_NONE,
+                                       offset=(x0, y0))
+        edge = np.zeros(crop.shape, dtype=np.uint8)
+        cv2.drawContours(edge, contours, -1, 1, 1, offset=(-x0, -y0))
+        helpers.set_mask_crop(mask, 'edge', edge.astype(bool))
+        mask['contours'] = contours
+    return masks
 
 
 def dilate_masks(masks, dilation, psize, downsample):
 
     """
-    Takes a list of masks and dilates each one by an approximate
-    radial distance in Angstrom.
+    Takes a list of masks and dilates each one by a radial distance
+    in Angstrom, with offset_masks().
 
     Arguments:
     masks (list): List of mask dictionaries (masks) with additional
@@ -312,21 +619,14 @@ def dilate_masks(masks, dilation, psize, downsample):
     downsample (int): The downsampling factor applied when generating masks.
     """
 
-    for mask in masks:
-        mask['segmentation'] = cv2.dilate(
-            mask['segmentation'].astype(np.uint8),
-            np.ones((3, 3), np.uint8),
-            iterations=int(np.round(dilation / (psize * downsample)))
-        ).astype(bool)
-        mask['edge'] = find_contour(mask)['edge']
-    return masks
+    return offset_masks(masks, dilation, psize, downsample)
 
 
 def erode_masks(masks, erosion, psize, downsample):
 
     """
-    Takes a list of masks and erodes each one by an approximate
-    radial distance in Angstrom.
+    Takes a list of masks and erodes each one by a radial distance
+    in Angstrom, with offset_masks().
 
     Arguments:
     masks (list): List of mask dictionaries (masks) with additional
@@ -336,14 +636,97 @@ def erode_masks(masks, erosion, psize, downsample):
     downsample (int): The downsampling factor applied when generating masks.
     """
 
-    for mask in masks:
-        mask['segmentation'] = cv2.erode(
-            mask['segmentation'].astype(np.uint8),
-            np.ones((3, 3), np.uint8),
-            iterations=int(np.round(erosion / (psize * downsample)))
-        ).astype(bool)
-        mask['edge'] = find_contour(mask)['edge']
-    return masks
+    return offset_masks(masks, -erosion, psize, downsample)
+
+
+def mask_contours(mask):
+
+    """
+    Return the contours of a mask in full-frame coordinates, from its
+    'contours' key if present, or else found in its crop.
+    """
+
+    if 'contours' in mask:
+        return mask['contours']
+    crop, x0, y0 = helpers.mask_crop(mask)
+    contours, _ = cv2.findContours(crop.astype(np.uint8),
+                                   cv2.RETR_EXTERNAL,
+                                   cv2.CHAIN_APPROX_NONE,
+                                   offset=(x0, y0))
+    return contours
+
+
+def contour_picks(masks, psize, downsample, spacing):
+
+    """
+    Takes masks and returns particle picks along their contours, spaced a
+    fixed distance apart along each contour, starting at its first point.
+    All contours are sampled at once, by interpolating between their
+    vertices at the cumulative arc length of each pick, without drawing
+    them into an image.
+
+    Arguments:
+    masks (list): Masks found by segmentation of a micrograph, with or
+    without postprocessing, either full-frame or compact. Their
+    'contours' are used if present, as set by find_contour().
+    psize (float): The pixel size of the original micrograph (Angstrom/pixel).
+    downsample (int): The downsampling factor applied when generating masks.
+    spacing (float): The distance between picks along a contour,
+    in Angstrom.
+
+    Outputs:
+    pick_indices (list): A list of numpy arrays containing the
+    0th axis and 1st axis (sub-pixel) coordinates of particle pick
+    locations, respectively, upsampled to map back onto the
+    full-resolution micrograph, in order along each contour.
+    """
+
+    contours = [
+        contour.reshape(-1, 2)
+        for mask in masks for contour in mask_contours(mask)
+        if len(contour) > 0
+    ]
+    if len(contours) == 0:
+        return (np.zeros(0), np.zeros(0))
+
+    # Convert the spacing to pixels of the downsampled micrograph
+    spacing = spacing / (psize * downsample)
+
+    # Join all contours, pairing each vertex with the next one along its
+    # own (closed) contour
+    points = np.concatenate(contours).astype(np.float64)
+    lengths = np.array([len(contour) for contour in contours])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    following = np.arange(1, len(points) + 1)
+    following[ends - 1] = starts
+    segments = points[following] - points
+
+    # Cumulative arc length at the end of each segment, and the
+    # perimeter of each contour
+    arc_ends = np.cumsum(np.hypot(segments[:, 0], segments[:, 1]))
+    arc_starts = np.concatenate([[0], arc_ends[:-1]])
+    perimeters = arc_ends[ends - 1] - arc_starts[starts]
+
+    # Place every pick by its arc length from the start of all contours,
+    # with at least one pick on every contour
+    n_picks = np.maximum(np.ceil(perimeters / spacing - 1e-9), 1).astype(int)
+    contour_index = np.repeat(np.arange(len(contours)), n_picks)
+    step = np.arange(n_picks.sum()) - np.repeat(np.cumsum(n_picks) - n_picks,
+                                                n_picks)
+    arc = arc_starts[starts][contour_index] + step * spacing
+
+    # Interpolate along the segment each pick falls in
+    segment = np.searchsorted(arc_ends, arc, side='right')
+    segment = np.clip(segment, starts[contour_index],
+                      ends[contour_index] - 1)
+    segment_length = arc_ends[segment] - arc_starts[segment]
+    fraction = np.divide(arc - arc_starts[segment], segment_length,
+                         out=np.zeros_like(arc), where=segment_length > 0)
+    picks = points[segment] + fraction[:, None] * segments[segment]
+
+    # Map the (x, y) picks back to rows and columns of the full-res image
+    return (downsample*picks[:, 1], downsample*picks[:, 0])
 
 
 def generate_picks(masks, psize, downsample, box_size, mode='edge'):
@@ -354,12 +737,15 @@ def generate_picks(masks, psize, downsample, box_size, mode='edge'):
 
     Arguments:
     masks (list): Masks found by segmentation of a micrograph,
-    with or without postprocessing.
+    with or without postprocessing, either full-frame or compact.
     downsample (int): The downsampling factor applied when generating masks.
     psize (float): The pixel size of the original micrograph (Angstrom/pixel).
     box_size (int): The spacing used to make a grid of picks in
     the micrograph, in Angstrom. A larger number represents sparcer picks.
-    mode (str): Whether to return edge ("edge") or surface picks ("surface").
+    In "contour" mode, the spacing of picks along each contour instead.
+    mode (str): Whether to return edge ("edge") or surface picks
+    ("surface") on a grid, or picks along the contours ("contour")
+    from contour_picks().
 
     Outputs:
     pick_indices (list): A list of numpy arrays containing the
@@ -367,6 +753,10 @@ def generate_picks(masks, psize, downsample, box_size, mode='edge'):
     respectively, upsampled to map back onto the full-resolution micrograph.
     """
 
+    # Contour picks are spaced along each contour, without a grid
+    if mode == "contour":
+        return contour_picks(masks, psize, downsample, box_size)
+
     # Generate picks based on whether user wants surfaces, edges, or both
     if mode == "edge":
         pick_mask = helpers.sum_masks(masks, 'edge')
@@ -384,37 +774,39 @@ def generate_picks(masks, psize, downsample, box_size, mode='edge'):
     w_org = pick_mask.shape[1]
     h_pad = int(np.ceil(h_org/box_size)*box_size - h_org)
     w_pad = int(np.ceil(w_org/box_size)*box_size - w_org)
-    pick_mask_pad = np.pad(pick_mask, ((0,h_pad),(0,w_pad)), "constant")
-
-    # Split the micrograph into evenly spaced grids assuming square micrograph
-    split_pick_mask = helpers.blockshaped(pick_mask_pad, box_size, box_size)
-
-    # In each patch, if the sum of the mask is greater
-    # than zero (i.e. if there is an edge)
-    # select the pick closest to the center by setting all
-    # other values in the patch to zero
-    for i in range(split_pick_mask.shape[0]):
-        this_patch = np.copy(split_pick_mask[i, :, :])
-        if np.sum(this_patch) > 0:
-            indices = np.argwhere(this_patch)
-            distances = np.sum((indices - box_size / 2) ** 2, axis=1)
-            best_indices = indices[np.argmin(distances)]
-            this_patch = np.zeros(this_patch.shape)
-            this_patch[best_indices[0], best_indices[1]] = 1
-            split_pick_mask[i, :, :] = this_patch
-
-    # Undo the split
-    merged_pick_mask_pad = helpers.unblockshaped(
-        split_pick_mask,
-        pick_mask_pad.shape[0],
-        pick_mask_pad.shape[1]
+    pick_mask_pad = np.pad(pick_mask > 0, ((0, h_pad), (0, w_pad)), "constant")
+
+    # Order the pixels of a block by their distance to the block center,
+    # breaking ties in row-major order
+    block_indices = np.indices((box_size, box_size)).reshape(2, -1)
+    distances = np.sum((block_indices - box_size / 2) ** 2, axis=0)
+    closest_first = np.argsort(distances, kind='stable')
+    block_rows = block_indices[0][closest_first]
+    block_cols = block_indices[1][closest_first]
+
+    # Split the micrograph into evenly spaced grids, gathering the pixels of
+    # every block in order of distance along the first axis in one pass
+    n_rows = pick_mask_pad.shape[0] // box_size
+    n_cols = pick_mask_pad.shape[1] // box_size
+    sorted_pick_mask = pick_mask_pad.reshape(
+        n_rows, box_size, n_cols, box_size
+    )[:, block_rows, :, block_cols]
+
+    # In each block, if there is an edge, select the pick closest to the
+    # center as the first occupied pixel in order of distance
+    best_rank = np.argmax(sorted_pick_mask, axis=0)
+    grid_rows, grid_cols = np.nonzero(
+        np.take_along_axis(sorted_pick_mask, best_rank[None], axis=0)[0]
     )
+    best_rank = best_rank[grid_rows, grid_cols]
 
-    # Undo the pad
-    merged_pick_mask = merged_pick_mask_pad[0:h_org, 0:w_org]
+    # Map the block-relative picks back onto the micrograph
+    rows = grid_rows * box_size + block_rows[best_rank]
+    cols = grid_cols * box_size + block_cols[best_rank]
 
-    # Generate the pick indices
-    pick_indices = np.where(merged_pick_mask == 1)
+    # Generate the pick indices in row-major order
+    order = np.lexsort((cols, rows))
+    pick_indices = (rows[order], cols[order])
 
     # Map the grid pick indices back to the full-res image
     pick_indices = (downsample*pick_indices[0], downsample*pick_indices[1])
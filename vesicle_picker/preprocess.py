@@ -1,5 +1,179 @@
 from cryosparc.tools import downsample as csparc_downsample
-from cv2 import GaussianBlur, medianBlur, bilateralFilter
+from cv2 import (
+    GaussianBlur, medianBlur, bilateralFilter, boxFilter, resize,
+    INTER_AREA, INTER_LINEAR
+)
+import numpy as np
+import scipy.fft
+
+# The [preprocessing] options read for each lowpass mode, with their types.
+# Options missing from the parameters file take the defaults below.
+LOWPASS_OPTIONS = {
+    'gaussian': [('sigmaX', float)],
+    'median': [('ksize', int)],
+    'bilateral': [('d', int), ('sigmaColor', float), ('sigmaSpace', float)],
+    'bilateral_grid': [('d', int), ('sigmaColor', float),
+                       ('sigmaSpace', float), ('levels', int)],
+    'guided': [('radius', int), ('eps', float)],
+    'fourier': [('sigma', float)],
+}
+
+
+def lowpass_parameters(parameters):
+
+    """
+    Read the lowpass mode and its options from the [preprocessing]
+    section of a parsed parameters file.
+
+    Arguments:
+    parameters (ConfigParser): The parsed parameters file.
+
+    Outputs:
+    lowpass_mode (str): The lowpass mode.
+    kwargs (dict): The keyword arguments for that mode, to pass on to
+    preprocess_micrograph().
+    """
+
+    lowpass_mode = parameters.get('preprocessing', 'lowpass_mode')
+    if lowpass_mode not in LOWPASS_OPTIONS:
+        raise Exception(
+            "Please input a valid lowpass mode "
+            f"({', '.join(LOWPASS_OPTIONS)})."
+        )
+
+    kwargs = {
+        option: option_type(parameters.get('preprocessing', option))
+        for option, option_type in LOWPASS_OPTIONS[lowpass_mode]
+        if parameters.has_option('preprocessing', option)
+    }
+    if lowpass_mode == 'gaussian':
+        kwargs['ksize'] = (0, 0)
+    return lowpass_mode, kwargs
+
+
+def bilateral_grid_filter(image, d=17, sigmaColor=71, sigmaSpace=71,
+                          levels=None):
+
+    """
+    Approximate bilateralFilter() on a coarse grid (Durand and Dorsey,
+    2002). The intensity range is split into a few levels. For each level,
+    the image is smoothed, at reduced resolution, with weights for pixels
+    of similar intensity, and each pixel interpolates between the two
+    levels nearest its intensity. The cost grows with the number of
+    levels rather than with d squared.
+
+    Arguments:
+    image (np.ndarray): A 2D float32 image.
+    d, sigmaColor, sigmaSpace: As for bilateralFilter(); sigmaColor is in
+    the intensity units of the image, and the spatial weights are a
+    Gaussian with standard deviation sigmaSpace truncated to d by d pixels.
+    levels (int): The number of intensity levels. By default, enough for
+    the levels to be at most sigmaColor apart, up to 32.
+
+    Outputs:
+    filtered (np.ndarray): The filtered image.
+    """
+
+    image = np.asarray(image, dtype=np.float32)
+    low, high = float(image.min()), float(image.max())
+    if levels is None:
+        levels = int(np.clip(np.ceil((high - low) / sigmaColor) + 1, 2, 32))
+    if high == low:
+        return image.copy()
+
+    # Smooth on a grid coarser by a quarter of the spatial kernel's extent
+    extent = min(d, 2 * sigmaSpace) if d > 0 else 2 * sigmaSpace
+    factor = max(1, int(extent // 8))
+    coarse = resize(image, None, fx=1 / factor, fy=1 / factor,
+                    interpolation=INTER_AREA)
+    ksize = (max(1, d // factor) | 1,) * 2 if d > 0 else (0, 0)
+
+    # Each pixel's position between the levels
+    position = (image - low) * ((levels - 1) / (high - low))
+
+    filtered = np.zeros_like(image)
+    for level, value in enumerate(np.linspace(low, high, levels)):
+        weights = np.exp(-0.5 * np.square((coarse - value) / sigmaColor))
+        smoothed = GaussianBlur(weights * coarse, ksize, sigmaSpace / factor)
+        smoothed /= np.maximum(
+            GaussianBlur(weights, ksize, sigmaSpace / factor), 1e-12
+        )
+        smoothed = resize(smoothed, image.shape[::-1],
+                          interpolation=INTER_LINEAR)
+
+        # Linear interpolation between levels, as a hat function
+        share = np.abs(position - level)
+        np.subtract(1, share, out=share)
+        np.maximum(share, 0, out=share)
+        filtered += share * smoothed
+
+    return filtered
+
+
+def guided_filter(image, radius=4, eps=10):
+
+    """
+    Edge-preserving smoothing with a guided filter that uses the image as
+    its own guide (He et al., 2013). Each pixel becomes a local linear
+    function of the image, fitted in a window of the given radius, so
+    flat regions are averaged while strong edges such as membranes are
+    kept. It costs four box filters, whatever the radius.
+
+    Arguments:
+    image (np.ndarray): A 2D float32 image.
+    radius (int): The radius of the window, in pixels.
+    eps (float): The regularization, as a fraction of the variance of the
+    image. Larger values smooth more across edges.
+
+    Outputs:
+    filtered (np.ndarray): The filtered image.
+    """
+
+    image = np.asarray(image, dtype=np.float32)
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    mean = boxFilter(image, -1, ksize)
+    variance = boxFilter(image * image, -1, ksize) - mean * mean
+    a = variance / (variance + eps * float(image.var()))
+    b = mean - a * mean
+    return boxFilter(a, -1, ksize) * image + boxFilter(b, -1, ksize)
+
+
+def fourier_downsample(image_fullres, downsample, sigma=2):
+
+    """
+    Downsample and lowpass filter in one step, by cropping the Fourier
+    transform of the full-resolution image to the downsampled size and
+    applying a Gaussian lowpass to the cropped transform. The output has
+    the shape and intensity scale of csparc_downsample() followed by
+    GaussianBlur() with standard deviation sigma, but without aliasing.
+
+    Arguments:
+    image_fullres (np.ndarray): A 2D full-resolution image.
+    downsample (int): The downsampling factor.
+    sigma (float): The standard deviation of the Gaussian lowpass,
+    in downsampled pixels.
+
+    Outputs:
+    blur (np.ndarray): The downsampled, filtered float32 image.
+    """
+
+    ny, nx = (size // downsample for size in image_fullres.shape)
+    image = np.asarray(image_fullres[:ny * downsample, :nx * downsample],
+                       dtype=np.float32)
+    spectrum = scipy.fft.rfft2(image, workers=-1)
+
+    # Keep the frequencies that fit in the downsampled image
+    cropped = np.concatenate(
+        [spectrum[:(ny + 1) // 2, :nx // 2 + 1],
+         spectrum[spectrum.shape[0] - ny // 2:, :nx // 2 + 1]]
+    )
+    fy = scipy.fft.fftfreq(ny).astype(np.float32)[:, None]
+    fx = scipy.fft.rfftfreq(nx).astype(np.float32)[None, :]
+    cropped *= np.exp(-2 * (np.pi * sigma)**2 * (fy**2 + fx**2))
+
+    # The unnormalized forward transform of the full image and normalized
+    # inverse of the small one scale intensities like summed binning
+    return scipy.fft.irfft2(cropped, s=(ny, nx), workers=-1)
 
 
 def preprocess_micrograph(image_fullres,
@@ -18,7 +192,9 @@ def preprocess_micrograph(image_fullres,
     by this factor.
     lowpass_mode (str): The smoothing filter applied to the downsampled
     image; "gaussian" for Gaussian blur, "median" for Median filtering,
-    and "bilateral" for Bilateral filtering.
+    "bilateral" for Bilateral filtering, "bilateral_grid" for a faster
+    approximation of it, "guided" for guided filtering, or "fourier" for
+    a Gaussian lowpass applied while downsampling in Fourier space.
     **kwargs: Keyword arguments to pass to the lowpass function of choice.
 
     Outputs:
@@ -26,6 +202,10 @@ def preprocess_micrograph(image_fullres,
     downsampling and smoothing filtering applied.
     """
 
+    # Downsampling and filtering in Fourier space happen in one step
+    if lowpass_mode == "fourier":
+        return fourier_downsample(image_fullres, downsample, **kwargs)
+
     # Downsample the micrograph using cryosparc-tools
     image = csparc_downsample(image_fullres, downsample)
 
@@ -36,9 +216,14 @@ def preprocess_micrograph(image_fullres,
         blur = medianBlur(image, **kwargs)
     elif lowpass_mode == "bilateral":
         blur = bilateralFilter(image,  **kwargs)
+    elif lowpass_mode == "bilateral_grid":
+        blur = bilateral_grid_filter(image, **kwargs)
+    elif lowpass_mode == "guided":
+        blur = guided_filter(image, **kwargs)
     else:
         raise Exception(
-            "Please input a valid lowpass mode (gaussian, median, bilateral)."
+            "Please input a valid lowpass mode (gaussian, median, bilateral, "
+            "bilateral_grid, guided, fourier)."
         )
 
     # Return the blurred micrograph
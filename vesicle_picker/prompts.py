@@ -0,0 +1,184 @@
+# Content-guided prompt points for segment-anything. Instead of prompting
+# the model on a uniform grid, most of whose points land on empty ice, a
+# classical blob detector finds candidate vesicles in the preprocessed
+# micrograph and only their centres are given to the prompt decoder.
+
+from cv2 import GaussianBlur, Laplacian, dilate, CV_32F
+import numpy as np
+
+# The [prompts] options read for content-guided prompts, with their types
+PROMPT_OPTIONS = {
+    'min_radius_A': float,
+    'max_radius_A': float,
+    'scales': int,
+    'threshold': float,
+    'max_points': int,
+    'grid_points_per_side': int,
+}
+PROMPT_METHODS = ['log', 'dog']
+
+
+def prompt_parameters(parameters):
+
+    """
+    Read the blob detector and its options from the [prompts] section of
+    a parsed parameters file.
+
+    Arguments:
+    parameters (ConfigParser): The parsed parameters file.
+
+    Outputs:
+    method (str): The blob detector, or None to prompt on a uniform grid
+    if there is no [prompts] section.
+    kwargs (dict): The keyword arguments for blob_prompts().
+    """
+
+    if not parameters.has_section('prompts'):
+        return None, {}
+
+    method = parameters.get('prompts', 'method', fallback='log')
+    if method not in PROMPT_METHODS:
+        raise Exception(
+            "Please input a valid prompt method "
+            f"({', '.join(PROMPT_METHODS)})."
+        )
+
+    kwargs = {
+        option: option_type(parameters.get('prompts', option))
+        for option, option_type in PROMPT_OPTIONS.items()
+        if parameters.has_option('prompts', option)
+    }
+    return method, kwargs
+
+
+def blob_responses(image, sigmas, method='log'):
+
+    """
+    Compute scale-normalized blob responses of an image at each scale,
+    with a Laplacian of Gaussian ("log") or its approximation by a
+    difference of Gaussians ("dog"), which blurs each scale from the
+    last with a narrower kernel.
+
+    Arguments:
+    image (np.ndarray): A 2D float32 image.
+    sigmas (np.ndarray): The increasing standard deviations of the scales.
+    method (str): "log" or "dog".
+
+    Outputs:
+    responses (np.ndarray): The absolute responses, of shape
+    (len(sigmas), height, width), so dark and bright blobs both respond.
+    """
+
+    image = np.asarray(image, dtype=np.float32)
+    responses = np.empty((len(sigmas),) + image.shape, dtype=np.float32)
+
+    if method == 'log':
+        for index, sigma in enumerate(sigmas):
+            blur = GaussianBlur(image, (0, 0), sigma)
+            responses[index] = sigma**2 * Laplacian(blur, CV_32F)
+    elif method == 'dog':
+        # The difference of Gaussians k apart approximates
+        # (k - 1) sigma^2 times the Laplacian
+        ratio = sigmas[1] / sigmas[0] if len(sigmas) > 1 else 1.0
+        ratio = ratio if ratio > 1 else 1.6
+        blur = GaussianBlur(image, (0, 0), sigmas[0])
+        for index, sigma in enumerate(sigmas):
+            wider = GaussianBlur(blur, (0, 0),
+                                 sigma * np.sqrt(ratio**2 - 1))
+            responses[index] = (wider - blur) / (ratio - 1)
+            blur = wider
+    else:
+        raise Exception(
+            "Please input a valid prompt method "
+            f"({', '.join(PROMPT_METHODS)})."
+        )
+
+    return np.abs(responses, out=responses)
+
+
+def detect_blobs(preprocessed_micrograph, psize, downsample, method='log',
+                 min_radius_A=150, max_radius_A=600, scales=6, threshold=3,
+                 max_points=512):
+
+    """
+    Find candidate vesicles in a preprocessed micrograph with a blob
+    detector. A vesicle of radius r, a dark membrane around its lumen,
+    responds most strongly at its centre at the scale sigma = r / sqrt(2).
+
+    Arguments:
+    preprocessed_micrograph (np.ndarray): A 2D downsampled, blurred
+    micrograph from preprocess_micrograph().
+    psize (float): The pixel size of the original micrograph (Angstrom/pixel).
+    downsample (int): The downsampling factor applied in preprocessing.
+    method (str): "log" for a Laplacian of Gaussian, or "dog" for a
+    difference of Gaussians.
+    min_radius_A, max_radius_A (float): The range of vesicle radii to
+    detect, in Angstrom.
+    scales (int): The number of scales between the two radii.
+    threshold (float): The minimum response of a blob, in robust
+    standard deviations of the responses above their median.
+    max_points (int): The maximum number of blobs, strongest first.
+
+    Outputs:
+    blobs (np.ndarray): One row per blob, strongest first, of its (x, y)
+    pixel coordinates in the preprocessed micrograph, its radius in
+    pixels, and its response.
+    """
+
+    image = np.asarray(preprocessed_micrograph, dtype=np.float32)
+    pixel_size = psize * downsample
+    min_radius = max(min_radius_A / pixel_size, 1.0)
+    max_radius = max(max_radius_A / pixel_size, min_radius)
+    sigmas = np.geomspace(min_radius, max_radius, max(scales, 1))
+    sigmas /= np.sqrt(2)
+
+    # Keep the strongest scale at each pixel, then the local maxima of
+    # the strongest response within the smallest vesicle's radius
+    responses = blob_responses(image, sigmas, method)
+    scale = responses.argmax(axis=0)
+    response = np.take_along_axis(responses, scale[None], axis=0)[0]
+    size = 2 * int(min_radius) + 1
+    peaks = response >= dilate(response, np.ones((size, size), np.uint8))
+
+    median = np.median(response)
+    spread = 1.4826 * np.median(np.abs(response - median))
+    peaks &= response > median + threshold * max(spread, 1e-12)
+
+    y, x = np.nonzero(peaks)
+    order = np.argsort(response[y, x])[::-1][:max_points]
+    y, x = y[order], x[order]
+    return np.stack([x + 0.5, y + 0.5, np.sqrt(2) * sigmas[scale[y, x]],
+                     response[y, x]], axis=1)
+
+
+def blob_prompts(preprocessed_micrograph, psize, downsample, method='log',
+                 grid_points_per_side=0, **kwargs):
+
+    """
+    Find candidate vesicles in a preprocessed micrograph with
+    detect_blobs(), and return their centres as prompt points.
+
+    Arguments:
+    preprocessed_micrograph, psize, downsample, method, **kwargs: As for
+    detect_blobs().
+    grid_points_per_side (int): If above zero, also prompt on a coarse
+    uniform grid, to catch vesicles the detector misses.
+
+    Outputs:
+    points (np.ndarray): The prompt points, of shape (N, 2), as (x, y)
+    pixel coordinates in the preprocessed micrograph.
+    """
+
+    points = detect_blobs(preprocessed_micrograph, psize, downsample,
+                          method, **kwargs)[:, :2]
+
+    if grid_points_per_side > 0:
+        height, width = preprocessed_micrograph.shape
+        offsets = np.arange(grid_points_per_side) + 0.5
+        offsets /= grid_points_per_side
+        grid_x, grid_y = np.meshgrid(offsets * width, offsets * height)
+        points = np.concatenate(
+            [points, np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)]
+        )
+
+    return points
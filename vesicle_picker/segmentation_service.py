@@ -0,0 +1,257 @@
+# A resident segmentation service, which loads the segment-anything model
+# once and keeps its mask generators warm, so that scripts and notebooks
+# can submit micrographs to it over a local socket instead of loading the
+# model on every run.
+
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from vesicle_picker import generate_masks, preprocess, funcs_mrcio
+import threading
+
+
+def parse_address(address):
+
+    """
+    Parse a service address, given as host:port for a TCP socket
+    or as a filepath for a Unix socket.
+    """
+
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def service_address(parameters):
+
+    """
+    Read the address and authentication key of the segmentation service
+    from the [service] section of a parsed parameters file.
+    """
+
+    return (
+        parse_address(parameters.get('service', 'address')),
+        parameters.get('service', 'authkey').encode()
+    )
+
+
+class SegmentationService:
+
+    """
+    Segments micrographs sent by SegmentationClient objects with a model
+    loaded once. A mask generator is kept for each distinct set of mask
+    generator parameters, and requests are segmented one at a time.
+    """
+
+    def __init__(self, model, embedding_cache=None):
+
+        """
+        Arguments:
+        model (PyTorch model): An initialized segment-anything model.
+        embedding_cache (EmbeddingCache): A cache of image embeddings, or None.
+        """
+
+        self.model = model
+        self.embedding_cache = embedding_cache
+        self.mask_generators = {}
+        self.lock = threading.Lock()
+        self.listener = None
+        self.authkey = None
+        self.stopping = False
+        self.requests = 0
+
+    def _mask_generator(self, kwargs):
+
+        """Return the warm mask generator for a set of parameters."""
+
+        key = tuple(sorted(kwargs.items()))
+        if key not in self.mask_generators:
+            self.mask_generators[key] = generate_masks.build_mask_generator(
+                self.model, 'crop', self.embedding_cache, **kwargs
+            )
+        return self.mask_generators[key]
+
+    def handle(self, request):
+
+        """
+        Handle one request, a dictionary with a 'command':
+
+        'segment' segments a 'preprocessed_micrograph', or the micrograph in
+        the MRC file at 'path', which is first preprocessed with the given
+        'downsample', 'lowpass_mode' and 'lowpass_kwargs'. The 'psize',
+        'downsample', optional 'prompts' and mask generator 'kwargs' are as
+        for generate_masks(). Returns the compact 'masks', and the
+        'preprocessed_micrograph' for requests by path.
+
+        'ping' returns the number of requests handled and mask generators
+        kept, and 'shutdown' stops the service.
+        """
+
+        command = request.get('command')
+        if command == 'ping':
+            return {'requests': self.requests,
+                    'mask_generators': len(self.mask_generators)}
+        if command == 'shutdown':
+            self.stopping = True
+            return {}
+        if command != 'segment':
+            raise Exception(
+                "Please input a valid command (segment, ping, shutdown)."
+            )
+
+        response = {}
+        preprocessed_micrograph = request.get('preprocessed_micrograph')
+        if preprocessed_micrograph is None:
+            preprocessed_micrograph = preprocess.preprocess_micrograph(
+                funcs_mrcio.MRC(request['path']).section(0),
+                downsample=request['downsample'],
+                lowpass_mode=request['lowpass_mode'],
+                **request.get('lowpass_kwargs', {})
+            )
+            response['preprocessed_micrograph'] = preprocessed_micrograph
+
+        with self.lock:
+            response['masks'] = generate_masks.generate_masks(
+                preprocessed_micrograph,
+                self.model,
+                psize=request['psize'],
+                downsample=request['downsample'],
+                output_mode='crop',
+                mask_generator=self._mask_generator(request.get('kwargs', {})),
+                prompts=request.get('prompts')
+            )
+            self.requests += 1
+        return response
+
+    def _serve_connection(self, connection):
+
+        """Answer the requests of one client until it disconnects."""
+
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = self.handle(request)
+                except Exception as error:
+                    response = {'error': f"{type(error).__name__}: {error}"}
+                connection.send(response)
+
+                # Wake the listener, so it sees that the service is stopping
+                if self.stopping:
+                    Client(self.listener.address, authkey=self.authkey).close()
+                    return
+
+    def serve(self, address, authkey):
+
+        """
+        Accept clients at an address until a client sends 'shutdown'.
+        Each client is served on its own thread.
+
+        Arguments:
+        address (tuple or str): (host, port) or a Unix socket filepath.
+        authkey (bytes): The key clients must authenticate with.
+        """
+
+        self.authkey = authkey
+        self.listener = Listener(address, authkey=authkey)
+        with self.listener:
+            while not self.stopping:
+                try:
+                    connection = self.listener.accept()
+                except (OSError, AuthenticationError):
+                    continue
+                if self.stopping:
+                    connection.close()
+                    break
+                threading.Thread(target=self._serve_connection,
+                                 args=(connection,), daemon=True).start()
+
+
+class SegmentationClient:
+
+    """
+    Submits micrographs to a running SegmentationService. A client can be
+    shared by several threads, whose requests are sent one at a time.
+    """
+
+    def __init__(self, address, authkey):
+
+        """
+        Arguments:
+        address (tuple or str): The address of the service.
+        authkey (bytes): The key to authenticate with.
+        """
+
+        self.connection = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+
+    def _request(self, request):
+        with self.lock:
+            self.connection.send(request)
+            response = self.connection.recv()
+        if 'error' in response:
+            raise Exception(
+                f"The segmentation service failed: {response['error']}"
+            )
+        return response
+
+    def generate_masks(self, preprocessed_micrograph, psize, downsample,
+                       prompts=None, **kwargs):
+
+        """
+        Segment a preprocessed micrograph, as generate_masks.generate_masks()
+        with output_mode='crop', returning its compact masks.
+        """
+
+        return self._request({
+            'command': 'segment',
+            'preprocessed_micrograph': preprocessed_micrograph,
+            'psize': psize,
+            'downsample': downsample,
+            'prompts': prompts,
+            'kwargs': kwargs
+        })['masks']
+
+    def segment_file(self, path, psize, downsample, lowpass_mode,
+                     lowpass_kwargs=None, **kwargs):
+
+        """
+        Preprocess and segment the micrograph in an MRC file that the
+        service can read, returning the preprocessed micrograph and
+        its compact masks.
+        """
+
+        response = self._request({
+            'command': 'segment',
+            'path': path,
+            'psize': psize,
+            'downsample': downsample,
+            'lowpass_mode': lowpass_mode,
+            'lowpass_kwargs': lowpass_kwargs or {},
+            'kwargs': kwargs
+        })
+        return response['preprocessed_micrograph'], response['masks']
+
+    def ping(self):
+
+        """Return the service's counts of requests and mask generators."""
+
+        return self._request({'command': 'ping'})
+
+    def shutdown(self):
+
+        """Stop the service."""
+
+        self._request({'command': 'shutdown'})
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,285 @@
+# Functions to split the micrographs of one cryosparc job across several
+# processes or nodes, either as fixed shards or through a work queue of
+# lock files on a shared filesystem. Each run is named by a run ID, which
+# keeps the lock files and per-shard outputs of different runs apart.
+
+import glob
+import os
+import re
+import socket
+
+
+def add_sharding_arguments(parser):
+
+    """
+    Add the --shard and --work-queue command line options to an
+    argparse parser. The two options are mutually exclusive.
+    """
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--shard',
+        type=str,
+        default=None,
+        help='Process only shard i of N, written as i/N with i counting '
+             'from 0, taking every Nth micrograph.'
+    )
+    group.add_argument(
+        '--work-queue',
+        type=str,
+        default=None,
+        help='Directory on a shared filesystem. Workers started with the '
+             'same directory and run ID claim micrographs one at a time '
+             'with lock files until none are left.'
+    )
+    parser.add_argument(
+        '--run-id',
+        type=str,
+        default=None,
+        help='Name of this run, shared by all its workers and needed with '
+             '--shard, --work-queue and --merge. Use a new run ID to start '
+             'over, or the same one to resume an interrupted run.'
+    )
+
+
+def run_id(args):
+
+    """
+    Return the run ID given on the command line, checking that it is
+    given when the micrographs are split across processes.
+    """
+
+    if args.run_id is None:
+        raise Exception(
+            "Please input a --run-id with --shard, --work-queue or --merge."
+        )
+    # Underscores separate the run ID from the worker name in file names
+    if not re.fullmatch(r'[A-Za-z0-9.-]+', args.run_id):
+        raise Exception(
+            "Please input a valid run ID, of letters, digits, '.' and '-'."
+        )
+    return args.run_id
+
+
+def parse_shard(shard):
+
+    """
+    Parse a shard given as "i/N" into its index and count,
+    checking that 0 <= i < N.
+    """
+
+    index, count = (int(value) for value in shard.split('/'))
+    if not 0 <= index < count:
+        raise Exception(
+            f"Please input a valid shard i/N with 0 <= i < N, not {shard}."
+        )
+    return index, count
+
+
+def shard_micrographs(micrographs, index, count):
+
+    """
+    Return every count-th micrograph starting from index, so that
+    shards 0 to count-1 together cover each micrograph exactly once.
+    """
+
+    return micrographs[index::count]
+
+
+def _abandoned(lock_filename):
+
+    """
+    Check whether a lock file was left by a worker on this host that is
+    no longer running. Locks held by other hosts cannot be checked.
+    """
+
+    try:
+        with open(lock_filename) as file:
+            host, pid = file.read().split()
+        if host != socket.gethostname():
+            return False
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+
+def _claim(lock_filename, owner):
+
+    """
+    Atomically create a lock file, or take over one abandoned by a
+    crashed worker on this host. Returns True if the lock was claimed.
+    """
+
+    for _ in range(2):
+        try:
+            lock = os.open(lock_filename,
+                           os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _abandoned(lock_filename):
+                return False
+
+            # Only one worker can move the abandoned lock aside
+            abandoned = f"{lock_filename}.abandoned.{os.getpid()}"
+            try:
+                os.rename(lock_filename, abandoned)
+            except FileNotFoundError:
+                return False
+            os.remove(abandoned)
+            continue
+        with os.fdopen(lock, 'w') as file:
+            file.write(owner)
+        return True
+    return False
+
+
+def queue_directory(args):
+
+    """Return the directory of this run's lock files in the work queue."""
+
+    return os.path.join(args.work_queue, run_id(args))
+
+
+def finish_micrograph(args, uid):
+
+    """
+    Mark a micrograph claimed from the work queue as done, by renaming
+    its lock file <uid>.lock to <uid>.done, so no worker of the run
+    claims it again. Does nothing without a work queue.
+    """
+
+    if args.work_queue is None:
+        return
+    lock_filename = os.path.join(queue_directory(args), f"{uid}.lock")
+    if os.path.isfile(lock_filename):
+        os.replace(lock_filename, lock_filename[:-len('.lock')] + '.done')
+
+
+def claim_micrographs(micrographs, args, finish_on_next=True):
+
+    """
+    Yield the micrographs that this worker claims from a work queue.
+    A micrograph is claimed by atomically creating the lock file
+    <uid>.lock in the run's directory of the queue, so among all workers
+    of a run each micrograph is claimed exactly once. Since micrographs
+    are only claimed as they are consumed, faster workers claim more of
+    them. Micrographs marked done by finish_micrograph() are skipped, and
+    locks left by crashed workers on the same host are claimed again,
+    so an interrupted run resumes with the same run ID.
+
+    Arguments:
+    micrographs (cryosparc Micrographs object): All the micrographs of
+    the job, in the same order for every worker.
+    args (Namespace): Parsed command line arguments with the work queue
+    and run ID.
+    finish_on_next (bool): Whether to mark each micrograph done when
+    the next one is requested, for loops that handle one micrograph at a
+    time. Otherwise, call finish_micrograph() once it is done.
+
+    Outputs:
+    micrograph (cryosparc Micrograph object): The next claimed micrograph.
+    """
+
+    directory = queue_directory(args)
+    os.makedirs(directory, exist_ok=True)
+    owner = f"{socket.gethostname()} {os.getpid()}\n"
+
+    for micrograph in micrographs[:]:
+        uid = micrograph['uid']
+        lock_filename = os.path.join(directory, f"{uid}.lock")
+        if not _claim(lock_filename, owner):
+            continue
+
+        # A micrograph may have been finished before the lock was taken
+        if os.path.isfile(os.path.join(directory, f"{uid}.done")):
+            os.remove(lock_filename)
+            continue
+
+        yield micrograph
+        if finish_on_next:
+            finish_micrograph(args, uid)
+
+
+def select_micrographs(micrographs, args, finish_on_next=True):
+
+    """
+    Select the micrographs this process should handle, given parsed
+    command line arguments from add_sharding_arguments(). Without
+    either option, all micrographs are returned. finish_on_next is
+    passed to claim_micrographs() for work queues.
+    """
+
+    if args.shard is not None:
+        run_id(args)
+        return shard_micrographs(micrographs, *parse_shard(args.shard))
+    if args.work_queue is not None:
+        return claim_micrographs(micrographs, args, finish_on_next)
+    return micrographs[:]
+
+
+def worker_name(args):
+
+    """
+    Name this process's share of the work, for per-shard output files,
+    or return None if the process handles all micrographs.
+    """
+
+    if args.shard is not None:
+        index, count = parse_shard(args.shard)
+        return f"{run_id(args)}_shard_{index}_of_{count}"
+    if args.work_queue is not None:
+        return f"{run_id(args)}_{socket.gethostname()}_{os.getpid()}"
+    return None
+
+
+def run_files(directory, prefix, args, extension):
+
+    """
+    Find the per-worker output files of this run, named
+    <prefix>_<worker name><extension> in directory, checking that no
+    shard of a sharded run is missing.
+
+    Arguments:
+    directory (str): The directory the workers wrote their outputs to.
+    prefix (str): The file name before the worker name.
+    args (Namespace): Parsed command line arguments with the run ID.
+    extension (str): The file extension, such as ".cs".
+
+    Outputs:
+    filenames (list): The sorted paths of the run's files.
+    """
+
+    run_prefix = f"{prefix}_{run_id(args)}_"
+    filenames = sorted(
+        glob.glob(os.path.join(glob.escape(directory),
+                               glob.escape(run_prefix) + '*' + extension))
+    )
+    if len(filenames) == 0:
+        raise Exception(
+            f"No {prefix} files of run {args.run_id} in {directory}."
+        )
+
+    # Every shard of a sharded run must be present
+    shards = [
+        re.fullmatch(r'shard_(\d+)_of_(\d+)',
+                     os.path.basename(filename)[len(run_prefix):
+                                                -len(extension)])
+        for filename in filenames
+    ]
+    shards = {(int(match[1]), int(match[2])) for match in shards if match}
+    counts = {count for _, count in shards}
+    if len(counts) > 1:
+        raise Exception(
+            f"Run {args.run_id} mixes shard counts {sorted(counts)}."
+        )
+    for count in counts:
+        missing = sorted(set(range(count))
+                         - {index for index, _ in shards})
+        if missing:
+            raise Exception(
+                f"Shards {missing} of {count} of run {args.run_id} "
+                f"are missing from {directory}."
+            )
+    return filenames
@@ -0,0 +1,214 @@
+# Where find_vesicles.py reads micrographs from: downloaded over HTTP from
+# cryoSPARC, or memory-mapped from a mounted project directory or a plain
+# directory of MRC files. Each source records how fast it delivers images.
+
+from vesicle_picker import funcs_mrcio
+import numpy as np
+import abc
+import os
+import threading
+import time
+
+
+class MicrographSource(abc.ABC):
+
+    """
+    Reads the full-resolution image of a cryosparc micrograph and records,
+    for each read, the time to the first pixel and the time until every
+    pixel has been read once.
+    """
+
+    mode = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.micrographs = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.first_pixel_seconds = 0.0
+
+    @abc.abstractmethod
+    def _open(self, micrograph):
+
+        """Return the image of a micrograph as a 2D array, possibly lazily."""
+
+    def _load(self, image):
+
+        """Make sure every pixel of an image returned by _open() is read."""
+
+        return image
+
+    def read(self, micrograph):
+
+        """
+        Read the full-resolution image of a micrograph.
+
+        Arguments:
+        micrograph (cryosparc Micrograph object): The micrograph to read.
+
+        Outputs:
+        image (np.ndarray): A 2D array of the image, which may be a
+        read-only memory-mapped view of the file on disk.
+        """
+
+        start = time.perf_counter()
+        image = self._open(micrograph)
+        image[0, 0]
+        first_pixel = time.perf_counter()
+        image = self._load(image)
+        finished = time.perf_counter()
+
+        with self.lock:
+            self.micrographs += 1
+            self.bytes += image.nbytes
+            self.seconds += finished - start
+            self.first_pixel_seconds += first_pixel - start
+
+        return image
+
+    def summary(self):
+
+        """
+        Summarize the reads so far: the mode, number of micrographs and
+        bytes read, bandwidth in MB/s, and mean time to first pixel.
+        """
+
+        return {
+            'mode': self.mode,
+            'micrographs': self.micrographs,
+            'bytes': self.bytes,
+            'bandwidth_MBps': (
+                self.bytes / self.seconds / 1e6 if self.seconds else 0
+            ),
+            'mean_first_pixel_seconds': (
+                self.first_pixel_seconds / self.micrographs
+                if self.micrographs else 0
+            ),
+        }
+
+
+class CryosparcSource(MicrographSource):
+
+    """Downloads micrographs from cryoSPARC with project.download_mrc()."""
+
+    mode = 'cryosparc'
+
+    def __init__(self, project):
+        super().__init__()
+        self.project = project
+
+    def _open(self, micrograph):
+        header, image_fullres = self.project.download_mrc(
+            micrograph["micrograph_blob/path"]
+        )
+        return image_fullres[0]
+
+
+class MemmapSource(MicrographSource):
+
+    """
+    Memory-maps micrographs from MRC files on a local filesystem with
+    funcs_mrcio.MRC, so image bytes are paged in from disk
+    rather than copied.
+    """
+
+    @abc.abstractmethod
+    def _path(self, micrograph):
+
+        """Return the local filepath of a micrograph's MRC file."""
+
+    def _open(self, micrograph):
+        return funcs_mrcio.MRC(self._path(micrograph)).section(0)
+
+    def _load(self, image):
+
+        # Fault in every page of the mapping with one strided read, which
+        # also leaves the pages cached for preprocessing. Sections are
+        # C-contiguous, so reshaping them never copies.
+        pixels = image.reshape(-1)
+        np.sum(pixels[::max(1, 4096 // image.itemsize)], dtype=np.float64)
+        return image
+
+
+class ProjectSource(MemmapSource):
+
+    """
+    Reads micrographs from a cryoSPARC project directory mounted on this
+    node, resolving each micrograph's micrograph_blob/path under it.
+    """
+
+    mode = 'project'
+
+    def __init__(self, project_directory):
+        super().__init__()
+        self.project_directory = project_directory
+
+    def _path(self, micrograph):
+        return os.path.join(self.project_directory,
+                            str(micrograph["micrograph_blob/path"]))
+
+
+class DirectorySource(MemmapSource):
+
+    """
+    Reads micrographs from a plain directory of MRC files, named like
+    the file at each micrograph's micrograph_blob/path.
+    """
+
+    mode = 'directory'
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def _path(self, micrograph):
+        return os.path.join(
+            self.directory,
+            os.path.basename(str(micrograph["micrograph_blob/path"]))
+        )
+
+
+def project_directory(project):
+
+    """
+    Return the directory of a cryoSPARC project, which cryosparc-tools 4
+    gives by the method Project.dir() and later versions by the property
+    Project.dir.
+    """
+
+    directory = project.dir
+    if callable(directory):
+        directory = directory()
+    return str(directory)
+
+
+def micrograph_source(parameters, project):
+
+    """
+    Build the micrograph source described by the [local_input] section of
+    a parsed parameters file, downloading from cryoSPARC if there is none.
+
+    Arguments:
+    parameters (ConfigParser): The parsed parameters file.
+    project (cryosparc Project object): The project to download from.
+
+    Outputs:
+    source (MicrographSource): The source to read micrographs with.
+    """
+
+    if not parameters.has_section('local_input'):
+        return CryosparcSource(project)
+
+    mode = parameters.get('local_input', 'mode', fallback='directory')
+    if mode == 'project':
+        if parameters.has_option('local_input', 'project_directory'):
+            return ProjectSource(
+                parameters.get('local_input', 'project_directory')
+            )
+        return ProjectSource(project_directory(project))
+    elif mode == 'directory':
+        return DirectorySource(parameters.get('local_input', 'directory'))
+    else:
+        raise Exception(
+            "Please input a valid local_input mode (project, directory)."
+        )
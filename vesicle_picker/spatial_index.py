@@ -0,0 +1,90 @@
+# A uniform grid over the bounding boxes of masks, to find the pairs of
+# masks whose boxes overlap without comparing every mask with every other.
+# Masks of vesicles are of similar sizes, so with cells about the size of
+# a typical box, each box falls in a few cells and each cell holds a few
+# boxes, and finding overlaps takes close to linear time.
+
+import numpy as np
+
+
+def box_cell_size(boxes):
+
+    """Choose a cell size for a grid of boxes: the median box side."""
+
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    if len(boxes) == 0:
+        return 1
+    return max(int(np.median(boxes[:, 2:])), 1)
+
+
+class BoxGrid:
+
+    """
+    A grid of cells over the plane, each listing the boxes that cover it.
+    Boxes are given as [x0, y0, width, height].
+    """
+
+    def __init__(self, cell_size):
+
+        """
+        Arguments:
+        cell_size (int): The side length of the cells, in pixels.
+        """
+
+        self.cell_size = cell_size
+        self.cells = {}
+        self.boxes = {}
+
+    def _cells(self, box):
+        x0, y0, w, h = box
+        size = self.cell_size
+        for cy in range(int(y0) // size, (int(y0 + h) - 1) // size + 1):
+            for cx in range(int(x0) // size, (int(x0 + w) - 1) // size + 1):
+                yield cx, cy
+
+    def insert(self, key, box):
+
+        """Add a box to the grid under a key."""
+
+        self.boxes[key] = box
+        for cell in self._cells(box):
+            self.cells.setdefault(cell, []).append(key)
+
+    def query(self, box):
+
+        """Return the keys of the boxes in the grid that overlap a box."""
+
+        x0, y0, w, h = box
+        found = set()
+        for cell in self._cells(box):
+            for key in self.cells.get(cell, []):
+                if key in found:
+                    continue
+                bx, by, bw, bh = self.boxes[key]
+                if (bx < x0 + w and x0 < bx + bw
+                        and by < y0 + h and y0 < by + bh):
+                    found.add(key)
+        return found
+
+
+def overlapping_pairs(boxes, cell_size=None):
+
+    """
+    Find every pair of overlapping boxes.
+
+    Arguments:
+    boxes (list): The boxes, as [x0, y0, width, height].
+    cell_size (int): The cell size of the grid, by default from
+    box_cell_size().
+
+    Outputs:
+    pairs (list): The (i, j) indices of each pair of overlapping boxes,
+    with i < j.
+    """
+
+    grid = BoxGrid(cell_size or box_cell_size(boxes))
+    pairs = []
+    for index, box in enumerate(boxes):
+        pairs += [(other, index) for other in sorted(grid.query(box))]
+        grid.insert(index, box)
+    return pairs